@@ -1,30 +1,55 @@
 from utils import Utils
+from fragment_file import FragmentFile
 import numpy as np
-
-from PyQt5.QtGui import QColor
+from concurrent.futures import ThreadPoolExecutor
+from color import Color
+from edit_history import EditHistory
 
 class BaseFragment:
+
+    # class variable
+    # number of threads used to load fragment files
+    load_threads = 8
+
     def __init__(self, name):
         self.name = name
-        self.color = QColor()
+        self.color = Color()
         self.cvcolor = (0,0,0,0)
         self.created = Utils.timestamp()
         self.modified = Utils.timestamp()
         self.valid = False
         self.project = None
+        # incremented every time the fragment is modified;
+        # used by fragment views to decide whether cached
+        # slice intersections are still valid
+        self.version = 0
+        # stem of the binary file that the fragment is saved in,
+        # and the value of self.version when it was last saved
+        # (or loaded); used to save only the fragments that
+        # have changed
+        self.file_stem = None
+        self.saved_version = None
+        # value of self.version when the fragment was last
+        # written to the project's autosave directory
+        # (see Project.compactJournal)
+        self.autosaved_version = None
+        # undo/redo history of the edits made to gpoints
+        self.history = EditHistory()
 
     def notifyModified(self, tstamp=""):
         if tstamp == "":
             tstamp = Utils.timestamp()
         self.modified = tstamp
+        self.version += 1
         # self.project can be None if BaseFragment is
         # a working Fragment of a TrglFragment
         if self.project is not None:
             self.project.notifyModified(tstamp)
 
-    def setColor(self, qcolor, no_notify=False):
-        self.color = qcolor
-        rgba = qcolor.getRgbF()
+    # color is a Color (not a QColor)
+    def setColor(self, color, no_notify=False):
+        self.color = color
+        rgba = color.getRgbF()
         self.cvcolor = [int(65535*c) for c in rgba] 
         if not no_notify:
             self.notifyModified()
@@ -46,13 +71,120 @@ class BaseFragment:
         for cl, l in class_lists.items():
             cl.saveList(l, path, stem)
 
+    # class function
+    # Makes sure that every fragment has a file stem (based on its
+    # "created" timestamp) that is not used by any other fragment.
+    def assignFileStems(frags):
+        used = set([frag.file_stem for frag in frags if frag.file_stem is not None])
+        for frag in frags:
+            if frag.file_stem is not None:
+                continue
+            cfixed = frag.created.replace(':',"_").replace('.',"p")
+            stem = cfixed
+            count = 1
+            while stem in used:
+                stem = "%s_%d"%(cfixed, count)
+                count += 1
+            used.add(stem)
+            frag.file_stem = stem
+
+    def binaryFileName(self):
+        return self.file_stem + FragmentFile.suffix
+
+    # True if the fragment has been modified since it was last
+    # saved to (or loaded from) the given directory
+    def needsSave(self, path):
+        if self.file_stem is None or self.saved_version != self.version:
+            return True
+        return not (path / self.binaryFileName()).exists()
+
+    # class function
+    # Saves each fragment in its own binary fragment file
+    # (see FragmentFile).
+    # Returns an error string ("" if no error).
+    def saveListBinary(frags, path):
+        BaseFragment.assignFileStems(frags)
+        errs = []
+        for frag in frags:
+            if not hasattr(frag, "binaryInfoAndArrays"):
+                continue
+            fpath = path / frag.binaryFileName()
+            print("writing to", fpath)
+            info, arrays = frag.binaryInfoAndArrays()
+            info['type'] = type(frag).__name__
+            err = FragmentFile.write(fpath, info, arrays)
+            if err != "":
+                errs.append(err)
+            else:
+                frag.saved_version = frag.version
+        if len(errs) > 0:
+            return errs[0]
+        return ""
+
+    # class function
+    # Loads a binary fragment file; the fragment class
+    # is chosen based on the "type" stored in the file.
+    # Like the load() functions of the fragment classes,
+    # returns a list of fragments, or None.
+    def loadBinary(fpath):
+        err, info, arrays = FragmentFile.read(fpath)
+        if err != "":
+            return None
+        frag = BaseFragment.fromBinaryInfo(info, arrays, str(fpath))
+        if frag is None:
+            return None
+        frag.file_stem = fpath.stem
+        frag.saved_version = frag.version
+        return [frag]
+
+    # class function
+    # Creates a fragment from the info and arrays of a binary
+    # fragment file (see binaryInfoAndArrays); the fragment
+    # class is chosen based on info's "type".  source is only
+    # used in error messages.  Returns None on error.
+    def fromBinaryInfo(info, arrays, source):
+        ftype = info.get('type', '')
+        classes = {cl.__name__: cl for cl in BaseFragment.__subclasses__()}
+        if ftype not in classes:
+            print("%s: unknown fragment type '%s'"%(source, ftype))
+            return None
+        return classes[ftype].fromBinary(info, arrays)
+
+    # class function
+    # Loads several binary fragment files, in parallel threads
+    # (opening many files one after another is slow, especially
+    # on network file systems; the fragment data itself is
+    # memory-mapped, and is only read when it is used).
+    # Returns a list with one entry per file, as returned
+    # by loadBinary.
+    def loadBinaryList(fpaths):
+        print("loading", len(fpaths), "fragment files")
+        with ThreadPoolExecutor(max_workers=BaseFragment.load_threads) as executor:
+            return list(executor.map(BaseFragment.loadBinary, fpaths))
+
+    # Arrays loaded from a binary fragment file are memory
+    # mapped; this replaces them by in-memory copies, so that
+    # the file can be moved or deleted (necessary on Windows)
+    def detachArrays(self):
+        for attr, value in list(vars(self).items()):
+            if isinstance(value, np.memmap):
+                setattr(self, attr, FragmentFile.detach(value))
+
     def meshExportNeedsInfill(self):
         return False
 
     # class function
-    def saveListAsObjMesh(fvs, path, infill, ppm):
+    # progress, if not None, is called as progress(done, total),
+    # where done and total are fractions of the whole export;
+    # it should return False if the user has cancelled the export.
+    # tex_volume, if not None, is the volume that textures are
+    # sampled from (see Fragment.saveListAsObjMesh)
+    def saveListAsObjMesh(fvs, path, infill, ppm, progress=None, tex_volume=None):
         class_lists = {}
         for fv in fvs:
+            # views of hidden, inactive fragments may not
+            # have been computed yet
+            fv.materialize()
             frag = fv.fragment
             print("bsl", frag.name)
             # print(type(frag))
@@ -60,10 +192,18 @@ class BaseFragment:
             # t.asdf()
             l = class_lists.setdefault(t, [])
             l.append(fv)
+        start = 0
         for cl, l in class_lists.items():
-            err = cl.saveListAsObjMesh(l, path, infill, ppm, len(class_lists.items()))
+            class_progress = None
+            if progress is not None:
+                # each class's share of the progress is
+                # proportional to its number of fragments
+                share = len(l)/len(fvs)
+                class_progress = lambda done, total, start=start, share=share: progress(start+share*done/max(total,1), 1.)
+            err = cl.saveListAsObjMesh(l, path, infill, ppm, len(class_lists.items()), class_progress, tex_volume)
             if err != "":
                 return err
+            start += len(l)/len(fvs)
         return ""
 
     # class function
@@ -112,40 +252,52 @@ class BaseFragment:
         return sqcm
 
     # class function
+    # Returns an array, of the same shape as trgls, where
+    # neighbors[t,k] is the index of the trgl that shares
+    # with trgl t the edge opposite vertex k (-1 if there is none).
+    # Edges are matched using a single sort of the
+    # (undirected) edge keys.
     def findNeighbors(trgls):
-        index = np.indices((len(trgls),1))[0]
-        ones = np.ones((len(trgls),1), dtype=np.int32)
-        zeros = np.zeros((len(trgls),1), dtype=np.int32)
-        twos = 2*ones
-        
-        e01 = np.concatenate((trgls[:, (0,1)], index, twos, ones), axis=1)
-        e12 = np.concatenate((trgls[:, (1,2)], index, zeros, ones), axis=1)
-        e20 = np.concatenate((trgls[:, (2,0)], index, ones, ones), axis=1)
-        
-        edges = np.concatenate((e01,e12,e20), axis=0)
-        rev = (edges[:,0] > edges[:,1])
-        edges[rev,0:2] = edges[rev,1::-1]
-        edges[rev,4] = -1
-        edges = edges[edges[:,4].argsort()]
-        edges = edges[edges[:,1].argsort(kind='mergesort')]
-        edges = edges[edges[:,0].argsort(kind='mergesort')]
-        
-        ediff = np.diff(edges, axis=0)
-        duprows = np.where(((ediff[:,0]==0) & (ediff[:,1]==0)))[0]
-        duprows2 = np.sort(np.append(duprows, duprows+1))
-        bdup = np.zeros((len(edges)), dtype=np.bool_)
-        bdup[duprows2] = True
-        
-        neighbors = np.full((len(trgls), 3), -1, dtype=np.int32)
-        
-        eplus = edges[duprows+1,:4]
-        eminus = edges[duprows,:4]
-        # print(eplus)
-        # print(eminus)
-        neighbors[eplus[:,2],eplus[:,3]] = eminus[:,2]
-        neighbors[eminus[:,2],eminus[:,3]] = eplus[:,2]
+        trgls = np.asarray(trgls, dtype=np.int64)
+        ntrgl = len(trgls)
+        neighbors = np.full((ntrgl, 3), -1, dtype=np.int32)
+        if ntrgl == 0:
+            return neighbors
+        # edge j of trgl t goes from vertex j to vertex j+1,
+        # and is opposite vertex (j+2)%3; flattened, the
+        # edge's index is 3*t+j
+        va = trgls.ravel()
+        vb = trgls[:, (1,2,0)].ravel()
+        lo = np.minimum(va, vb)
+        hi = np.maximum(va, vb)
+        key = lo*(int(trgls.max())+1) + hi
+        # the lowest bit of the sort key is set if the edge
+        # goes from hi to lo, so that within each pair of
+        # matching edges, the one going from lo to hi comes first
+        order = np.argsort(2*key + (va > vb))
+        skey = key[order]
+        dups = np.nonzero(skey[1:] == skey[:-1])[0]
+        ea = order[dups]
+        eb = order[dups+1]
+        # the neighbors entry of edge 3*t+j is neighbors[t,(j+2)%3]
+        neighbors[ea//3, (ea%3+2)%3] = eb//3
+        neighbors[eb//3, (eb%3+2)%3] = ea//3
         return neighbors
 
+    # class function
+    # Vertex-to-trgl adjacency, in compressed sparse row form:
+    # the trgls that have vertex v as a corner are
+    # tindexes[starts[v]:starts[v+1]].  npts is the
+    # number of vertices.  Returns (starts, tindexes).
+    def vertexTrgls(trgls, npts):
+        flat = np.asarray(trgls).ravel()
+        order = np.argsort(flat, kind='stable')
+        tindexes = (order//3).astype(np.int32)
+        counts = np.bincount(flat, minlength=npts)
+        starts = np.zeros(len(counts)+1, dtype=np.int64)
+        np.cumsum(counts, out=starts[1:])
+        return starts, tindexes
+
     # returns list of indexes of those trgls that have pt_index as
     # a vertex
     def trglsAroundPoint(pt_index, trgls):
@@ -154,14 +306,69 @@ class BaseFragment:
         return tindexes.tolist()
 
 class BaseFragmentView:
+
+    # class variable
+    # maximum number of (axis, position) entries kept
+    # in each fragment view's slice cache
+    slice_cache_size = 16
+
     def __init__(self, project_view, fragment):
         self.project_view = project_view
         self.fragment = fragment
         self.sqcm = 0.
         self.cur_volume_view = None
+        # True if the view's local points (and the surfaces
+        # etc derived from them) have not yet been computed
+        # for the current volume view; see updateLocalPoints
+        self.geometry_pending = False
         self.visible = True
         self.active = False
         self.mesh_visible = True
+        self.slice_cache = {}
+        self.slice_cache_version = -1
+
+    # Computing a view's local points can be slow for large
+    # fragments, and a project may contain many fragments that
+    # are neither visible nor active.  So the computation is
+    # deferred until the view is needed: when it is made
+    # visible or active, or when materialize() is called
+    # (for instance, before export).
+    @property
+    def visible(self):
+        return self._visible
+
+    @visible.setter
+    def visible(self, visible):
+        self._visible = visible
+        if visible:
+            self.materialize()
+
+    @property
+    def active(self):
+        return self._active
+
+    @active.setter
+    def active(self, active):
+        self._active = active
+        if active:
+            self.materialize()
+
+    def isNeeded(self):
+        return self._visible or self._active
+
+    # Calls setLocalPoints if the view is needed; otherwise
+    # marks the local points as pending
+    def updateLocalPoints(self, recursion_ok):
+        if self.cur_volume_view is not None and not self.isNeeded():
+            self.clearSliceCache()
+            self.geometry_pending = True
+            return
+        self.setLocalPoints(recursion_ok)
+
+    # Computes the local points if they are pending
+    def materialize(self):
+        if self.geometry_pending:
+            self.setLocalPoints(False)
 
     def setVolumeView(self, vol_view):
         if vol_view == self.cur_volume_view:
@@ -169,7 +376,7 @@ class BaseFragmentView:
         self.cur_volume_view = vol_view
         self.clearCaches()
         if vol_view is not None:
-            self.setLocalPoints(False)
+            self.updateLocalPoints(False)
 
     def notifyModified(self, tstamp=""):
         if tstamp == "":
@@ -178,13 +385,47 @@ class BaseFragmentView:
         # print("fragment view", self.fragment.name,"modified", tstamp)
         self.project_view.notifyModified(tstamp)
 
+    # Intersections of the fragment with a given slice are
+    # cached, keyed by (kind, axis, axis_pos).  The cache is
+    # emptied whenever the fragment's version changes (see
+    # BaseFragment.notifyModified), and whenever clearSliceCache
+    # is called (local points recomputed, volume view changed).
+    # Callers can rely on getting the identical object back
+    # as long as nothing has changed.
+    def cachedSliceResult(self, kind, axis, axis_pos, compute):
+        version = self.fragment.version
+        if version != self.slice_cache_version:
+            self.slice_cache = {}
+            self.slice_cache_version = version
+        key = (kind, axis, axis_pos)
+        if key in self.slice_cache:
+            return self.slice_cache[key]
+        result = compute(axis, axis_pos)
+        if len(self.slice_cache) >= BaseFragmentView.slice_cache_size:
+            # dicts preserve insertion order, so this
+            # removes the oldest entry
+            del self.slice_cache[next(iter(self.slice_cache))]
+        self.slice_cache[key] = result
+        return result
+
+    def clearSliceCache(self):
+        self.slice_cache = {}
+
     def getZsurfPoints(self, axis, axis_pos):
+        return self.cachedSliceResult(
+                "zsurf", axis, axis_pos, self.computeZsurfPoints)
+
+    def computeZsurfPoints(self, axis, axis_pos):
         return None
 
     def line(self):
         return None
 
     def getLinesOnSlice(self, axis, axis_pos):
+        return self.cachedSliceResult(
+                "lines", axis, axis_pos, self.computeLinesOnSlice)
+
+    def computeLinesOnSlice(self, axis, axis_pos):
         return None, None
 
     def triangulate(self):
@@ -193,6 +434,14 @@ class BaseFragmentView:
     def addPoint(self, tijk):
         return None
 
+    # Adds a batch of points (tijks is a list or array of
+    # tijks); returns a list with the result of addPoint
+    # for each point.  Subclasses that support adding points
+    # should override this, so that the fragment is updated
+    # only once per batch
+    def addPoints(self, tijks):
+        return [self.addPoint(tijk) for tijk in tijks]
+
     def deletePointByIndex(self, index):
         return None
 
@@ -235,10 +484,10 @@ class BaseFragmentView:
     # to recompute things
     def setVolumeViewDirection(self, direction):
         self.clearCaches()
-        self.setLocalPoints(False)
+        self.updateLocalPoints(False)
 
     def clearCaches(self):
-        return None
+        self.clearSliceCache()
     
     def pointNormals(self):
         self.triangulate()
@@ -260,17 +509,44 @@ class BaseFragmentView:
         # fpoints has 4 elements; the 4th is the index
         sgn = self.moveAlongNormalsSign()
         self.fpoints[:, :3] += sgn*step*ns
-        self.fragment.gpoints = self.cur_volume_view.volume.transposedIjksToGlobalPositions(self.fpoints, self.fragment.direction)
-        self.fragment.notifyModified()
-        self.setLocalPoints(True)
+        self.setAllGpointsFromFpoints()
 
     def moveInK(self, step):
         # if len(self.fpoints) > 0:
         #     print("before", self.fragment.gpoints[0], self.fpoints[0])
         self.fpoints[:,2] += step
-        self.fragment.gpoints = self.cur_volume_view.volume.transposedIjksToGlobalPositions(self.fpoints, self.fragment.direction)
+        self.setAllGpointsFromFpoints()
         # if len(self.fpoints) > 0:
         #     print("after", self.fragment.gpoints[0], self.fpoints[0])
+
+    # Called after every point in fpoints has been moved;
+    # the move is recorded in the undo history
+    def setAllGpointsFromFpoints(self):
+        gpoints = self.cur_volume_view.volume.transposedIjksToGlobalPositions(self.fpoints, self.fragment.direction)
+        old_gpoints = self.fragment.gpoints
+        self.fragment.history.record(old_gpoints, replaced=True)
+        self.fragment.gpoints = gpoints
         self.fragment.notifyModified()
         self.setLocalPoints(True)
 
+    # Undoes the most recent edit of the fragment's points
+    # (if any).  Returns a list of the changes that were made,
+    # as (op, index, pt) (see EditHistory); the list is empty
+    # if there was nothing to undo.
+    def undo(self):
+        return self.applyHistory(self.fragment.history.undo)
+
+    # Redoes the most recently undone edit; returns the
+    # changes, as undo does
+    def redo(self):
+        return self.applyHistory(self.fragment.history.redo)
+
+    def applyHistory(self, step):
+        gpoints, changes = step(self.fragment.gpoints)
+        if gpoints is None:
+            return []
+        self.fragment.gpoints = gpoints
+        self.fragment.notifyModified()
+        self.setLocalPoints(True, False)
+        return changes
+
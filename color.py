@@ -0,0 +1,59 @@
+import colorsys
+
+# A plain (Qt-free) RGBA color, used by the data model
+# (fragments and volume views), so that the data model
+# can be imported without loading PyQt5.
+# It provides the subset of the QColor interface that
+# khartes uses: name() and getRgbF().
+# Components are floats in the range 0 to 1.
+# GUI code converts to and from QColor using the
+# "#rrggbb" name: QColor(color.name()) and Color(qcolor.name())
+class Color():
+
+    # name is a string of the form "#rrggbb" (as
+    # returned by name(), or by QColor.name()) or "#aarrggbb".
+    # If no name is given, the color is opaque black.
+    def __init__(self, name=None):
+        self.r, self.g, self.b, self.a = 0., 0., 0., 1.
+        if name is None:
+            return
+        txt = str(name).strip()
+        try:
+            if not txt.startswith('#') or len(txt) not in (7, 9):
+                raise ValueError
+            ints = [int(txt[i:i+2], 16) for i in range(1, len(txt), 2)]
+        except ValueError:
+            print("Could not parse '%s' as a color; using black"%name)
+            return
+        if len(ints) == 4:
+            self.a = ints.pop(0)/255
+        self.r, self.g, self.b = [i/255 for i in ints]
+
+    # class function
+    # r, g, b, a are floats in the range 0 to 1
+    def fromRgbF(r, g, b, a=1.):
+        color = Color()
+        color.r, color.g, color.b, color.a = [min(1., max(0., float(c))) for c in (r, g, b, a)]
+        return color
+
+    # class function
+    # h is in the range 0 to 359, s and v in the range 0 to 255
+    # (same ranges as QColor.setHsv)
+    def fromHsv(h, s, v):
+        r, g, b = colorsys.hsv_to_rgb((h%360)/360, s/255, v/255)
+        return Color.fromRgbF(r, g, b)
+
+    def getRgbF(self):
+        return (self.r, self.g, self.b, self.a)
+
+    # returns "#rrggbb"
+    def name(self):
+        return "#%02x%02x%02x"%tuple(round(255*c) for c in (self.r, self.g, self.b))
+
+    def __eq__(self, other):
+        if not isinstance(other, Color):
+            return NotImplemented
+        return self.getRgbF() == other.getRgbF()
+
+    def __repr__(self):
+        return "Color('%s')"%self.name()
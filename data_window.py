@@ -9,13 +9,18 @@ import numpy.linalg as npla
 import cv2
 
 from utils import Utils
-from st import ST
+from st import ST, STTileCache
+from st_volume import StructureTensorVolume
 # import PIL
 # import PIL.Image
 
 # non-intuitively, QLabel is what is used to display pixmaps
 class DataWindow(QLabel):
 
+    # class variable
+    # structure-tensor fields, shared by all the data windows
+    st_cache = STTileCache()
+
     def __init__(self, window, axis):
         super(DataWindow, self).__init__()
         self.window = window
@@ -36,6 +41,9 @@ class DataWindow(QLabel):
         self.isMovingNode = False
         self.isMovingTiff = False
         self.fv2zpoints = {}
+        # per-fragment-view cache of slice intersections that
+        # have already been converted to window coordinates
+        self.fv2slicexys = {}
         self.localNearbyNodeIndex = -1
         self.maxNearbyNodeDistance = 10
         self.nearbyNodeDistance = -1
@@ -202,6 +210,42 @@ class DataWindow(QLabel):
         xy = np.rint(zoom*(ijs-cij)+wc).astype(np.int32)
         return xy
 
+    # Returns a key that changes whenever the mapping
+    # from tijk to window xy changes
+    def xyTransformKey(self):
+        tijk = self.volume_view.ijktf
+        return (self.getZoom(), tijk[self.iIndex], tijk[self.jIndex],
+                self.iIndex, self.jIndex,
+                self.width(), self.height())
+
+    # Converts zsurf points and intersection lines, as returned
+    # by the fragment view, to window coordinates.  The fragment
+    # view returns the identical objects as long as neither the
+    # fragment nor the slice has changed, so if the xy transform
+    # hasn't changed either, the previous results can be reused.
+    def sliceXys(self, frag, zpts, lines, window_ij_bounds, old_cache):
+        key = self.xyTransformKey()
+        entry = old_cache.get(frag, None)
+        if entry is not None and entry[0] == key and entry[1] is zpts and entry[2] is lines:
+            self.fv2slicexys[frag] = entry
+            return entry[3:]
+        orig_zpts = zpts
+        zxys = None
+        if zpts is not None:
+            wi0, wj0, wi1, wj1 = window_ij_bounds
+            zpts = zpts[(zpts[:,0] >= wi0) & (zpts[:,1] >= wj0) & (zpts[:,0] < wi1) & (zpts[:,1] < wj1)]
+            zxys = self.ijsToXys(zpts)
+            zxys = zxys.reshape(-1,1,1,2).astype(np.int32)
+        lxys = None
+        if lines is not None:
+            ijkpts = lines.reshape(-1, 3)
+            ijpts = self.tijksToIjs(ijkpts)
+            lxys = self.ijsToXys(ijpts)
+            lxys = lxys.reshape(-1,1,2,2)
+        entry = (key, orig_zpts, lines, zpts, zxys, lxys)
+        self.fv2slicexys[frag] = entry
+        return entry[3:]
+
     def getNearbyNodeIjk(self):
         xyijks = self.cur_frag_pts_xyijk
         nearbyNode = self.localNearbyNodeIndex
@@ -906,6 +950,9 @@ class DataWindow(QLabel):
                 sign = -1
             # self.window.drawSlices()
             self.autoExtrapolate(sign, ij)
+        elif not self.isMovingNode and self.axis in (0,1) and key == Qt.Key_I and e.modifiers() == Qt.ControlModifier:
+            self.setWaitCursor()
+            self.autoInterpolateAll()
         elif not self.isMovingNode and self.axis in (0,1) and key == Qt.Key_I:
             self.setWaitCursor()
             self.autoInterpolate()
@@ -1005,6 +1052,36 @@ class DataWindow(QLabel):
         gaxis = self.volume_view.globalAxisFromTransposedAxis(self.axis)
         return gxyz[gaxis]
 
+    # Returns an ST, with eigen fields set, covering the
+    # rectangle ij0, ij1 (data coordinates) of the current slice.
+    # If a 3D structure-tensor field has been precomputed for
+    # the volume (see st_volume.py), the fields are taken from it.
+    # Otherwise they come from the structure-tensor tile cache;
+    # missing tiles are computed from the full-resolution
+    # data (read synchronously, if the volume is a zarr volume).
+    def stInRect(self, ij0, ij1):
+        volume = self.volume_view
+        axis = self.axis
+        k = int(volume.ijktf[axis])
+        shape = volume.trdata.shape
+        extent = (shape[2-self.iIndex], shape[2-self.jIndex])
+        slice_key = (volume.volume, volume.direction, axis, k)
+        def getData(i0, i1, j0, j1):
+            slc = volume.getSliceInRange(
+                    volume.trdata, slice(i0,i1), slice(j0,j1), k, axis)
+            return np.asarray(slc).astype(np.float64)/65535.
+        stv = StructureTensorVolume.forVolume(volume.volume)
+        volume.volume.setImmediateDataMode(True)
+        try:
+            if stv is not None:
+                image = getData(int(ij0[0]), int(ij1[0]), int(ij0[1]), int(ij1[1]))
+                st = stv.createST(volume, axis, k, ij0, ij1, image)
+            else:
+                st = DataWindow.st_cache.getST(slice_key, getData, ij0, ij1, extent)
+        finally:
+            volume.volume.setImmediateDataMode(False)
+        return st
+
     def autoInterpolate(self):
         if self.bounding_nodes is None:
             return
@@ -1072,9 +1149,10 @@ class DataWindow(QLabel):
             return
         if jmin < ij0[1] or jmax >= ij1[1]:
             return
-        st = ST((slc[int(ij0[1]-s0[1]):int(ij1[1]-s0[1]),int(ij0[0]-s0[0]):int(ij1[0]-s0[0])]).astype(np.float64)/65535.)
+        # st = ST((slc[int(ij0[1]-s0[1]):int(ij1[1]-s0[1]),int(ij0[0]-s0[0]):int(ij1[0]-s0[0])]).astype(np.float64)/65535.)
+        # st.computeEigens()
+        st = self.stInRect(ij0, ij1)
         print ("st created", st.image.shape)
-        st.computeEigens()
         '''
         path = self.window.project_view.project.path
         st.saveImage(path / "st_debug.tif")
@@ -1110,22 +1188,100 @@ class DataWindow(QLabel):
         pts[:,0] += ij0[0]
         pts[:,1] += ij0[1]
         # print("xs",pts[:,0])
-        zsurf_update = self.window.live_zsurf_update
-        self.window.setLiveZsurfUpdate(False)
+        tijks = []
         for pt in pts:
             # pt = (dpt[0]+ij0[0], dpt[1]+ij0[1])
             if pt[0] < ijo0[0] or pt[0] >= ijo1[0] or pt[1] < ijo0[1] or pt[1] >= ijo1[1]:
                 break
             tijk = self.ijToTijk(pt)
             # print("adding point at",tijk)
-            self.window.addPointToCurrentFragment(tijk)
-        self.window.setLiveZsurfUpdate(zsurf_update)
+            tijks.append(tijk)
+        self.window.addPointsToCurrentFragment(tijks)
         mpt = self.mapFromGlobal(QCursor.pos())
         mxy = (mpt.x(), mpt.y())
         self.setNearbyTiffAndNode(mxy)
         self.window.drawSlices()
 
 
+    # Auto-interpolates between each pair of consecutive
+    # (in the i direction) nodes of the current fragment that
+    # are on the current slice and in the viewing window.
+    # All the curves share one ST, and are solved together;
+    # the new points are added to the fragment in one batch.
+    def autoInterpolateAll(self):
+        volume = self.volume_view
+        if volume is None :
+            return
+        curfv = self.currentFragmentView()
+        if curfv is None:
+            return
+        xyijks = self.cur_frag_pts_xyijk
+        if xyijks is None or len(xyijks) == 0:
+            return
+        flags = np.array([fv == curfv for fv in self.cur_frag_pts_fv], dtype=np.bool_)
+        ijs = xyijks[flags][:,(2+self.iIndex, 2+self.jIndex)]
+
+        ww = self.size().width()
+        wh = self.size().height()
+        # ij* are corners of the viewing window, in data coordinates
+        ij0 = self.xyToIj((0,0))
+        ij1 = self.xyToIj((ww,wh))
+        ijo0 = ij0
+        ijo1 = ij1
+        # add a margin of 32 pixels (in data coordinates)
+        margin = 32
+        ij0m = (ij0[0]-margin,ij0[1]-margin)
+        ij1m = (ij1[0]+margin,ij1[1]+margin)
+
+        zarr_max_width = self.getZarrMaxWidth()
+        rs = volume.getSliceBounds(self.axis, volume.ijktf, zarr_max_width)
+        if rs is None:
+            return
+        ri = Utils.rectIntersection((ij0m,ij1m), rs)
+        if ri is None:
+            return
+        ij0 = ri[0]
+        ij1 = ri[1]
+        inside = ((ijs >= ijo0) & (ijs < ijo1) & (ijs >= ij0) & (ijs < ij1)).all(axis=1)
+        ijs = ijs[inside]
+        ijs = ijs[np.argsort(ijs[:,0], kind='stable')]
+        # consecutive nodes with different i values
+        pairs = (ijs[1:,0] > ijs[:-1,0]).nonzero()[0]
+        print("autointerpolate all", len(pairs), "pairs", ij0, ij1)
+        if len(pairs) == 0:
+            return
+        st = self.stInRect(ij0, ij1)
+        dijas = ijs[pairs]-ij0
+        dijbs = ijs[pairs+1]-ij0
+        # min distance between computed auto-pick points
+        # (see autoInterpolate)
+        min_delta = 5
+        ijk = self.ijToTijk(ij0)
+        gxyz = self.volume_view.transposedIjkToGlobalPosition(ijk)
+        gaxis = self.volume_view.globalAxisFromTransposedAxis(self.iIndex)
+        gstep = self.volume_view.volume.gijk_steps[gaxis]
+        min_delta_shift = (gxyz[gaxis]/gstep) % min_delta
+        ys = st.interp2dWHSpans(dijas, dijbs)
+        tijks = []
+        for y in ys:
+            if y is None:
+                continue
+            pts = st.sparse_result(y, min_delta_shift, min_delta)
+            if pts is None:
+                continue
+            pts[:,0] += ij0[0]
+            pts[:,1] += ij0[1]
+            for pt in pts:
+                if pt[0] < ijo0[0] or pt[0] >= ijo1[0] or pt[1] < ijo0[1] or pt[1] >= ijo1[1]:
+                    break
+                tijks.append(self.ijToTijk(pt))
+        print(len(tijks), "points returned")
+        self.window.addPointsToCurrentFragment(tijks)
+        mpt = self.mapFromGlobal(QCursor.pos())
+        mxy = (mpt.x(), mpt.y())
+        self.setNearbyTiffAndNode(mxy)
+        self.window.drawSlices()
+
     def autoExtrapolate(self, sign, ij):
         volume = self.volume_view
         if volume is None :
@@ -1176,9 +1332,10 @@ class DataWindow(QLabel):
             return
         if ij[1] < ij0[1] or ij[1] >= ij1[1]:
             return
-        st = ST((slc[int(ij0[1]-s0[1]):int(ij1[1]-s0[1]),int(ij0[0]-s0[0]):int(ij1[0]-s0[0])]).astype(np.float64)/65535.)
+        # st = ST((slc[int(ij0[1]-s0[1]):int(ij1[1]-s0[1]),int(ij0[0]-s0[0]):int(ij1[0]-s0[0])]).astype(np.float64)/65535.)
+        # st.computeEigens()
+        st = self.stInRect(ij0, ij1)
         # print ("st created", st.image.shape)
-        st.computeEigens()
         # print ("eigens computed")
         dij = (ij[0]-ij0[0], ij[1]-ij0[1])
         # min distance between computed auto-pick points
@@ -1209,16 +1366,15 @@ class DataWindow(QLabel):
         pts[:,0] += ij0[0]
         pts[:,1] += ij0[1]
         # print("xs",pts[:,0])
-        zsurf_update = self.window.live_zsurf_update
-        self.window.setLiveZsurfUpdate(False)
+        tijks = []
         for pt in pts:
             # print("   ", pt)
             if pt[0] < ijo0[0] or pt[0] >= ijo1[0] or pt[1] < ijo0[1] or pt[1] >= ijo1[1]:
                 break
             tijk = self.ijToTijk(pt)
             # print("adding point at",tijk)
-            self.window.addPointToCurrentFragment(tijk)
-        self.window.setLiveZsurfUpdate(zsurf_update)
+            tijks.append(tijk)
+        self.window.addPointsToCurrentFragment(tijks)
         mpt = self.mapFromGlobal(QCursor.pos())
         mxy = (mpt.x(), mpt.y())
         self.setNearbyTiffAndNode(mxy)
@@ -1548,6 +1704,8 @@ into and out of the viewing plane.
         xypts = []
         pv = self.window.project_view
         self.fv2zpoints = {}
+        old_slicexys = self.fv2slicexys
+        self.fv2slicexys = {}
         nearbyNode = (pv.nearby_node_fv, pv.nearby_node_index)
         splineLineSize = self.getDrawWidth("line")
         nodeSize = self.getDrawWidth("node")
@@ -1573,9 +1731,11 @@ into and out of the viewing plane.
             # if pts is not None:
             #     print(self.axis, len(pts))
             timera.time("get zsurf points")
+            lines, trglist = frag.getLinesOnSlice(self.axis, self.positionOnAxis())
+            pts, vrts, lxys = self.sliceXys(
+                    frag, pts, lines, (wi0, wj0, wi1, wj1), old_slicexys)
             if pts is not None and splineLineSize > 0:
                 # self.fv2zpoints[frag] = np.round(pts).astype(np.int32)
-                pts = pts[(pts[:,0] >= wi0) & (pts[:,1] >= wj0) & (pts[:,0] < wi1) & (pts[:,1] < wj1)]
                 self.fv2zpoints[frag] = pts
                 # print(pts)
                 color = frag.fragment.cvcolor
@@ -1589,16 +1749,11 @@ into and out of the viewing plane.
                 else:
                     # size = splineLineSize
                     pass
-                vrts = self.ijsToXys(pts)
-                # vrts = vrts[(vrts[:,0] >= 0) & (vrts[:,1] >= 0) & (vrts[:,0] < ww) & (vrts[:,1] < wh)]
-                # print(" ", len(vrts))
-                vrts = vrts.reshape(-1,1,1,2).astype(np.int32)
                 cv2.polylines(outrgbx, vrts, True, color, size)
                 if not apply_line_opacity:
                     cv2.polylines(original, vrts, True, color, size)
                 timera.time("draw zsurf points")
 
-            lines, trglist = frag.getLinesOnSlice(self.axis, self.positionOnAxis())
             if lines is not None and splineLineSize > 0:
                 trgls = frag.trgls()
                 wtrgls = frag.workingTrgls()
@@ -1606,8 +1761,8 @@ into and out of the viewing plane.
                 # working[wtrgls] = True
                 # working_bools = working[trglist]
                 working_bools = wtrgls[trglist]
-                working_lines = lines[working_bools]
-                non_working_lines = lines[~working_bools]
+                working_lines = lxys[working_bools]
+                non_working_lines = lxys[~working_bools]
                 # print(len(lines),"lines",len(working_lines),"working lines")
                 llen = len(lines)
                 wlen = len(working_lines)
@@ -1631,13 +1786,9 @@ into and out of the viewing plane.
                     # print("normal thin", len(normal_lines), len(thin_lines))
 
 
-                ijkpts = normal_lines.reshape(-1, 3)
-                ijpts = self.tijksToIjs(ijkpts)
-                xys = self.ijsToXys(ijpts)
                 # TODO: figure out how to put a dense-enough set
                 # of points in fv2zpoints, for the status bar
-                # self.fv2zpoints[frag] = ijpts
-                xys = xys.reshape(-1,1,2,2)
+                xys = normal_lines
                 color = frag.fragment.cvcolor
                 size = splineLineSize
                 cv2.polylines(outrgbx, xys, False, color, size)
@@ -1646,13 +1797,7 @@ into and out of the viewing plane.
 
                 size -= 1
                 if thin_lines is not None and size > 0:
-                    ijkpts = thin_lines.reshape(-1, 3)
-                    ijpts = self.tijksToIjs(ijkpts)
-                    xys = self.ijsToXys(ijpts)
-                    # TODO: figure out how to put a dense-enough set
-                    # of points in fv2zpoints, for the status bar
-                    # self.fv2zpoints[frag] = ijpts
-                    xys = xys.reshape(-1,1,2,2)
+                    xys = thin_lines
                     color = frag.fragment.cvcolor
                     size = splineLineSize-1
                     cv2.polylines(outrgbx, xys, False, color, size)
@@ -0,0 +1,181 @@
+import numpy as np
+
+# Undo/redo history of the edits made to a fragment's gpoints.
+# Rather than a full copy of gpoints per edit, each entry
+# records only what the edit changed:
+#   moved rows: their indexes, old values, and new values;
+#   deleted rows: their indexes and values;
+#   added rows: their values (added rows are always
+#   appended to the end of gpoints).
+# An edit that changes every row (for instance, moving the
+# whole fragment) is instead recorded as a single copy of
+# the other version of gpoints: the old version while the
+# entry can be undone, and the new version once it has
+# been undone.
+# When an edit does several of these, they are applied in
+# the order moves, deletes, adds (and undone in the reverse
+# order); move and delete indexes refer to gpoints before
+# the edit.
+# The oldest entries are discarded when the history's
+# memory use exceeds max_bytes, or its length exceeds
+# max_entries.
+# undo and redo return the new gpoints, together with a list
+# of the changes that were made, in the form (op, index, pt)
+# used by the edit journal; for whole-array entries, the list
+# is the single change ("replace", -1, gpoints).
+class EditHistory():
+
+    # class variables
+    # memory budget of each fragment's history, in bytes
+    max_bytes = 16*2**20
+    max_entries = 100
+
+    class Entry():
+        def __init__(self, npts):
+            # number of points before the edit
+            self.npts = npts
+            self.move_indexes = None
+            self.move_old = None
+            self.move_new = None
+            self.delete_indexes = None
+            self.delete_rows = None
+            self.added = None
+            self.replaced = None
+
+        def nbytes(self):
+            total = 64
+            for ar in (self.move_indexes, self.move_old, self.move_new, self.delete_indexes, self.delete_rows, self.added, self.replaced):
+                if ar is not None:
+                    total += ar.nbytes
+            return total
+
+        # number of points after the edit
+        def nptsAfter(self):
+            n = self.npts
+            if self.delete_indexes is not None:
+                n -= len(self.delete_indexes)
+            if self.added is not None:
+                n += len(self.added)
+            return n
+
+    def __init__(self):
+        self.undo_entries = []
+        self.redo_entries = []
+        self.nbytes = 0
+
+    def clear(self):
+        self.undo_entries = []
+        self.redo_entries = []
+        self.nbytes = 0
+
+    def canUndo(self):
+        return len(self.undo_entries) > 0
+
+    def canRedo(self):
+        return len(self.redo_entries) > 0
+
+    # Records an edit of gpoints (which must be called before
+    # the edit is made, since gpoints is the array as it was
+    # before the edit).
+    # moved is (indexes, new_rows), deleted is an array of
+    # indexes, added is an array of the rows appended to the
+    # end of gpoints; any of them can be None.
+    # If replaced is True, the edit replaces every row of
+    # gpoints (without changing their number), and the
+    # other arguments are ignored.
+    def record(self, gpoints, moved=None, deleted=None, added=None, replaced=False):
+        entry = EditHistory.Entry(len(gpoints))
+        if replaced:
+            entry.replaced = np.array(gpoints)
+            moved = deleted = added = None
+        if moved is not None and len(moved[0]) > 0:
+            indexes = np.array(moved[0], dtype=np.int64)
+            entry.move_indexes = indexes
+            entry.move_old = np.array(gpoints[indexes])
+            entry.move_new = np.array(moved[1]).reshape(-1,3)
+        if deleted is not None and len(deleted) > 0:
+            indexes = np.unique(np.array(deleted, dtype=np.int64))
+            entry.delete_indexes = indexes
+            entry.delete_rows = np.array(gpoints[indexes])
+        if added is not None and len(added) > 0:
+            entry.added = np.array(added).reshape(-1,3)
+        self.redo_entries = []
+        self.undo_entries.append(entry)
+        self.nbytes = sum(e.nbytes() for e in self.undo_entries)
+        while len(self.undo_entries) > 0 and (self.nbytes > EditHistory.max_bytes or len(self.undo_entries) > EditHistory.max_entries):
+            self.nbytes -= self.undo_entries.pop(0).nbytes()
+
+    # Returns (gpoints, changes); gpoints is None if there
+    # is nothing to undo.  If gpoints does not have the number
+    # of points that the most recent edit left it with, the
+    # fragment has been changed by something that was not
+    # recorded, and the history is cleared.
+    def undo(self, gpoints):
+        if len(self.undo_entries) == 0:
+            return None, []
+        entry = self.undo_entries[-1]
+        if len(gpoints) != entry.nptsAfter():
+            print("Edit history does not match the fragment; clearing it")
+            self.clear()
+            return None, []
+        self.undo_entries.pop()
+        self.nbytes -= entry.nbytes()
+        self.redo_entries.append(entry)
+
+        if entry.replaced is not None:
+            return EditHistory.swapReplaced(entry, gpoints)
+        changes = []
+        if entry.added is not None:
+            n = len(gpoints)-len(entry.added)
+            changes.extend(("delete", i, None) for i in range(len(gpoints)-1, n-1, -1))
+            gpoints = gpoints[:n]
+        if entry.delete_indexes is not None:
+            # np.insert takes indexes relative to the
+            # array before the insertion
+            idxs = entry.delete_indexes
+            gpoints = np.insert(gpoints, idxs-np.arange(len(idxs)), entry.delete_rows.astype(gpoints.dtype), axis=0)
+            changes.extend(("insert", i, pt) for i, pt in zip(idxs, gpoints[idxs]))
+        else:
+            gpoints = gpoints.copy()
+        if entry.move_indexes is not None:
+            gpoints[entry.move_indexes] = entry.move_old
+            changes.extend(("move", i, gpoints[i]) for i in entry.move_indexes)
+        return gpoints, changes
+
+    # Returns (gpoints, changes), as undo does
+    def redo(self, gpoints):
+        if len(self.redo_entries) == 0:
+            return None, []
+        entry = self.redo_entries[-1]
+        if len(gpoints) != entry.npts:
+            print("Edit history does not match the fragment; clearing it")
+            self.clear()
+            return None, []
+        self.redo_entries.pop()
+        self.undo_entries.append(entry)
+        self.nbytes += entry.nbytes()
+
+        if entry.replaced is not None:
+            return EditHistory.swapReplaced(entry, gpoints)
+        changes = []
+        gpoints = gpoints.copy()
+        if entry.move_indexes is not None:
+            gpoints[entry.move_indexes] = entry.move_new
+            changes.extend(("move", i, gpoints[i]) for i in entry.move_indexes)
+        if entry.delete_indexes is not None:
+            gpoints = np.delete(gpoints, entry.delete_indexes, axis=0)
+            changes.extend(("delete", i, None) for i in entry.delete_indexes[::-1])
+        if entry.added is not None:
+            n = len(gpoints)
+            gpoints = np.concatenate((gpoints, entry.added), axis=0)
+            changes.extend(("add", i, gpoints[i]) for i in range(n, len(gpoints)))
+        return gpoints, changes
+
+    # class function
+    # Undoes or redoes a whole-array entry: the entry's copy
+    # of gpoints becomes the current version, and the current
+    # version is kept in the entry.  Returns (gpoints, changes).
+    def swapReplaced(entry, gpoints):
+        new_gpoints = entry.replaced
+        entry.replaced = np.array(gpoints)
+        return new_gpoints, [("replace", -1, new_gpoints)]
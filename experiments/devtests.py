@@ -168,8 +168,8 @@ ppm.loadData()
 # pts = np.array(((3000.5, 3000.5),(-1.,-1.)))
 pts = np.array(((3000.5, 3000.5),(-3000.,-3000.)))
 # pts = np.array(((3000.5, 3000.5),))
-print (ppm.ijk_interpolator(pts))
-print (ppm.normal_interpolator(pts))
+print (ppm.ijksAt(pts))
+print (ppm.normalsAt(pts))
 
 exit()
 ''''''
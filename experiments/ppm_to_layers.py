@@ -206,21 +206,22 @@ else:
     print("im", im.shape)
 '''
 
-ppm.loadData()
+# float32 is enough for rendering, and uses half the memory
+ppm.loadData(np.float32)
 
 '''
 # pts = np.array(((3000.5, 3000.5),(-1.,-1.)))
 pts = np.array(((3000.5, 3000.5),(-3000.,-3000.)))
 # pts = np.array(((3000.5, 3000.5),))
-print (ppm.ijk_interpolator(pts))
-print (ppm.normal_interpolator(pts))
+print (ppm.ijksAt(pts))
+print (ppm.normalsAt(pts))
 '''
 print(ppm.data[2500,1500])
 print(ppm.data[2500,1501])
 print(ppm.data[2501,1500])
 print(ppm.ijks.shape)
-rr_ijks = ppm.ijks.astype(np.float32)
-rr_normals = ppm.normals.astype(np.float32)
+rr_ijks = ppm.ijks
+rr_normals = ppm.normals
 rr_h = rr_ijks.shape[0]
 rr_w = rr_ijks.shape[1]
 rr_uvs = np.mgrid[0:rr_h, 0:rr_w]
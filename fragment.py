@@ -1,11 +1,12 @@
+import os
 import json
 import time
 import math
-# from queue import LifoQueue
-from collections import deque
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 import numpy as np
-import cv2
+import tifffile
 import rectpack
 from scipy.spatial import Delaunay
 from scipy.spatial.qhull import QhullError
@@ -17,237 +18,10 @@ from scipy.interpolate import (
         )
 from scipy.interpolate import CubicSpline
 from utils import Utils
+from mesh_writer import MeshWriter
 from volume import Volume
 from base_fragment import BaseFragment, BaseFragmentView
-from PyQt5 import QtCore, QtGui
-from PyQt5.QtCore import Qt
-from PyQt5.QtGui import QColor
-
-class FragmentsModel(QtCore.QAbstractTableModel):
-    def __init__(self, project_view, main_window):
-        super(FragmentsModel, self).__init__()
-        # note that self.project_view should not be
-        # changed after initialization; instead, a new
-        # instance of VolumesModel should be created
-        # and attached to the QTableView
-        self.project_view = project_view
-        self.main_window = main_window
-
-    columns = [
-            "Active",
-            "Visible",
-            "Hide\nMesh",
-            "Name",
-            "Color",
-            "Dir",
-            "Pts",
-            "cm^2"
-            ]
-
-    ctips = [
-            "Select which fragment is active;\nclick box to select.\nNote that you can only select fragments\nwhich have the same direction (orientation)\nas the current volume view",
-            "Select which fragments are visible;\nclick box to select",
-            "Select which fragments have their mesh hidden;\nclick box to select",
-            "Name of the fragment; click to edit",
-            "Color of the fragment; click to edit",
-            "Direction (orientation) of the fragment",
-            "Number of points currently in fragment",
-            "Fragment area in square centimeters"
-            ]
-    
-    def flags(self, index):
-        col = index.column()
-        oflags = super(FragmentsModel, self).flags(index)
-        if col == 0:
-            nflags = Qt.ItemNeverHasChildren
-            nflags |= Qt.ItemIsUserCheckable
-            nflags |= Qt.ItemIsEnabled
-            return nflags
-        elif col == 1:
-            # print(col, int(oflags))
-            nflags = Qt.ItemNeverHasChildren
-            nflags |= Qt.ItemIsUserCheckable
-            nflags |= Qt.ItemIsEnabled
-            # nflags |= Qt.ItemIsEditable
-            return nflags
-        elif col == 2:
-            # print(col, int(oflags))
-            nflags = Qt.ItemNeverHasChildren
-            nflags |= Qt.ItemIsUserCheckable
-            nflags |= Qt.ItemIsEnabled
-            # nflags |= Qt.ItemIsEditable
-            return nflags
-        elif col== 3:
-            nflags = Qt.ItemNeverHasChildren
-            nflags |= Qt.ItemIsEnabled
-            nflags |= Qt.ItemIsEditable
-            return nflags
-        else:
-            return Qt.ItemNeverHasChildren|Qt.ItemIsEnabled
-
-    def headerData(self, section, orientation, role):
-        if orientation != Qt.Horizontal:
-            return
-        
-        if role == Qt.DisplayRole:
-            if section == 0:
-                # print("HD", self.rowCount())
-                table = self.main_window.fragments_table
-                # make sure the color button in column 3 is always open
-                # (so no double-clicking required)
-                for i in range(self.rowCount()):
-                    index = self.createIndex(i, 4)
-                    table.openPersistentEditor(index)
-
-            return FragmentsModel.columns[section]
-        elif role == Qt.ToolTipRole:
-            return FragmentsModel.ctips[section]
-
-    def columnCount(self, parent=None):
-        return len(FragmentsModel.columns)
-
-    def rowCount(self, parent=None):
-        if self.project_view is None:
-            return 0
-        fragments = self.project_view.fragments
-        # print("row count", len(fragments.keys()))
-        return len(fragments.keys())
-
-    # columns: name, color, direction, xmin, xmax, xstep, y..., img...
-
-    def data(self, index, role):
-        if self.project_view is None:
-            return None
-        if role == Qt.DisplayRole:
-            return self.dataDisplayRole(index, role)
-        elif role == Qt.TextAlignmentRole:
-            return self.dataAlignmentRole(index, role)
-        elif role == Qt.BackgroundRole:
-            return self.dataBackgroundRole(index, role)
-        elif role == Qt.CheckStateRole:
-            return self.dataCheckStateRole(index, role)
-        return None
-
-    def dataCheckStateRole(self, index, role):
-        column = index.column()
-        row = index.row()
-        fragments = self.project_view.fragments
-        fragment = list(fragments.keys())[row]
-        fragment_view = fragments[fragment]
-        if column == 0:
-            if fragment_view.active:
-                return Qt.Checked
-            else:
-                return Qt.Unchecked
-        if column == 1:
-            if fragment_view.visible:
-                return Qt.Checked
-            else:
-                return Qt.Unchecked
-        if column == 2:
-            # Note that column is "Hide Mesh", but
-            # internal variable is mesh_visible
-            if fragment_view.mesh_visible:
-                return Qt.Unchecked
-            else:
-                return Qt.Checked
-
-    def dataAlignmentRole(self, index, role):
-        return Qt.AlignVCenter + Qt.AlignRight
-
-    def dataBackgroundRole(self, index, role):
-        row = index.row()
-        fragments = self.project_view.fragments
-        fragment = list(fragments.keys())[row]
-        fragment_view = fragments[fragment]
-        if self.project_view.mainActiveVisibleFragmentView() == fragment_view:
-            # return QtGui.QColor('beige')
-            return QtGui.QColor(self.main_window.highlightedBackgroundColor())
-
-    def dataDisplayRole(self, index, role):
-        row = index.row()
-        column = index.column()
-        fragments = self.project_view.fragments
-        fragment = list(fragments.keys())[row]
-        fragment_view = fragments[fragment]
-        if column == 3:
-            return fragment.name
-        elif column == 4:
-            # print("ddr", row, volume_view.color.name())
-            return fragment.color.name()
-        elif column == 5:
-            # print("data display role", row, volume_view.direction)
-            return ('X','Y')[fragment.direction]
-        elif column == 6:
-            return len(fragment.gpoints)
-        elif column == 7:
-            return "%.4f"%fragment_view.sqcm
-        else:
-            return None
-
-    def setData(self, index, value, role):
-        row = index.row()
-        column = index.column()
-        # print("setdata", row, column, value, role)
-        if role == Qt.CheckStateRole and column == 0:
-            # print("check", row, value)
-            fragments = self.project_view.fragments
-            fragment = list(fragments.keys())[row]
-            fragment_view = fragments[fragment]
-            exclusive = True
-            # print(self.main_window.app.keyboardModifiers())
-            if ((self.main_window.app.keyboardModifiers() & Qt.ControlModifier) 
-               or 
-               len(self.main_window.project_view.activeFragmentViews(unaligned_ok=True)) > 1):
-                exclusive = False
-            self.main_window.setFragmentActive(fragment, value==Qt.Checked, exclusive)
-            return True
-        elif role == Qt.CheckStateRole and column == 1:
-            # print(row, value)
-            fragments = self.project_view.fragments
-            fragment = list(fragments.keys())[row]
-            fragment_view = fragments[fragment]
-            self.main_window.setFragmentVisibility(fragment, value==Qt.Checked)
-            return True
-        elif role == Qt.CheckStateRole and column == 2:
-            # print(row, value)
-            fragments = self.project_view.fragments
-            fragment = list(fragments.keys())[row]
-            fragment_view = fragments[fragment]
-            # Note that column reads "Hide Mesh", but internal variable
-            # is mesh_visible
-            self.main_window.setFragmentMeshVisibility(fragment, value==Qt.Unchecked)
-            return True
-        elif role == Qt.EditRole and column == 3:
-            # print("setdata", row, value)
-            name = value
-            # print("sd name", value)
-            fragments = self.project_view.fragments
-            fragment = list(fragments.keys())[row]
-            # print("%s to %s"%(fragment.name, name))
-            if name != "":
-                self.main_window.renameFragment(fragment, name)
-
-        elif role == Qt.EditRole and column == 4:
-            # print("sd color", value)
-            fragments = self.project_view.fragments
-            fragment = list(fragments.keys())[row]
-            # print("setdata", row, color.name())
-            self.main_window.setFragmentColor(fragment, value)
-
-        return False
-
-    def scrollToRow(self, row):
-        index = self.createIndex(row, 0)
-        table = self.main_window.fragments_table
-        table.scrollTo(index)
-
-    def scrollToEnd(self):
-        row = self.rowCount()-1
-        if row < 0:
-            return
-        self.scrollToRow(row)
-
+from color import Color
 
 # note that FragmentView is defined after Fragment
 class Fragment(BaseFragment):
@@ -255,16 +29,25 @@ class Fragment(BaseFragment):
     # class variable
     min_roundness = .1
 
+    # class variable
+    # width and height of the tiles in exported texture images
+    texture_tile_size = 256
+
+    # class variable
+    # maximum width and height of an exported texture image;
+    # fragment textures that do not fit in one image are
+    # spread over several
+    texture_page_size = 16384
+
     def __init__(self, name, direction):
         super(Fragment, self).__init__(name)
         self.direction = direction
         self.params = {}
         # fragment points in global coordinates
         self.gpoints = np.zeros((0,3), dtype=np.float32)
-
-        # History of gpoints, for undo functionality
-        # self.gpoints_history : LifoQueue = LifoQueue(100)
-        self.gpoints_history = deque(maxlen=50)
+        # (key, infill points) of the most recent call
+        # to createInfillPoints
+        self.infill_cache = None
 
     def createView(self, project_view):
         return FragmentView(project_view, self)
@@ -276,7 +59,7 @@ class Fragment(BaseFragment):
         frag.valid = True
         return frag
 
-    def toDict(self):
+    def toDict(self, with_gpoints=True):
         info = {}
         info['name'] = self.name
         info['created'] = self.created
@@ -284,11 +67,37 @@ class Fragment(BaseFragment):
         info['direction'] = self.direction
         info['color'] = self.color.name()
         info['params'] = self.params
+        if not with_gpoints:
+            return info
         info['gpoints'] = self.gpoints.tolist()
         if self.params.get('echo', '') != '':
             info['gpoints'] = []
         return info
 
+    # returns the info and arrays to be stored in
+    # a binary fragment file
+    def binaryInfoAndArrays(self):
+        info = self.toDict(with_gpoints=False)
+        gpoints = self.gpoints
+        if self.params.get('echo', '') != '':
+            gpoints = np.zeros((0,3), dtype=np.float32)
+        arrays = {'gpoints': gpoints.astype(np.float32, copy=False)}
+        return info, arrays
+
+    # class function
+    # creates a fragment from the contents of
+    # a binary fragment file
+    def fromBinary(info, arrays):
+        info = dict(info)
+        info['gpoints'] = []
+        frag = Fragment.fragFromDict(info)
+        if not frag.valid:
+            return None
+        gpoints = arrays.get('gpoints', None)
+        if gpoints is not None and len(gpoints) > 0:
+            frag.gpoints = gpoints
+        return frag
+
 
     def save(self, path):
         info = self.toDict()
@@ -325,7 +134,7 @@ class Fragment(BaseFragment):
                 return Fragment.createErrorFragment(err)
 
         if 'color' in info:
-            color = QColor(info['color'])
+            color = Color(info['color'])
         else:
             color = Utils.getNextColor()
         name = info['name']
@@ -462,7 +271,7 @@ class Fragment(BaseFragment):
     # consisting of bad trgls that are (recursively) on the border
     def badBorderTrgls(self, tri, bads):
         # print("bads", bads)
-        badbool = np.zeros((len(tri.simplices),), dtype=np.bool8)
+        badbool = np.zeros((len(tri.simplices),), dtype=np.bool_)
         badbool[bads] = True
         borderlist = np.array((-1,), dtype=np.int32)
         lbl = len(borderlist)
@@ -481,178 +290,251 @@ class Fragment(BaseFragment):
     # global coordinate system to infill the grid at the given
     # spacing.  Infill points will be omitted wherever there
     # is an existing grid point nearby.  Returns the new gpoints.
-    def createInfillPoints(self, infill):
-        direction = self.direction
-        gijks = self.gpoints
-        # ngijks = np.zeros((0,3), dtype=np.int32)
+    # fv, if not None, is a FragmentView of a fragment that
+    # has the same gpoints as this one; if its triangulation
+    # and interpolator are current (see FragmentView.infillSurface),
+    # they are used, rather than triangulating the gpoints again.
+    # The result is cached, so calling this again, with the
+    # same gpoints and infill, costs almost nothing.
+    def createInfillPoints(self, infill, fv=None):
         ngijks = np.zeros((0,3), dtype=np.float32)
-        if infill <= 0:
-            return ngijks
-        tgijks = Volume.globalIjksToTransposedGlobalIjks(gijks, direction)
-
-        print("tgijks", tgijks.shape, tgijks.dtype)
-        if tgijks.shape == 0:
-            return ngijks
-        mini = np.amin(tgijks[:,0])
-        maxi = np.amax(tgijks[:,0])
-        minj = np.amin(tgijks[:,1])
-        maxj = np.amax(tgijks[:,1])
-        print("minmax", mini, maxi, minj, maxj)
-        minid = mini/infill
-        maxid = maxi/infill
-        minjd = minj/infill
-        maxjd = maxj/infill
-        
-        id0 = math.floor(minid)
-        idm = math.floor(maxid)
-        if idm != maxid:
-            idm += 1
-        idn = idm-id0+1
-
-        jd0 = math.floor(minjd)
-        jdm = math.floor(maxjd)
-        if jdm != maxjd:
-            jdm += 1
-        jdn = jdm-jd0+1
-        print("id,jd", id0, idn, jd0, jdn)
-
-        # create an array to hold the coordinates of the infill points
-        sid = np.indices((jdn, idn))
-        print("sid", idn, jdn, sid.shape, sid.dtype)
-        # add a flag layer to indicate whether an existing gpoint
-        # is close to one of the proposed infill points
-        si = np.append(sid, np.zeros((1, jdn, idn), dtype=sid.dtype), axis=0)
-        # set the coordinates (in the transposed global frame) of
-        # the infill points
-        # notice si[0] corresponds to j and si[0] to i
-        si[1] = np.rint((si[1]+id0)*infill+infill/2).astype(si.dtype)
-        si[0] = np.rint((si[0]+jd0)*infill+infill/2).astype(si.dtype)
-        # calculate the position, in the si array, of the
-        # existing transposed gpoints
-        itgijks0 = np.int32(np.floor(tgijks[:,0]/infill - id0))
-        itgijks1 = np.int32(np.floor(tgijks[:,1]/infill - jd0))
-        # set the flag wherever there is an existing point
-        si[2,itgijks1,itgijks0] = 1
-
-        # print("si corners", si[:,0,0], si[:,-1,-1])
-        # sum should equal the number of gpoints (but may be
-        # smaller if more than one gpoint near a single infill point)
-        # print("sum", np.sum(si[2]))
-        # sib is a boolean of all the infill points that are not near an
-        # existing gpoint
-        sib = si[2,:,:] == 0
-        # print("si sib",si.shape, sib.shape)
-
-        # filter si by sib
-        si = si[:2, sib]
-        # print("si",si.shape)
-        # don't need the infill point in an array any more; flatten them
-        # notice si[0] corresponds to j and si[0] to i
-        newtis = si[1].flatten()
-        newtjs = si[0].flatten()
-
-        newtijs = np.array((newtis, newtjs)).transpose()
-        # print("newtijs", newtijs.shape)
-
-        try:
-            # triangulate the original gpoints
-            tri = Delaunay(tgijks[:,0:2])
-        except Exception as err:
-            err = str(err).splitlines()[0]
-            print("createInfillPoints triangulation error: %s"%err)
+        if infill <= 0 or len(self.gpoints) == 0:
             return ngijks
-
-        # bads = self.badBorderTrgls(tri, self.badTrglsByNormal(tri, tgijks))
-        bads = self.badBorderTrgls(tri, self.badTrglsBySkinniness(tri, self.minRoundness()))
-        badlist = bads.tolist()
-
-        interp = CloughTocher2DInterpolator(tri, tgijks[:,2])
-        newtks = interp(newtijs)
-        simpids = tri.find_simplex(newtijs)
-        newtks = np.reshape(newtks, (newtks.shape[0],1))
-        # print("newtks", newtks.shape)
-        # the list of infill points, in transposed global
-        # ijk coordinates
-        newtijks = np.append(newtijs, newtks, axis=1)
-        print("newtijks with nans", newtijks.shape)
-        # eliminate infill points in "bad" simplices
-        newtijks = newtijks[~np.isin(simpids, badlist)]
-        print("newtijks no bad trgls", newtijks.shape)
+        cached = self.cachedInfillPoints(infill)
+        if cached is not None:
+            return cached
+        direction = self.direction
+        tgijks = Volume.globalIjksToTransposedGlobalIjks(self.gpoints, direction)
+
+        # the infill grid, in transposed global ij coordinates
+        id0 = math.floor(np.amin(tgijks[:,0])/infill)
+        idn = math.ceil(np.amax(tgijks[:,0])/infill)-id0+1
+        jd0 = math.floor(np.amin(tgijks[:,1])/infill)
+        jdn = math.ceil(np.amax(tgijks[:,1])/infill)-jd0+1
+        print("infill grid", idn, jdn)
+        # grid cells that contain an existing gpoint
+        occupied = np.zeros((jdn, idn), dtype=np.bool_)
+        occupied[np.int32(np.floor(tgijks[:,1]/infill - jd0)),
+                 np.int32(np.floor(tgijks[:,0]/infill - id0))] = True
+        jds, ids = (~occupied).nonzero()
+        newtijs = np.stack((
+            np.rint((ids+id0)*infill+infill/2).astype(np.int64),
+            np.rint((jds+jd0)*infill+infill/2).astype(np.int64)), axis=1)
+
+        surface = None
+        if fv is not None:
+            surface = fv.infillSurface(direction)
+        if surface is None:
+            try:
+                # triangulate the original gpoints
+                tri = Delaunay(tgijks[:,0:2])
+            except Exception as err:
+                err = str(err).splitlines()[0]
+                print("createInfillPoints triangulation error: %s"%err)
+                return ngijks
+            interp = None
+            # positions of the infill points in tri's coordinates
+            qijs = newtijs
+        else:
+            tri, interp, volume = surface
+            tgs = np.zeros((len(newtijs), 3), dtype=np.float64)
+            tgs[:,0:2] = newtijs
+            gs = Volume.transposedGlobalIjksToGlobalIjks(tgs, direction)
+            qijs = volume.globalPositionsToTransposedIjks(gs, direction)[:,0:2]
+
+        # eliminate infill points that are outside of the
+        # triangulation, or in "bad" simplices
+        good = np.ones(len(tri.simplices), dtype=np.bool_)
+        good[self.badBorderTrgls(tri, self.badTrglsBySkinniness(tri, self.minRoundness()))] = False
+        simpids = tri.find_simplex(qijs)
+        keep = simpids >= 0
+        keep[keep] = good[simpids[keep]]
+        newtijs = newtijs[keep]
+        qijs = qijs[keep]
+
+        if surface is None:
+            interp = CloughTocher2DInterpolator(tri, tgijks[:,2])
+            newtks = interp(qijs)
+        else:
+            lijks = np.zeros((len(qijs), 3), dtype=np.float64)
+            lijks[:,0:2] = qijs
+            lijks[:,2] = interp(qijs)
+            gs = volume.transposedIjksToGlobalPositions(lijks, direction)
+            newtks = Volume.globalIjksToTransposedGlobalIjks(gs, direction)[:,2]
+        # the infill points, in transposed global ijk coordinates
+        newtijks = np.concatenate((newtijs, np.reshape(newtks, (-1,1))), axis=1)
         # eliminate infill points where k is nan
         newtijks = newtijks[~np.isnan(newtijks[:,2])]
-        print("newtijks no nans", newtijks.shape)
+        print("infill points", len(newtijks))
         ngijks = Volume.transposedGlobalIjksToGlobalIjks(newtijks, direction)
+        self.infill_cache = (self.infillCacheKey(infill), ngijks)
+        return ngijks
 
-        # TODO: shouldn't be hardwired here!
-        voxelSizeUm = self.project.voxel_size_um
-        meshCount = len(newtijks)
-        area_sq_mm_flat = meshCount*voxelSizeUm*voxelSizeUm*infill*infill/1000000
-        simps = tri.simplices
-        pts = tgijks
-        simps = simps[~(np.isin(simps, bads).any(1))]
-        v0 = pts[simps[:,0]].astype(np.float64)
-        v1 = pts[simps[:,1]].astype(np.float64)
-        v2 = pts[simps[:,2]].astype(np.float64)
-        v01 = v1-v0
-        v02 = v2-v0
-        norm = np.cross(v01, v02)
-        # print(norm.shape)
-        # print((norm*norm).shape)
-        normsq = np.sum(norm*norm, axis=1)
-        # print(norm.shape, normsq.shape)
-        # normsq = normsq[~np.isnan(normsq)]
-        # print(normsq[normsq < 0])
-        # print(normsq.shape)
-        area_sq_mm_trg = np.sum(np.sqrt(normsq))*voxelSizeUm*voxelSizeUm/(2*1000000)
-        print("areas", area_sq_mm_flat, area_sq_mm_trg)
-
+    def infillCacheKey(self, infill):
+        gpoints = self.gpoints
+        return (infill, self.direction, self.minRoundness(), gpoints.shape, gpoints.dtype.str, hash(gpoints.tobytes()))
 
+    # Returns the result of the most recent call to
+    # createInfillPoints, if it was made with the same
+    # infill and gpoints; otherwise returns None
+    def cachedInfillPoints(self, infill):
+        if self.infill_cache is None:
+            return None
+        key, ngijks = self.infill_cache
+        if key != self.infillCacheKey(infill):
+            return None
         return ngijks
 
     class ExportFrag:
-        def __init__(self, fv, infill):
+
+        # class variable
+        # maximum number of worker processes used by createList
+        # (None means the number of cpus)
+        max_workers = None
+
+        # mesh, if not None, is the result of computeMesh
+        # (which may have been run in another process)
+        def __init__(self, fv, infill, mesh=None):
             frag = fv.fragment
             gpoints = frag.gpoints
             fname = frag.name
             self.err = ""
             self.fv = fv
             self.frag = frag
-            self.trgs = []
+            self.trgs = np.zeros((0,3), dtype=np.int32)
             self.has_ssurf = False
+            # if not None, the texture is sampled from this
+            # (full-resolution) volume rather than taken from ssurf
+            self.tex_volume = None
+            # number of texture pixels per pixel of the current
+            # volume, along the transposed i and j axes
+            self.tex_scale = (1,1)
             if not fv.mesh_visible:
                 self.vrts = gpoints
                 return
+            if mesh is None:
+                mesh = Fragment.ExportFrag.computeMesh(fname, gpoints, frag.direction, infill, frag.minRoundness(), frag.createInfillPoints(infill, fv))
+            self.err, self.vrts, trgs = mesh
+            if self.err != "":
+                return
+            self.trgs = trgs
+
+            fv.createZsurf()
+            if fv.zsurf is not None and fv.ssurf is not None:
+                self.has_ssurf = True
+                self.data_rect = Fragment.ExportFrag.dataBounds(fv.zsurf)
+                self.shape = fv.zsurf.shape
+                # (w,h) of the texture, in pixels
+                self.tex_size = self.data_rect[2:]
+
+        # class function
+        # Adds infill points to gpoints, triangulates the result,
+        # and removes bad triangles from the border.
+        # infill_points, if not None, are the infill points
+        # (already computed by createInfillPoints).
+        # Depends only on its arguments, so that it can be run
+        # in a worker process.
+        # Returns (err, vrts, trgs)
+        def computeMesh(fname, gpoints, direction, infill, min_roundness, infill_points=None):
+            # min_roundness is a user setting; a worker process
+            # would otherwise see only the default value
+            Fragment.min_roundness = min_roundness
+            frag = Fragment(fname, direction)
+            frag.gpoints = gpoints
+            trgs = np.zeros((0,3), dtype=np.int32)
             print(fname,"gpoints before", len(gpoints))
-            newgps = frag.createInfillPoints(infill)
+            newgps = infill_points
+            if newgps is None:
+                newgps = frag.createInfillPoints(infill)
             gpoints = np.append(gpoints, newgps, axis=0)
             print(fname,"gpoints after", len(gpoints))
-            self.vrts = gpoints
-            tgps = Volume.globalIjksToTransposedGlobalIjks(gpoints, frag.direction)
+            tgps = Volume.globalIjksToTransposedGlobalIjks(gpoints, direction)
             try:
                 # triangulate the new gpoints
                 tri = Delaunay(tgps[:,0:2])
             # except QhullError as err:
             except Exception as err:
-                self.err = "%s triangulation error: %s"%(fname,err)
-                self.err = self.err.splitlines()[0]
-                print(self.err)
-                return
+                err = "%s triangulation error: %s"%(fname,err)
+                err = err.splitlines()[0]
+                print(err)
+                return err, gpoints, trgs
 
             # bads = frag.badBorderTrgls(tri, frag.badTrglsByNormal(tri, tgps))
-            bads = frag.badBorderTrgls(tri, frag.badTrglsBySkinniness(tri, frag.minRoundness()))
-            badlist = bads.tolist()
-            for i,trg in enumerate(tri.simplices):
-                if i in badlist:
-                    continue
-                self.trgs.append(trg)
-            print("all",len(tri.simplices),"good",len(self.trgs))
-
-            fv.createZsurf()
-            if fv.zsurf is not None and fv.ssurf is not None:
-                self.has_ssurf = True
-                self.data_rect = Fragment.ExportFrag.dataBounds(fv.zsurf)
-                self.shape = fv.zsurf.shape
+            bads = frag.badBorderTrgls(tri, frag.badTrglsBySkinniness(tri, min_roundness))
+            good = np.ones(len(tri.simplices), dtype=np.bool_)
+            good[bads] = False
+            trgs = tri.simplices[good]
+            print("all",len(tri.simplices),"good",len(trgs))
+            return "", gpoints, trgs
 
+        # class function
+        # Creates an ExportFrag for each of the FragmentViews.
+        # The meshes are computed in parallel, one fragment per
+        # worker process; the rest of the work (which needs the
+        # volume data) is done in this process.
+        # progress, if not None, is called as progress(done, total),
+        # and should return False if the user has cancelled
+        # the operation.
+        # Returns (err, efs); err is "" if no error (or
+        # "Export cancelled"), in which case efs is None.
+        # The list of ExportFrags is in the same order as fvs.
+        def createList(fvs, infill, progress=None):
+            jobs = {}
+            for i, fv in enumerate(fvs):
+                if fv.mesh_visible:
+                    frag = fv.fragment
+                    # infill points are computed here only if
+                    # that is cheap (see createInfillPoints)
+                    infill_points = frag.cachedInfillPoints(infill)
+                    if infill_points is None and fv.infillSurface(frag.direction) is not None:
+                        infill_points = frag.createInfillPoints(infill, fv)
+                    jobs[i] = (frag.name, np.asarray(frag.gpoints), frag.direction, infill, frag.minRoundness(), infill_points)
+            # one step per mesh, and one per ExportFrag
+            total = len(jobs)+len(fvs)
+            meshes = {}
+            max_workers = Fragment.ExportFrag.max_workers
+            if max_workers is None:
+                max_workers = os.cpu_count() or 1
+            max_workers = min(max_workers, len(jobs))
+            if max_workers > 1:
+                # "spawn" rather than "fork", because this
+                # process is running Qt
+                ctx = multiprocessing.get_context("spawn")
+                executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=ctx)
+                futures = {executor.submit(Fragment.ExportFrag.computeMesh, *job): i for i, job in jobs.items()}
+                pending = set(futures.keys())
+                cancelled = False
+                try:
+                    while len(pending) > 0 and not cancelled:
+                        # time out periodically, so that the
+                        # caller can respond to the user
+                        done, pending = wait(pending, timeout=.1, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            meshes[futures[future]] = future.result()
+                        if progress is not None and not progress(len(meshes), total):
+                            cancelled = True
+                except Exception as e:
+                    # for instance, a worker process that was
+                    # killed for lack of memory
+                    err = "Mesh computation failed: %s"%e
+                    print(err)
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    return err, None
+                executor.shutdown(wait=not cancelled, cancel_futures=True)
+                if cancelled:
+                    return "Export cancelled", None
+            else:
+                for i, job in jobs.items():
+                    meshes[i] = Fragment.ExportFrag.computeMesh(*job)
+                    if progress is not None and not progress(len(meshes), total):
+                        return "Export cancelled", None
+
+            efs = []
+            for i, fv in enumerate(fvs):
+                efs.append(Fragment.ExportFrag(fv, infill, meshes.get(i, None)))
+                if progress is not None and not progress(len(jobs)+i+1, total):
+                    return "Export cancelled", None
+            return "", efs
 
         # class function
         # returns (x,y,w,h) of bounding box that contains
@@ -688,82 +570,221 @@ class Fragment(BaseFragment):
             # print(frag.name, b0min, b0max, b1min, b1max)
             return x,y,w,h
 
-        def addTexture(self, arr):
+        # Sets tex_volume (a CachedZarrVolume), which is sampled
+        # at full resolution (one texture pixel per global-coordinate
+        # unit), so if the current volume is a subsampled one,
+        # the texture is larger than data_rect.
+        def setTextureVolume(self, tex_volume):
+            if not self.has_ssurf or tex_volume is None:
+                return
+            vol = self.fv.cur_volume_view.volume
+            tijks = np.array([[0,0,0],[1,0,0],[0,1,0]], dtype=np.float64)
+            gps = vol.transposedIjksToGlobalPositions(tijks, self.frag.direction)
+            steps = np.linalg.norm(gps[1:]-gps[0], axis=1)
+            fi, fj = np.maximum(np.rint(steps), 1).astype(np.int64)
+            w, h = self.data_rect[2:]
+            self.tex_volume = tex_volume
+            self.tex_scale = (int(fi), int(fj))
+            self.tex_size = (int((w-1)*fi+1), int((h-1)*fj+1))
+
+        # class function
+        # Bilinear interpolation of zsurf at the points (xs, ys).
+        # Where one of the neighbors is NaN (at the border of
+        # the surface), the nearest value is used instead.
+        def interpolateZsurf(zsurf, xs, ys):
+            ny, nx = zsurf.shape
+            x0 = np.clip(np.floor(xs).astype(np.int64), 0, max(nx-2, 0))
+            y0 = np.clip(np.floor(ys).astype(np.int64), 0, max(ny-2, 0))
+            x1 = np.minimum(x0+1, nx-1)
+            y1 = np.minimum(y0+1, ny-1)
+            fx = xs-x0
+            fy = ys-y0
+            zs = ((1.-fy)*((1.-fx)*zsurf[y0,x0] + fx*zsurf[y0,x1]) +
+                    fy*((1.-fx)*zsurf[y1,x0] + fx*zsurf[y1,x1]))
+            bad = np.isnan(zs)
+            zs[bad] = zsurf[np.rint(ys[bad]).astype(np.int64), np.rint(xs[bad]).astype(np.int64)]
+            return zs
+
+        # Copies the part of this fragment's texture that overlaps
+        # tile (whose upper-left corner is at (tx0, ty0) in the
+        # texture image) into tile
+        def addTextureToTile(self, tile, tx0, ty0):
             if not self.has_ssurf:
                 return
             xt,yt = self.tex_orig
-            x0,y0 = self.data_rect[:2]
-            w,h = self.data_rect[2:]
-            x1 = x0+w
-            y1 = y0+h
-            arr[yt:yt+h,xt:xt+w] = self.fv.ssurf[y0:y1,x0:x1]
+            w,h = self.tex_size
+            x0 = max(xt, tx0)
+            x1 = min(xt+w, tx0+tile.shape[1])
+            y0 = max(yt, ty0)
+            y1 = min(yt+h, ty0+tile.shape[0])
+            if x0 >= x1 or y0 >= y1:
+                return
+            dx,dy = self.data_rect[:2]
+            if self.tex_volume is None:
+                tile[y0-ty0:y1-ty0, x0-tx0:x1-tx0] = self.fv.ssurf[dy+y0-yt:dy+y1-yt, dx+x0-xt:dx+x1-xt]
+                return
+            fi,fj = self.tex_scale
+            us, vs = np.meshgrid(np.arange(x0-xt, x1-xt), np.arange(y0-yt, y1-yt))
+            # position in the current volume's transposed ijk coordinates
+            xs = dx+us/fi
+            ys = dy+vs/fj
+            zs = Fragment.ExportFrag.interpolateZsurf(self.fv.zsurf, xs, ys)
+            valid = ~np.isnan(zs)
+            tijks = np.stack((xs[valid], ys[valid], zs[valid]), axis=1)
+            gps = self.fv.cur_volume_view.volume.transposedIjksToGlobalPositions(tijks, self.frag.direction)
+            values = self.tex_volume.sampleGlobalPositions(gps)
+            sub = np.zeros(xs.shape, dtype=np.uint16)
+            sub[valid] = np.minimum(np.rint(values), 65535)
+            tile[y0-ty0:y1-ty0, x0-tx0:x1-tx0] = sub
 
         # class function
+        # Packs the textures of the ExportFrags into one or more
+        # texture pages (atlases).  A page is normally no larger than
+        # texture_page_size in either direction, but it is enlarged
+        # if a single texture would not otherwise fit.
+        # Sets tex_page and tex_orig of each ExportFrag that has
+        # a texture.  Returns a list of the (w,h) sizes of the pages,
+        # or None if an error occurs.
         def pack(efs):
             packer = rectpack.newPacker(
                     rotation=False, pack_algo=rectpack.MaxRectsBlsf)
             pad = 1
             incount = 0
-            for ef in efs:
+            pw = Fragment.texture_page_size
+            ph = Fragment.texture_page_size
+            for i, ef in enumerate(efs):
                 if not ef.has_ssurf:
                     continue
-                dr = ef.data_rect
-                packer.add_rect(dr[2]+2*pad, dr[3]+2*pad)
+                w, h = ef.tex_size
+                w, h = int(w)+2*pad, int(h)+2*pad
+                packer.add_rect(w, h, rid=i)
+                pw = max(pw, w)
+                ph = max(ph, h)
                 incount += 1
-            ibin = (20000, 20000)
-            packer.add_bin(*ibin)
+            if incount == 0:
+                return []
+            packer.add_bin(pw, ph, count=float("inf"))
             packer.pack()
-            if len(packer.rect_list()) == 0:
-                obin = []
-            else:
-                obin = packer[0]
-            '''
-            if incount != len(obin):
-                err = "Have %d valid efs but only %d rects in obin"%(incount,len(obin))
+            rects = packer.rect_list()
+            if incount != len(rects):
+                err = "Have %d textures but only %d were packed"%(incount,len(rects))
                 print(err)
-                return
-            '''
+                return None
 
-            maxx = 0
-            maxy = 0
-            used = set()
-            for rect in obin:
-                (x, y, w, h) = rect.x, rect.y, rect.width, rect.height
-                found = False
-                for ef in efs:
-                    if not ef.has_ssurf:
-                        continue
-                    if ef in used:
-                        continue
-                    dr = ef.data_rect
-                    if w != dr[2]+2*pad or h != dr[3]+2*pad:
-                        continue
-                    ef.tex_orig = (x+pad,y+pad)
-                    used.add(ef)
-                    found = True
-                if not found:
-                    self.err = "Could not find rect %d %d %d %d in efs"%(x,y,w,d)
-                    print(err)
-                    return
-                mx = x+w
-                maxx = max(maxx, mx)
-                my = y+h
-                maxy = max(maxy, my)
-            return (maxx, maxy)
-            
-            
+            sizes = [(0,0)]*len(packer)
+            for ipage, x, y, w, h, i in rects:
+                ef = efs[i]
+                ef.tex_page = ipage
+                ef.tex_orig = (x+pad,y+pad)
+                mw, mh = sizes[ipage]
+                sizes[ipage] = (max(mw, x+w), max(mh, y+h))
+            return sizes
 
     def meshExportNeedsInfill(self):
         return True
 
+    # class function
+    # Writes the obj and mtl files for saveListAsObjMesh.
+    # vrtss and tvrtss are lists (one element per ExportFrag) of
+    # the vertices and texture vertices.  tfilenames is the list
+    # of texture images (indexed by ExportFrag.tex_page).
+    # Returns an error string ("" if no error).
+    def writeObjMesh(filename, efs, vrtss, tvrtss, tfilenames):
+        try:
+            of = filename.open("w")
+        except Exception as e:
+            err = "Could not open %s: %s"%(str(filename), e)
+            print(err)
+            return err
+
+        mfilename = filename.with_suffix(".mtl")
+        with of:
+            print("# khartes .obj file", file=of)
+            print("#", file=of)
+            print("mtllib %s"%mfilename.name, file=of)
+            print("# vertices", file=of)
+            for ef, vrts in zip(efs, vrtss):
+                print("# fragment", ef.frag.name, file=of)
+                if ef.fv.mesh_visible:
+                    MeshWriter.writeRows(of, "v %.2f %.2f %.2f ", vrts)
+                else:
+                    rgb = ef.frag.color.getRgbF()
+                    rgbs = np.tile(np.array(rgb[:3]), (len(vrts), 1))
+                    MeshWriter.writeRows(of, "v %.2f %.2f %.2f %.4f %.4f %.4f",
+                            np.concatenate((vrts, rgbs), axis=1))
+
+            print("# texture vertices", file=of)
+            for ef, tvrts in zip(efs, tvrtss):
+                print("# fragment", ef.frag.name, file=of)
+                MeshWriter.writeRows(of, "vt %f %f", tvrts)
+
+            print("# trgls", file=of)
+            i0 = 1
+            for i,ef in enumerate(efs):
+                print("# fragment", ef.frag.name, file=of)
+                print("usemtl frag%d"%i, file=of)
+                trgs = np.asarray(ef.trgs).reshape(-1,3)+i0
+                MeshWriter.writeRows(of, "f %d/%d %d/%d %d/%d", np.repeat(trgs, 2, axis=1))
+                i0 += len(ef.vrts)
+
+        try:
+            ofm = mfilename.open("w")
+        except Exception as e:
+            err = "Could not open %s: %s"%(str(mfilename), e)
+            print(err)
+            return err
+
+        with ofm:
+            for i,ef in enumerate(efs):
+                frag = ef.frag
+                rgba = frag.color.getRgbF()
+                print("newmtl frag%d"%i, file=ofm)
+                print("Ka %f %f %f"%(rgba[0],rgba[1],rgba[2]), file=ofm)
+                print("Kd %f %f %f"%(rgba[0],rgba[1],rgba[2]), file=ofm)
+                print("Ks 0.0 0.0 0.0", file=ofm)
+                print("illum 2", file=ofm)
+                print("d 1.0", file=ofm)
+                if ef.has_ssurf:
+                    print("map_Kd %s"%tfilenames[ef.tex_page].name, file=ofm)
+        return ""
+
+    # class function
+    # Writes the texture image as a tiled TIFF file.  The image
+    # is created, and written, one tile at a time, so the
+    # whole image is never held in memory.
+    # Returns an error string ("" if no error).
+    def writeTexture(filename, efs, tw, th):
+        ts = Fragment.texture_tile_size
+        def tiles():
+            for ty0 in range(0, th, ts):
+                for tx0 in range(0, tw, ts):
+                    tile = np.zeros((min(ts, th-ty0), min(ts, tw-tx0)), dtype=np.uint16)
+                    for ef in efs:
+                        ef.addTextureToTile(tile, tx0, ty0)
+                    yield tile
+        try:
+            # classic TIFF files are limited to 4 Gb
+            tifffile.imwrite(str(filename), tiles(), shape=(int(th),int(tw)), dtype=np.uint16, tile=(ts,ts), bigtiff=(2*tw*th > 2**31))
+        except Exception as e:
+            err = "Could not write %s: %s"%(str(filename), e)
+            print(err)
+            return err
+        return ""
+
     # class function
     # takes a list of FragmentView's as input
     # texture is taken from current volume, which may not
-    # be full resolution
-    def saveListAsObjMesh(fvs, filename, infill, ppm, class_count):
+    # be full resolution, unless tex_volume (a CachedZarrVolume)
+    # is given, in which case the texture is sampled from
+    # tex_volume at full resolution
+    def saveListAsObjMesh(fvs, filename, infill, ppm, class_count, progress=None, tex_volume=None):
         frags = [fv.fragment for fv in fvs]
         print("slaom", len(frags), filename, infill)
-        filename = filename.with_suffix(".obj")
+        # a binary PLY file is written if the user
+        # asked for one; otherwise OBJ
+        ply = (filename.suffix.lower() == ".ply")
+        if not ply:
+            filename = filename.with_suffix(".obj")
         err = ""
 
         rects = []
@@ -780,125 +801,87 @@ class Fragment(BaseFragment):
         '''
 
 
-        efs = []
-        for fv in fvs:
-            ef = Fragment.ExportFrag(fv, infill)
+        err, efs = Fragment.ExportFrag.createList(fvs, infill, progress)
+        if err != "":
+            print(err)
+            return err
+        for ef in efs:
             if ef.err != "":
                 print("Fragment",ef.frag.name,"error",ef.err)
                 # err += ef.err + '\n'
                 # continue
-            efs.append(ef)
+            ef.setTextureVolume(tex_volume)
 
         if len(efs) == 0:
             err = "No exportable fragments"
             print(err)
             return err
 
-        try:
-            of = filename.open("w")
-        except Exception as e:
-            err = "Could not open %s: %s"%(str(filename), e)
-            print(err)
-            return err
-
-        mfilename = filename.with_suffix(".mtl")
-        print("# khartes .obj file", file=of)
-        print("#", file=of)
-        print("mtllib %s"%mfilename.name, file=of)
-        print("# vertices", file=of)
-        for ef in efs:
-            fv = ef.fv
-            mesh_visible = fv.mesh_visible
-            rgb = ef.frag.color.getRgbF()
-            r = rgb[0]
-            g = rgb[1]
-            b = rgb[2]
-            vrts = ef.vrts
-            if ppm is not None:
-                vrts = ppm.layerIjksToScrollIjks(vrts)
-            print("# fragment", ef.frag.name, file=of)
-            for vrt in vrts:
-                if mesh_visible:
-                    print("v %.2f %.2f %.2f "%(vrt[0],vrt[1],vrt[2]), file=of)
-                else:
-                    print("v %.2f %.2f %.2f %.4f %.4f %.4f"%(vrt[0],vrt[1],vrt[2], r, g, b), file=of)
-
-        tex_rect = Fragment.ExportFrag.pack(efs)
-        if tex_rect is None:
+        page_sizes = Fragment.ExportFrag.pack(efs)
+        if page_sizes is None:
             err = "Could not pack textures (see console message)"
             print(err)
             return err
 
-
         for ef in efs:
             if not ef.has_ssurf:
                 continue
-            print("  ", ef.frag.name, ef.data_rect, ef.tex_orig)
-
-        print("texture size", tex_rect)
-        tw,th = tex_rect
-        tfilename = ""
-        if tw > 0 and th > 0:
-            tex_out = np.zeros((th,tw), dtype=np.uint16)
-            for ef in efs:
-                ef.addTexture(tex_out)
-
-            tfilename = filename.with_suffix(".tif")
-            cv2.imwrite(str(tfilename), tex_out)
-
-        print("# texture vertices", file=of)
+            print("  ", ef.frag.name, ef.data_rect, ef.tex_page, ef.tex_orig)
+
+        print("texture sizes", page_sizes)
+        # the texture images are written one at a time
+        tfilenames = []
+        for ipage, (tw, th) in enumerate(page_sizes):
+            if len(page_sizes) == 1:
+                tfilename = filename.with_suffix(".tif")
+            else:
+                tfilename = filename.with_name("%s_%d.tif"%(filename.stem, ipage))
+            pefs = [ef for ef in efs if ef.has_ssurf and ef.tex_page == ipage]
+            err = Fragment.writeTexture(tfilename, pefs, tw, th)
+            if err != "":
+                return err
+            tfilenames.append(tfilename)
+
+        # vertices and texture vertices of each fragment
+        vrtss = []
+        tvrtss = []
         for ef in efs:
-            print("# fragment", ef.frag.name, file=of)
+            vrts = ef.vrts
+            if ppm is not None:
+                vrts = ppm.layerIjksToScrollIjks(vrts)
+            vrtss.append(vrts)
             if not ef.has_ssurf:
-                for i in range(len(ef.vrts)):
-                    print("vt %f %f"%(0.,0.), file=of)
+                tvrtss.append(np.zeros((len(ef.vrts), 2), dtype=np.float64))
                 continue
-
+            tw, th = page_sizes[ef.tex_page]
             x0, y0 = ef.tex_orig
             dx, dy, dw, dh = ef.data_rect
-            # for vrt in ef.vrts:
             frag = ef.frag
             fv = ef.fv
-            # tgps = Volume.globalIjksToTransposedGlobalIjks(ef.vrts, frag.direction)
             tgps = fv.cur_volume_view.volume.globalPositionsToTransposedIjks(ef.vrts, frag.direction)
-            for fpt in tgps:
-                # print("v %d %d %d"%(vrt[0],vrt[1],vrt[2]), file=of)
-                vx, vy = fpt[0:2]
-                tx = (vx+x0-dx)/(tw-1)
-                ty = (vy+y0-dy)/(th-1)
-                ty = 1.-ty
-                print("vt %f %f"%(tx, ty), file=of)
-
-        print("# trgls", file=of)
-        i0 = 1
-        for i,ef in enumerate(efs):
-            print("# fragment", ef.frag.name, file=of)
-            print("usemtl frag%d"%i, file=of)
-            for trg in ef.trgs:
-                v0 = trg[0]+i0
-                v1 = trg[1]+i0
-                v2 = trg[2]+i0
-                print("f %d/%d %d/%d %d/%d"%(v0,v0,v1,v1,v2,v2), file=of)
-            i0 += len(ef.vrts)
-
-        try:
-            ofm = mfilename.open("w")
-        except Exception as e:
-            err = "Could not open %s: %s"%(str(mfilename), e)
-            print(err)
-            return err
-
-        for i,ef in enumerate(efs):
-            frag = ef.frag
-            rgba = frag.color.getRgbF()
-            print("newmtl frag%d"%i, file=ofm)
-            print("Ka %f %f %f"%(rgba[0],rgba[1],rgba[2]), file=ofm)
-            print("Kd %f %f %f"%(rgba[0],rgba[1],rgba[2]), file=ofm)
-            print("Ks 0.0 0.0 0.0", file=ofm)
-            print("illum 2", file=ofm)
-            print("d 1.0", file=ofm)
-            if tfilename != "":
-                print("map_Kd %s"%tfilename.name, file=ofm)
+            tvrts = np.zeros((len(tgps), 2), dtype=np.float64)
+            fi, fj = ef.tex_scale
+            tvrts[:,0] = ((tgps[:,0]-dx)*fi+x0)/(tw-1)
+            tvrts[:,1] = 1.-((tgps[:,1]-dy)*fj+y0)/(th-1)
+            tvrtss.append(tvrts)
+
+        if ply:
+            i0 = 0
+            trgss = []
+            for ef in efs:
+                trgss.append(np.asarray(ef.trgs).reshape(-1,3)+i0)
+                i0 += len(ef.vrts)
+            err = MeshWriter.writePly(filename,
+                    np.concatenate(vrtss, axis=0),
+                    np.concatenate(trgss, axis=0),
+                    tvrts=np.concatenate(tvrtss, axis=0),
+                    comments=["khartes .ply file"])
+            if err != "":
+                return err
+        else:
+            err = Fragment.writeObjMesh(filename, efs, vrtss, tvrtss, tfilenames)
+            if err != "":
+                return err
 
         jfilename = filename.with_suffix(".json")
         jdict = {}
@@ -910,6 +893,8 @@ class Fragment(BaseFragment):
             fdict["area_sq_cm"] = fv.sqcm
             fdict["n_vrts"] = len(ef.vrts)
             fdict["n_trgls"] = len(ef.trgs)
+            if ef.has_ssurf:
+                fdict["texture"] = tfilenames[ef.tex_page].name
             jdict[frag.name] = fdict
         info_txt = json.dumps(jdict, indent=4)
         try:
@@ -938,8 +923,6 @@ class FragmentView(BaseFragmentView):
         self.lineAxis = -1
         self.lineAxisPosition = 0
         self.zsurf = None
-        self.prevZslice = -1
-        self.prevZslicePts = None
         self.ssurf = None
         self.nearbyNode = -1
         self.live_zsurf_update = True
@@ -949,6 +932,9 @@ class FragmentView(BaseFragmentView):
         self.fpoints = np.zeros((0,4), dtype=np.float32)
         self.oldzs = None
         self.oldtri = None
+        # (tri, interpolator) of the most recent zsurf
+        # computation that used a CloughTocher interpolator
+        self.ct_interp = None
         # same as above, but trijk based on cur_volume_view's 
         # direction
         self.vpoints = np.zeros((0,4), dtype=np.float32)
@@ -970,9 +956,9 @@ class FragmentView(BaseFragmentView):
         self.oldtri = None
         self.clearZsliceCache()
 
+    # called whenever zsurf changes
     def clearZsliceCache(self):
-        self.prevZslice = -1
-        self.prevZslicePts = None
+        self.clearSliceCache()
 
     def aligned(self):
         if self.cur_volume_view is None:
@@ -987,10 +973,19 @@ class FragmentView(BaseFragmentView):
     def setLocalPoints(self, recursion_ok, always_update_zsurf=True):
         # print("set local points", self.cur_volume_view.volume.name)
         # print("set local points", self.fragment.name)
+        self.geometry_pending = False
+        self.clearSliceCache()
         if self.cur_volume_view is None:
             self.fpoints = np.zeros((0,4), dtype=np.float32)
             self.vpoints = np.zeros((0,4), dtype=np.float32)
             return
+        # an "echo" fragment gets its points from its original,
+        # whose local points may not have been computed yet
+        # (they are computed lazily; see BaseFragmentView)
+        orig = self.echoOriginal()
+        if orig is not None and orig.geometry_pending:
+            orig.setLocalPoints(False)
+            self.echoPointsFrom(orig)
         self.fpoints = self.cur_volume_view.volume.globalPositionsToTransposedIjks(self.fragment.gpoints, self.fragment.direction)
         npts = self.fpoints.shape[0]
         if npts > 0:
@@ -1040,7 +1035,18 @@ class FragmentView(BaseFragmentView):
             return
         self.live_zsurf_update = lzu
         if lzu:
-            self.setLocalPoints(True)
+            self.updateLocalPoints(True)
+
+    # returns the view of the fragment that this fragment
+    # is an echo of, or None
+    def echoOriginal(self):
+        echo = self.fragment.params.get('echo', '')
+        if echo == '' or self.project_view is None:
+            return None
+        for fv in self.project_view.fragments.values():
+            if fv.fragment.name == echo and fv != self:
+                return fv
+        return None
 
     def echoPointsFrom(self, orig):
         # print("echo from",orig.fragment.name,"to",self.fragment.name)
@@ -1056,9 +1062,33 @@ class FragmentView(BaseFragmentView):
             print("infill",infill)
             vol = self.cur_volume_view.volume
             print("vol", vol.name)
-            newgijks = self.fragment.createInfillPoints(infill)
+            newgijks = self.fragment.createInfillPoints(infill, orig)
             self.fragment.gpoints = np.append(self.fragment.gpoints, newgijks, axis=0)
-            self.setLocalPoints(True)
+
+    # Returns (tri, interp, volume), where tri is the current
+    # triangulation of fpoints and interp is the CloughTocher
+    # interpolator of the fpoints k values that was created along
+    # with the current zsurf, for use by createInfillPoints
+    # (in the coordinates of volume, the current volume).
+    # Returns None if they are not current, or if they can't
+    # stand in for a triangulation made in global coordinates:
+    # the triangulation (and the roundness of its triangles)
+    # is unchanged by a uniform scaling of i and j, but not
+    # by different scalings.
+    def infillSurface(self, direction):
+        if self.tri is None or self.ct_interp is None or self.ct_interp[0] is not self.tri:
+            return None
+        if self.geometry_pending or self.cur_volume_view is None:
+            return None
+        if direction != self.fragment.direction or len(self.fpoints) != len(self.fragment.gpoints):
+            return None
+        volume = self.cur_volume_view.volume
+        tijks = np.array([[0,0,0],[1,0,0],[0,1,0]], dtype=np.float64)
+        gps = volume.transposedIjksToGlobalPositions(tijks, direction)
+        si, sj = np.linalg.norm(gps[1:]-gps[0], axis=1)
+        if abs(si-sj) > 1.e-6*si:
+            return None
+        return self.tri, self.ct_interp[1], volume
 
     # given node indices and a triangulation, return a list of the
     # neighboring node indices, plus the input node indices themselves
@@ -1198,11 +1228,12 @@ class FragmentView(BaseFragmentView):
             # print("old new",oldpts.shape, newpts.shape)
 
             # Find points that have been deleted (oldpts minus newpts,
-            # where "minus" is a set operation)
+            # where "minus" is a set operation), and points that
+            # have been added (newpts minus oldpts).
             # If a point has simply been moved, it will be detected
             # twice: as if the point at the old position had been deleted,
             # and the point at the new position had been added
-            deleted_pts = Utils.setDiff2DIndex(oldpts, newpts)
+            deleted_pts, added_pts = Utils.setDiffs2DIndex(oldpts, newpts)
             del_pts_rect = None
             if len(deleted_pts) > 0:
                 # Neighboring points
@@ -1211,8 +1242,6 @@ class FragmentView(BaseFragmentView):
                 nnidxs = self.nodesNeighbors(oldtri, nidxs)
                 del_pts_rect = self.nodesBoundingBox(oldtri, nnidxs)
 
-            # Find points which have been added (newpts minus oldpts)
-            added_pts = Utils.setDiff2DIndex(newpts, oldpts)
             add_pts_rect = None
             if len(added_pts) > 0:
                 nidxs = self.nodesNeighbors(self.tri, added_pts)
@@ -1244,16 +1273,18 @@ class FragmentView(BaseFragmentView):
             oldtrixys = oldtri.points[oldtris].reshape(-1,6)
             newtrixys = self.tri.points[newtris].reshape(-1,6)
 
-            # old triangulation minus new triangulation
-            deleted_tris = Utils.setDiff2DIndex(oldtrixys, newtrixys)
+            # old triangulation minus new triangulation, and
+            # new triangulation minus old triangulation.
+            # (scipy's Delaunay rebuilds the triangulation from
+            # scratch, so the changed triangles can only be found
+            # by comparing the two triangulations)
+            deleted_tris, added_tris = Utils.setDiffs2DIndex(oldtrixys, newtrixys)
             del_tris_rect = None
             if len(deleted_tris) > 0:
                 vrts = self.trglsNeighborsVertices(oldtri, deleted_tris)
                 if len(vrts) > 0:
                     del_tris_rect = self.nodesBoundingBox(oldtri, vrts)
 
-            # new triangulation minus old triangulation
-            added_tris = Utils.setDiff2DIndex(newtrixys, oldtrixys)
             add_tris_rect = None
             if len(added_tris) > 0:
                 vrts = self.trglsNeighborsVertices(self.tri, added_tris)
@@ -1277,6 +1308,10 @@ class FragmentView(BaseFragmentView):
             '''
 
             if not Utils.rectIsValid(changed_rect):
+                if changed_rect is None and self.ct_interp is not None and self.ct_interp[0] is oldtri:
+                    # nothing has changed, so the interpolator
+                    # is still current
+                    self.ct_interp = (self.tri, self.ct_interp[1])
                 return
 
             if changed_rect is not None:
@@ -1326,6 +1361,7 @@ class FragmentView(BaseFragmentView):
                 inner_interp = NearestNDInterpolator(self.tri, self.fpoints[:,2])
             else:
                 inner_interp = CloughTocher2DInterpolator(self.tri, self.fpoints[:,2])
+                self.ct_interp = (self.tri, inner_interp)
             # for testing:
             interp = self.interpAndFilter(inner_interp, self.tri)
             if changed_rect is None:
@@ -1544,8 +1580,10 @@ class FragmentView(BaseFragmentView):
 
     # returns zsurf points, as array of [ipos, jpos] values
     # for the slice with the given axis and axis position
-    # (axis and position relative to volume-view axes)
-    def getZsurfPoints(self, vaxis, vaxisPosition):
+    # (axis and position relative to volume-view axes).
+    # Called via BaseFragmentView.getZsurfPoints, which caches
+    # the result.
+    def computeZsurfPoints(self, vaxis, vaxisPosition):
         if self.zsurf is None:
             return
         faxis = vaxis
@@ -1594,9 +1632,8 @@ class FragmentView(BaseFragmentView):
         else: # faxis == 2
             # The so-called z slice is a relatively expensive
             # operation, and should not be performed unless "z"
-            # or the zsurf has changed.  So cache the results.
-            if self.prevZslicePts is not None and self.prevZslice == vaxisPosition:
-                return self.prevZslicePts
+            # or the zsurf has changed; the slice cache takes
+            # care of this.
             frag_rect = self.computeFragRect()
             if frag_rect is not None:
                 minx, miny, maxx, maxy = frag_rect
@@ -1615,8 +1652,6 @@ class FragmentView(BaseFragmentView):
                 # print("len pts",len(pts), pts.shape)
             else:
                 pts = None
-            self.prevZslice = vaxisPosition
-            self.prevZslicePts = pts
             return pts
 
     def triangulate(self):
@@ -1698,6 +1733,9 @@ class FragmentView(BaseFragmentView):
             vijk = (fijk[2], fijk[1], fijk[0])
         return vijk
 
+    # returns the index of the point that was added (or
+    # moved, if there was already a point at the same ij),
+    # or None if no point was added
     def addPoint(self, tijk):
         # ijk using volume-view's direction
         fijk = self.vijkToFijk(tijk)
@@ -1721,19 +1759,80 @@ class FragmentView(BaseFragmentView):
             # Move existing point rather than deleting and replacing
             # it, to avoid reindexing the list of points
             print("addPoint: duplicate at", ij, tijk)
-            self.movePoint(matches[0], tijk)
-            return
+            if not self.movePoint(matches[0], tijk):
+                return None
+            return matches[0]
         # create new point
         gijk = self.cur_volume_view.transposedIjkToGlobalPosition(tijk)
-        self.pushFragmentState()
+        self.fragment.history.record(self.fragment.gpoints, added=np.reshape(gijk, (1,3)))
         self.fragment.gpoints = np.append(self.fragment.gpoints, np.reshape(gijk, (1,3)), axis=0)
         # print(self.lpoints)
         self.setLocalPoints(True, False)
         self.fragment.notifyModified()
+        return len(self.fragment.gpoints)-1
+
+    # Adds a batch of points: tijks is an array of shape (n,3)
+    # (or a list of tijks), in the current volume view's
+    # transposed coordinates.  As in addPoint, a point that has
+    # the same (rounded) ij, in the fragment's direction, as an
+    # existing point moves that point instead, and if several
+    # points in the batch have the same ij, the result is the
+    # same as adding them one after another: one point, at the
+    # position of the last of them.
+    # The fragment is modified, and its surface updated,
+    # only once.
+    # Returns a list with, for each point, its index in gpoints.
+    def addPoints(self, tijks):
+        tijks = np.asarray(tijks, dtype=np.float64).reshape(-1,3)
+        n = len(tijks)
+        if n == 0:
+            return []
+        if self.aligned():
+            fijks = tijks
+        else:
+            fijks = tijks[:,::-1]
+        npts = len(self.fpoints)
+        ijs = np.concatenate((np.rint(self.fpoints[:,0:2]), np.rint(fijks[:,0:2])))
+        keys, inverse = np.unique(ijs, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        old_keys = inverse[:npts]
+        new_keys = inverse[npts:]
+        nkeys = len(keys)
+        # for each key: the first existing point that has it,
+        # the first and the last batch points that have it
+        big = npts+n
+        first_old = np.full(nkeys, big, dtype=np.int64)
+        np.minimum.at(first_old, old_keys, np.arange(npts))
+        first_new = np.full(nkeys, big, dtype=np.int64)
+        np.minimum.at(first_new, new_keys, np.arange(n))
+        last_new = np.full(nkeys, -1, dtype=np.int64)
+        np.maximum.at(last_new, new_keys, np.arange(n))
+
+        gijks = self.cur_volume_view.transposedIjksToGlobalPositions(tijks)
+        batch_keys = (last_new >= 0).nonzero()[0]
+        moved_keys = batch_keys[first_old[batch_keys] < big]
+        added_keys = batch_keys[first_old[batch_keys] == big]
+        # new points are added in order of first appearance
+        added_keys = added_keys[np.argsort(first_new[added_keys])]
+        key_index = first_old.copy()
+        key_index[added_keys] = npts + np.arange(len(added_keys))
+
+        gpoints = self.fragment.gpoints
+        self.fragment.history.record(gpoints,
+                moved=(first_old[moved_keys], gijks[last_new[moved_keys]]),
+                added=gijks[last_new[added_keys]])
+        if len(added_keys) > 0:
+            gpoints = np.concatenate((gpoints, gijks[last_new[added_keys]]), axis=0)
+        if len(moved_keys) > 0:
+            gpoints[first_old[moved_keys], :] = gijks[last_new[moved_keys]]
+        self.fragment.gpoints = gpoints
+        self.fragment.notifyModified()
+        self.setLocalPoints(True, False)
+        return key_index[new_keys].tolist()
 
     def deletePointByIndex(self, index):
         if index >= 0 and index < len(self.fragment.gpoints):
-            self.pushFragmentState()
+            self.fragment.history.record(self.fragment.gpoints, deleted=[index])
             self.fragment.gpoints = np.delete(self.fragment.gpoints, index, 0)
         self.fragment.notifyModified()
         self.setLocalPoints(True, False)
@@ -1769,44 +1868,10 @@ class FragmentView(BaseFragmentView):
         new_gijk = self.cur_volume_view.transposedIjkToGlobalPosition(new_vijk)
         # print(self.fragment.gpoints)
         # print(match, new_gijk)
-        self.pushFragmentState()
+        self.fragment.history.record(self.fragment.gpoints, moved=([index], new_gijk))
         self.fragment.gpoints[index, :] = new_gijk
         # print(self.fragment.gpoints)
         self.fragment.notifyModified()
         self.setLocalPoints(True, False)
         return True
 
-    def pushFragmentState(self):
-        """Push the current list of gpoints onto the stack in preparation for changing gpoints."""
-        # Currently disabled because of crash when 
-        # undoing the initial creation of the fragment
-        return
-
-        gpoints_copy = np.copy(self.fragment.gpoints)
-        self.fragment.gpoints_history.append(gpoints_copy)
-
-    def popFragmentState(self):
-        """Replace current gpoints with top of the stack, and update."""
-        # Currently disabled because of crash when 
-        # undoing the initial creation of the fragment
-        return
-
-        hist_size =  len(self.fragment.gpoints_history)
-        if hist_size > 0:
-            self.fragment.gpoints = self.fragment.gpoints_history.pop()
-            self.fragment.notifyModified()
-            self.setLocalPoints(True, False)
-
-    def pushFragmentStateOld(self):
-        """Push the current list of gpoints onto the stack in preparation for changing gpoints."""
-        gpoints_copy = np.copy(self.fragment.gpoints)
-        self.fragment.gpoints_history.put(gpoints_copy)
-
-    def popFragmentStateOld(self):
-        """Replace current gpoints with top of the stack, and update."""
-        hist_size=  self.fragment.gpoints_history.qsize()
-        if hist_size > 0:
-            self.fragment.gpoints = self.fragment.gpoints_history.get()
-            self.fragment.notifyModified()
-            self.setLocalPoints(True, False)
-
@@ -0,0 +1,127 @@
+import os
+import json
+import struct
+import numpy as np
+
+# Binary container for a single fragment.
+# Layout:
+#   magic (8 bytes): b"KHFRAG1\n"
+#   header length in bytes (8 bytes, little-endian unsigned int)
+#   header: utf-8 JSON, padded with blanks so that the
+#     first array starts on an alignment boundary
+#   arrays: raw C-order data, each starting on an
+#     alignment boundary
+# The header is a dict with two entries:
+#   "info": fragment metadata (name, color, timestamps, etc),
+#   "arrays": {name: {"dtype", "shape", "offset"}, ...}
+# Arrays are loaded as copy-on-write memory maps, so opening
+# a file costs (almost) nothing until the data is actually used,
+# and in-memory changes are never written back to the file.
+class FragmentFile():
+
+    suffix = ".khfrag"
+    magic = b"KHFRAG1\n"
+    alignment = 64
+
+    # class function
+    def alignUp(n):
+        a = FragmentFile.alignment
+        return ((n+a-1)//a)*a
+
+    # class function
+    # info is a json-serializable dict; arrays is a dict
+    # of numpy arrays.  The file is written to a temporary
+    # name and then renamed, so that a failed write never
+    # damages an existing file.
+    # Returns an error string ("" if no error).
+    def write(path, info, arrays):
+        carrays = {}
+        # offsets relative to the start of the data section
+        rel_offsets = {}
+        offset = 0
+        for name, arr in arrays.items():
+            carr = np.ascontiguousarray(arr)
+            carrays[name] = carr
+            rel_offsets[name] = offset
+            offset = FragmentFile.alignUp(offset+carr.nbytes)
+
+        # the header size depends on the offsets, which depend
+        # on the header size, so iterate until they agree
+        data_start = 0
+        while True:
+            descs = {}
+            for name, carr in carrays.items():
+                descs[name] = {
+                        "dtype": carr.dtype.str,
+                        "shape": list(carr.shape),
+                        "offset": data_start+rel_offsets[name],
+                        }
+            header = json.dumps({"info": info, "arrays": descs}).encode("utf-8")
+            new_start = FragmentFile.alignUp(16+len(header))
+            if new_start == data_start:
+                break
+            data_start = new_start
+        header += b' '*(data_start-16-len(header))
+
+        tmp_path = path.with_name(path.name+".tmp")
+        try:
+            with tmp_path.open("wb") as fd:
+                fd.write(FragmentFile.magic)
+                fd.write(struct.pack("<Q", len(header)))
+                fd.write(header)
+                for name, carr in carrays.items():
+                    fd.seek(descs[name]["offset"])
+                    carr.tofile(fd)
+                # pad the file so that its size is a multiple
+                # of the alignment
+                fd.seek(data_start+offset)
+                fd.truncate()
+            os.replace(tmp_path, path)
+        except Exception as e:
+            err = "Could not write %s: %s"%(str(path), e)
+            print(err)
+            return err
+        return ""
+
+    # class function
+    # Returns (err, info, arrays); err is "" if no error.
+    def read(path):
+        fstr = str(path)
+        try:
+            with path.open("rb") as fd:
+                magic = fd.read(len(FragmentFile.magic))
+                if magic != FragmentFile.magic:
+                    err = "%s is not a khartes fragment file"%fstr
+                    print(err)
+                    return err, None, None
+                hlen = struct.unpack("<Q", fd.read(8))[0]
+                header = json.loads(fd.read(hlen).decode("utf-8"))
+        except Exception as e:
+            err = "Could not read %s: %s"%(fstr, e)
+            print(err)
+            return err, None, None
+
+        arrays = {}
+        for name, desc in header.get("arrays", {}).items():
+            shape = tuple(desc["shape"])
+            dtype = np.dtype(desc["dtype"])
+            if 0 in shape:
+                # np.memmap can't map zero bytes
+                arrays[name] = np.zeros(shape, dtype=dtype)
+                continue
+            try:
+                arrays[name] = np.memmap(path, dtype=dtype, mode='c', offset=desc["offset"], shape=shape)
+            except Exception as e:
+                err = "Could not map array %s in %s: %s"%(name, fstr, e)
+                print(err)
+                return err, None, None
+        return "", header.get("info", {}), arrays
+
+    # class function
+    # Memory-mapped arrays keep the file open (which, on Windows,
+    # prevents the file from being replaced).  Returns arr as an
+    # ordinary in-memory array.
+    def detach(arr):
+        if isinstance(arr, np.memmap):
+            return np.array(arr)
+        return arr
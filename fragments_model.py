@@ -0,0 +1,234 @@
+from PyQt5 import QtCore, QtGui
+from PyQt5.QtCore import Qt
+from color import Color
+
+
+class FragmentsModel(QtCore.QAbstractTableModel):
+    def __init__(self, project_view, main_window):
+        super(FragmentsModel, self).__init__()
+        # note that self.project_view should not be
+        # changed after initialization; instead, a new
+        # instance of VolumesModel should be created
+        # and attached to the QTableView
+        self.project_view = project_view
+        self.main_window = main_window
+
+    columns = [
+            "Active",
+            "Visible",
+            "Hide\nMesh",
+            "Name",
+            "Color",
+            "Dir",
+            "Pts",
+            "cm^2"
+            ]
+
+    ctips = [
+            "Select which fragment is active;\nclick box to select.\nNote that you can only select fragments\nwhich have the same direction (orientation)\nas the current volume view",
+            "Select which fragments are visible;\nclick box to select",
+            "Select which fragments have their mesh hidden;\nclick box to select",
+            "Name of the fragment; click to edit",
+            "Color of the fragment; click to edit",
+            "Direction (orientation) of the fragment",
+            "Number of points currently in fragment",
+            "Fragment area in square centimeters"
+            ]
+    
+    def flags(self, index):
+        col = index.column()
+        oflags = super(FragmentsModel, self).flags(index)
+        if col == 0:
+            nflags = Qt.ItemNeverHasChildren
+            nflags |= Qt.ItemIsUserCheckable
+            nflags |= Qt.ItemIsEnabled
+            return nflags
+        elif col == 1:
+            # print(col, int(oflags))
+            nflags = Qt.ItemNeverHasChildren
+            nflags |= Qt.ItemIsUserCheckable
+            nflags |= Qt.ItemIsEnabled
+            # nflags |= Qt.ItemIsEditable
+            return nflags
+        elif col == 2:
+            # print(col, int(oflags))
+            nflags = Qt.ItemNeverHasChildren
+            nflags |= Qt.ItemIsUserCheckable
+            nflags |= Qt.ItemIsEnabled
+            # nflags |= Qt.ItemIsEditable
+            return nflags
+        elif col== 3:
+            nflags = Qt.ItemNeverHasChildren
+            nflags |= Qt.ItemIsEnabled
+            nflags |= Qt.ItemIsEditable
+            return nflags
+        else:
+            return Qt.ItemNeverHasChildren|Qt.ItemIsEnabled
+
+    def headerData(self, section, orientation, role):
+        if orientation != Qt.Horizontal:
+            return
+        
+        if role == Qt.DisplayRole:
+            if section == 0:
+                # print("HD", self.rowCount())
+                table = self.main_window.fragments_table
+                # make sure the color button in column 3 is always open
+                # (so no double-clicking required)
+                for i in range(self.rowCount()):
+                    index = self.createIndex(i, 4)
+                    table.openPersistentEditor(index)
+
+            return FragmentsModel.columns[section]
+        elif role == Qt.ToolTipRole:
+            return FragmentsModel.ctips[section]
+
+    def columnCount(self, parent=None):
+        return len(FragmentsModel.columns)
+
+    def rowCount(self, parent=None):
+        if self.project_view is None:
+            return 0
+        fragments = self.project_view.fragments
+        # print("row count", len(fragments.keys()))
+        return len(fragments.keys())
+
+    # columns: name, color, direction, xmin, xmax, xstep, y..., img...
+
+    def data(self, index, role):
+        if self.project_view is None:
+            return None
+        if role == Qt.DisplayRole:
+            return self.dataDisplayRole(index, role)
+        elif role == Qt.TextAlignmentRole:
+            return self.dataAlignmentRole(index, role)
+        elif role == Qt.BackgroundRole:
+            return self.dataBackgroundRole(index, role)
+        elif role == Qt.CheckStateRole:
+            return self.dataCheckStateRole(index, role)
+        return None
+
+    def dataCheckStateRole(self, index, role):
+        column = index.column()
+        row = index.row()
+        fragments = self.project_view.fragments
+        fragment = list(fragments.keys())[row]
+        fragment_view = fragments[fragment]
+        if column == 0:
+            if fragment_view.active:
+                return Qt.Checked
+            else:
+                return Qt.Unchecked
+        if column == 1:
+            if fragment_view.visible:
+                return Qt.Checked
+            else:
+                return Qt.Unchecked
+        if column == 2:
+            # Note that column is "Hide Mesh", but
+            # internal variable is mesh_visible
+            if fragment_view.mesh_visible:
+                return Qt.Unchecked
+            else:
+                return Qt.Checked
+
+    def dataAlignmentRole(self, index, role):
+        return Qt.AlignVCenter + Qt.AlignRight
+
+    def dataBackgroundRole(self, index, role):
+        row = index.row()
+        fragments = self.project_view.fragments
+        fragment = list(fragments.keys())[row]
+        fragment_view = fragments[fragment]
+        if self.project_view.mainActiveVisibleFragmentView() == fragment_view:
+            # return QtGui.QColor('beige')
+            return QtGui.QColor(self.main_window.highlightedBackgroundColor())
+
+    def dataDisplayRole(self, index, role):
+        row = index.row()
+        column = index.column()
+        fragments = self.project_view.fragments
+        fragment = list(fragments.keys())[row]
+        fragment_view = fragments[fragment]
+        if column == 3:
+            return fragment.name
+        elif column == 4:
+            # print("ddr", row, volume_view.color.name())
+            return fragment.color.name()
+        elif column == 5:
+            # print("data display role", row, volume_view.direction)
+            return ('X','Y')[fragment.direction]
+        elif column == 6:
+            return len(fragment.gpoints)
+        elif column == 7:
+            # area is not known until the view's
+            # local points are computed
+            if fragment_view.geometry_pending:
+                return ""
+            return "%.4f"%fragment_view.sqcm
+        else:
+            return None
+
+    def setData(self, index, value, role):
+        row = index.row()
+        column = index.column()
+        # print("setdata", row, column, value, role)
+        if role == Qt.CheckStateRole and column == 0:
+            # print("check", row, value)
+            fragments = self.project_view.fragments
+            fragment = list(fragments.keys())[row]
+            fragment_view = fragments[fragment]
+            exclusive = True
+            # print(self.main_window.app.keyboardModifiers())
+            if ((self.main_window.app.keyboardModifiers() & Qt.ControlModifier) 
+               or 
+               len(self.main_window.project_view.activeFragmentViews(unaligned_ok=True)) > 1):
+                exclusive = False
+            self.main_window.setFragmentActive(fragment, value==Qt.Checked, exclusive)
+            return True
+        elif role == Qt.CheckStateRole and column == 1:
+            # print(row, value)
+            fragments = self.project_view.fragments
+            fragment = list(fragments.keys())[row]
+            fragment_view = fragments[fragment]
+            self.main_window.setFragmentVisibility(fragment, value==Qt.Checked)
+            return True
+        elif role == Qt.CheckStateRole and column == 2:
+            # print(row, value)
+            fragments = self.project_view.fragments
+            fragment = list(fragments.keys())[row]
+            fragment_view = fragments[fragment]
+            # Note that column reads "Hide Mesh", but internal variable
+            # is mesh_visible
+            self.main_window.setFragmentMeshVisibility(fragment, value==Qt.Unchecked)
+            return True
+        elif role == Qt.EditRole and column == 3:
+            # print("setdata", row, value)
+            name = value
+            # print("sd name", value)
+            fragments = self.project_view.fragments
+            fragment = list(fragments.keys())[row]
+            # print("%s to %s"%(fragment.name, name))
+            if name != "":
+                self.main_window.renameFragment(fragment, name)
+
+        elif role == Qt.EditRole and column == 4:
+            # print("sd color", value)
+            fragments = self.project_view.fragments
+            fragment = list(fragments.keys())[row]
+            # print("setdata", row, color.name())
+            # value is a QColor; the fragment stores a plain Color
+            self.main_window.setFragmentColor(fragment, Color(value.name()))
+
+        return False
+
+    def scrollToRow(self, row):
+        index = self.createIndex(row, 0)
+        table = self.main_window.fragments_table
+        table.scrollTo(index)
+
+    def scrollToEnd(self):
+        row = self.rowCount()-1
+        if row < 0:
+            return
+        self.scrollToRow(row)
@@ -0,0 +1,182 @@
+import os
+import json
+import queue
+import shutil
+import threading
+from fragment_file import FragmentFile
+
+# Append-only journal of fragment edits (node add, move,
+# delete), so that edits made since the last save can be
+# recovered after a crash (see Project.replayJournal).
+# Each record is one line of JSON.
+# All file operations are performed by a background thread,
+# so that recording an edit never blocks the GUI.  The same
+# thread performs compaction: it writes the fragments that
+# reflect the journaled edits to the autosave directory
+# (never to the project's fragments directory, which is
+# only written by an explicit save), and then removes
+# the records of those fragments from the journal.
+# Because records and compaction jobs are handled in the
+# order they were queued, a compaction never discards
+# a record that it does not include.
+class EditJournal():
+
+    file_name = "journal.jsonl"
+    autosave_dir_name = "autosave"
+
+    def __init__(self, path):
+        self.path = path
+        self.autosave_path = path.parent / EditJournal.autosave_dir_name
+        # number of records queued since the last
+        # compaction (or reset); only used by the
+        # calling thread
+        self.count = 0
+        try:
+            if path.stat().st_size > 0:
+                # records left over from an earlier session
+                self.count = 1
+        except Exception:
+            pass
+        self.queue = queue.Queue()
+        # "created" ids of the fragments that a compaction
+        # failed to write; filled by the background thread,
+        # emptied by the calling thread (see failures())
+        self.failed = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # rec is a json-serializable dict
+    def record(self, rec):
+        self.queue.put(("record", rec))
+        self.count += 1
+
+    # jobs is a list of (created, fpath, info, arrays), where
+    # created identifies the fragment, and fpath is in the
+    # autosave directory; the arrays must not be modified by
+    # the caller after they are passed in.  names is the set
+    # of the file names of all the current fragments; other
+    # files in the autosave directory are removed.
+    def compact(self, jobs, names):
+        self.queue.put(("compact", (jobs, names)))
+        self.count = 0
+
+    # Returns the "created" ids of the fragments that
+    # compactions have failed to write since the last call
+    def failures(self):
+        ids = []
+        while not self.failed.empty():
+            ids.append(self.failed.get())
+        return ids
+
+    # removes all records, and the autosave directory
+    # (for instance, after the project has been saved)
+    def reset(self):
+        self.queue.put(("reset", None))
+        self.count = 0
+        self.sync()
+
+    # waits until all queued operations are finished
+    def sync(self):
+        self.queue.join()
+
+    # stops the background thread; if discard is True,
+    # the journal file and the autosave directory are deleted
+    def stop(self, discard=False):
+        self.queue.put(("stop", discard))
+        self.thread.join()
+
+    # class function
+    # Returns the list of records in the journal file at path.
+    # A partially-written final line (the result of a crash)
+    # is ignored.
+    def readRecords(path):
+        recs = []
+        try:
+            txt = path.read_text(encoding="utf8")
+        except Exception:
+            return recs
+        for line in txt.splitlines():
+            try:
+                recs.append(json.loads(line))
+            except Exception:
+                print("journal: ignoring unreadable record")
+        return recs
+
+    # class function
+    # Used by json.dumps to serialize the arrays in records
+    # (converting them in the background thread)
+    def toJson(obj):
+        return obj.tolist()
+
+    def truncate(self, fd):
+        if fd is not None:
+            fd.close()
+        return self.path.open("w", encoding="utf8")
+
+    # Removes the records of the given fragments from the
+    # journal file; the file is replaced atomically, so a
+    # crash leaves either the old or the new version
+    def removeRecords(self, fd, created_ids):
+        if fd is not None:
+            fd.close()
+        recs = EditJournal.readRecords(self.path)
+        tmp_path = self.path.with_name(self.path.name+".tmp")
+        with tmp_path.open("w", encoding="utf8") as tfd:
+            for rec in recs:
+                if rec.get("frag", "") not in created_ids:
+                    tfd.write(json.dumps(rec)+"\n")
+            tfd.flush()
+            os.fsync(tfd.fileno())
+        os.replace(tmp_path, self.path)
+        return None
+
+    def clearAutosave(self):
+        shutil.rmtree(self.autosave_path, ignore_errors=True)
+
+    def run(self):
+        fd = None
+        while True:
+            op, arg = self.queue.get()
+            try:
+                if op == "record":
+                    if fd is None:
+                        fd = self.path.open("a", encoding="utf8")
+                    fd.write(json.dumps(arg, default=EditJournal.toJson)+"\n")
+                    if self.queue.empty():
+                        fd.flush()
+                        os.fsync(fd.fileno())
+                elif op == "compact":
+                    jobs, names = arg
+                    self.autosave_path.mkdir(exist_ok=True)
+                    written = set()
+                    for created, fpath, info, arrays in jobs:
+                        err = FragmentFile.write(fpath, info, arrays)
+                        if err == "":
+                            written.add(created)
+                        else:
+                            self.failed.put(created)
+                    # records of the fragments that could not be
+                    # written are kept, so that they can still
+                    # be replayed
+                    if len(written) > 0:
+                        fd = self.removeRecords(fd, written)
+                    if len(written) < len(jobs):
+                        print("journal: compaction of %d fragments failed"%(len(jobs)-len(written)))
+                    for file in self.autosave_path.glob("*"+FragmentFile.suffix):
+                        if file.name not in names:
+                            file.unlink()
+                elif op == "reset":
+                    fd = self.truncate(fd)
+                    self.clearAutosave()
+                elif op == "stop":
+                    if fd is not None:
+                        fd.close()
+                        fd = None
+                    if arg:
+                        self.path.unlink(missing_ok=True)
+                        self.clearAutosave()
+                    return
+            except Exception as e:
+                print("journal: %s failed: %s"%(op, e))
+            finally:
+                self.queue.task_done()
@@ -17,7 +17,10 @@ class Khartes():
         self.window = window
         window.show()
 
-app = QApplication(sys.argv)
+# The guard is needed because worker processes (which are
+# started using "spawn") import this module
+if __name__ == '__main__':
+    app = QApplication(sys.argv)
 
-khartes = Khartes(app)
-app.exec()
+    khartes = Khartes(app)
+    app.exec()
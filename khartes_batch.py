@@ -0,0 +1,273 @@
+'''
+Command-line (no GUI) interface to the slow khartes operations:
+creating data volumes, exporting fragments as meshes,
+rendering layers from a PPM file, and precomputing
+structure-tensor fields.  Run
+    python khartes_batch.py --help
+for a list of commands, and
+    python khartes_batch.py <command> --help
+for the options of each command.
+
+Standard output consists only of progress and status
+messages, one JSON object per line, for example:
+    {"job": "export", "done": 3, "total": 10}
+    {"job": "export", "status": "ok"}
+(status is "ok" or "error"; if "error", there is also an
+"error" field).  Everything else that khartes prints
+goes to standard error.
+The exit status is 0 if the job succeeded, 1 otherwise.
+'''
+
+import os
+import re
+import sys
+import json
+import time
+import pathlib
+import argparse
+
+import cv2
+
+from project import Project, ProjectView
+from volume import Volume
+from volume_zarr import CachedZarrVolume
+from base_fragment import BaseFragment
+from fragment import Fragment
+from ppm_layers import PpmLayers
+from st_volume import StructureTensorVolume
+
+class KhartesBatch():
+
+    # class variable
+    # minimum time, in seconds, between progress messages
+    # that report the same job
+    progress_interval = .5
+
+    def __init__(self, job, out):
+        self.job = job
+        # file that the JSON messages are written to
+        self.out = out
+        self.last_time = 0.
+
+    def emit(self, **kwargs):
+        msg = {"job": self.job}
+        msg.update(kwargs)
+        print(json.dumps(msg), file=self.out, flush=True)
+
+    # Has the signature expected by the progress arguments
+    # of the khartes functions; always returns True
+    # (never cancels)
+    def progress(self, done, total):
+        now = time.time()
+        if done >= total or now-self.last_time >= KhartesBatch.progress_interval:
+            self.last_time = now
+            self.emit(done=done, total=total)
+        return True
+
+    # Has the signature expected by Volume.createFromTiffs
+    def message(self, text):
+        self.emit(message=text)
+        return True
+
+    # class function
+    # Returns (err, project)
+    def openProject(path):
+        project = Project.open(pathlib.Path(path))
+        if not project.valid:
+            return "Could not open project %s: %s"%(path, project.error), None
+        return "", project
+
+    # class function
+    # Returns the volume, in project, with the given name,
+    # or None
+    def findVolume(project, name):
+        for volume in project.volumes:
+            if volume.name == name:
+                return volume
+        return None
+
+    # class function
+    # Returns a dict of the numbered TIFF files in tiff_dir,
+    # indexed by number (the first number in the file name),
+    # as in the TIFF loader dialog
+    def numberedTiffs(tiff_dir):
+        inttif = {}
+        rec = re.compile(r'[0-9]+')
+        for tif in pathlib.Path(tiff_dir).glob("*.tif"):
+            match = rec.search(tif.name)
+            if match is None:
+                continue
+            inttif[int(match[0])] = tif
+        return {key: inttif[key] for key in sorted(inttif.keys())}
+
+    # Each of the job functions below returns an error string
+    # ("" if no error)
+
+    def importTiffs(self, args):
+        err, project = KhartesBatch.openProject(args.project)
+        if err != "":
+            return err
+        tiff_dir = pathlib.Path(args.tiff_dir).resolve()
+        tifs = KhartesBatch.numberedTiffs(tiff_dir)
+        if len(tifs) == 0:
+            return "No TIFF files found in %s"%tiff_dir
+        keys = list(tifs.keys())
+        iarr = cv2.imread(str(tifs[keys[0]]), cv2.IMREAD_UNCHANGED)
+        if iarr is None:
+            return "TIFF file %s is unreadable"%tifs[keys[0]]
+        # defaults are the full extent of the images, step 1
+        defaults = ([0, iarr.shape[1]-1, 1], [0, iarr.shape[0]-1, 1], [keys[0], keys[-1], 1])
+        ranges = []
+        for given, default in zip((args.x, args.y, args.z), defaults):
+            ranges.append(given if given is not None else default)
+        volume = Volume.createFromTiffs(project, tiff_dir, args.name, ranges, "", tifs, self.message, args.vc_render)
+        if volume is None or not volume.valid:
+            return "Failed to create volume: %s"%volume.error
+        return ""
+
+    def attach(self, args):
+        err, project = KhartesBatch.openProject(args.project)
+        if err != "":
+            return err
+        if self.job == "attach-zarr":
+            volume = CachedZarrVolume.createFromZarr(project, args.directory, args.name, args.vc_render)
+        else:
+            volume = CachedZarrVolume.createFromTiffs(project, args.directory, args.name, args.vc_render)
+        if volume is None or not volume.valid:
+            return "Failed to attach volume: %s"%volume.error
+        return ""
+
+    def export(self, args):
+        pv = ProjectView.open(pathlib.Path(args.project))
+        if not pv.valid:
+            return pv.error
+        project = pv.project
+        volume = pv.cur_volume
+        if args.volume is not None:
+            volume = KhartesBatch.findVolume(project, args.volume)
+            if volume is None:
+                return "Project has no volume named %s"%args.volume
+        if volume is None:
+            return "No volume specified, and the project has no current volume"
+        pv.setCurrentVolume(volume, no_notify=True)
+        pv.updateFragmentViews()
+
+        fvs = []
+        if args.fragments is not None:
+            names = set(args.fragments)
+            fvs = [fv for frag, fv in pv.fragments.items() if frag.name in names]
+            missing = names - set(fv.fragment.name for fv in fvs)
+            if len(missing) > 0:
+                return "Project has no fragment named %s"%(", ".join(sorted(missing)))
+        elif args.all:
+            fvs = list(pv.fragments.values())
+        else:
+            fvs = [fv for fv in pv.fragments.values() if fv.active]
+        if len(fvs) == 0:
+            return "No fragments to export"
+
+        ppm = None
+        if args.ppm is not None:
+            for p in project.ppms:
+                if p.name == args.ppm:
+                    ppm = p
+            if ppm is None:
+                return "Project has no PPM named %s"%args.ppm
+            ppm.loadData()
+        tex_volume = None
+        if args.texture_volume is not None:
+            tex_volume = KhartesBatch.findVolume(project, args.texture_volume)
+            if tex_volume is None or not tex_volume.is_zarr:
+                return "Project has no zarr volume named %s"%args.texture_volume
+
+        output = pathlib.Path(args.output)
+        try:
+            output.parent.mkdir(parents=True, exist_ok=True)
+        except Exception as e:
+            return "Could not create directory %s: %s"%(output.parent, e)
+        Fragment.ExportFrag.max_workers = args.workers
+        return BaseFragment.saveListAsObjMesh(fvs, output, args.infill, ppm, self.progress, tex_volume)
+
+    def ppmLayers(self, args):
+        return PpmLayers.render(args.ppm, args.volume, args.output_dir, args.nmin, args.nmax, args.workers, args.cache_gb, self.progress)
+
+    def stVolume(self, args):
+        return StructureTensorVolume.compute(args.volume, args.output, args.sigma0, args.sigma1, args.chunk, args.workers, args.cache_gb, self.progress)
+
+    # class function
+    def parser():
+        parser = argparse.ArgumentParser(
+                description="Run khartes operations without the GUI")
+        sub = parser.add_subparsers(dest="job", required=True)
+
+        p = sub.add_parser("import-tiffs", help="create a data volume (.nrrd) from a directory of TIFF files")
+        p.add_argument("project", help="khartes project (.khprj directory)")
+        p.add_argument("tiff_dir", help="directory of numbered TIFF files")
+        p.add_argument("name", help="name of the new volume")
+        for axis in ("x", "y", "z"):
+            p.add_argument("--"+axis, type=int, nargs=3, metavar=("MIN", "MAX", "STEP"),
+                    help="%s range, inclusive (default: all, step 1)"%axis)
+        p.add_argument("--vc_render", action="store_true", help="TIFFs are from vc_layers")
+        p.set_defaults(func=KhartesBatch.importTiffs)
+
+        for job, what in (("attach-zarr", "an OME/Zarr data store"), ("attach-tiffs", "a directory of TIFF files")):
+            p = sub.add_parser(job, help="attach the project to %s"%what)
+            p.add_argument("project", help="khartes project (.khprj directory)")
+            p.add_argument("directory", help=what)
+            p.add_argument("name", help="name of the new volume")
+            p.add_argument("--vc_render", action="store_true", help="data is from vc_layers")
+            p.set_defaults(func=KhartesBatch.attach)
+
+        p = sub.add_parser("export", help="export fragments as a mesh (.obj, or .ply)")
+        p.add_argument("project", help="khartes project (.khprj directory)")
+        p.add_argument("output", help="mesh file to create")
+        p.add_argument("--volume", help="volume that defines the fragment surfaces and textures (default: the project's current volume)")
+        p.add_argument("--fragments", nargs="+", metavar="NAME", help="fragments to export (default: the active fragments)")
+        p.add_argument("--all", action="store_true", help="export all fragments")
+        p.add_argument("--infill", type=int, default=16, help="infill spacing, in voxels (default 16; 0 means no infill)")
+        p.add_argument("--ppm", help="export in scroll coordinates, using the project's PPM with this name")
+        p.add_argument("--texture_volume", help="sample the texture at full resolution from the project's zarr volume with this name")
+        p.add_argument("--workers", type=int, default=None, help="number of worker processes (default: number of cpus)")
+        p.set_defaults(func=KhartesBatch.export)
+
+        p = sub.add_parser("ppm-layers", help="render the layers of a surface volume from a PPM file")
+        p.add_argument("ppm", help="PPM file")
+        p.add_argument("volume", help="khartes volume file (.nrrd or .volzarr)")
+        p.add_argument("output_dir", help="directory for the layer TIFF files")
+        p.add_argument("--nmin", type=int, default=-32, help="offset of the first layer along the normal (default -32)")
+        p.add_argument("--nmax", type=int, default=32, help="offset of the last layer along the normal (default 32)")
+        p.add_argument("--workers", type=int, default=None, help="number of worker processes (default: number of cpus)")
+        p.add_argument("--cache_gb", type=float, default=1., help="size of each worker's zarr chunk cache, in Gb (default 1)")
+        p.set_defaults(func=KhartesBatch.ppmLayers)
+
+        p = sub.add_parser("st-volume", help="precompute the 3D structure-tensor field (normals) of a volume")
+        p.add_argument("volume", help="khartes volume file (.nrrd or .volzarr)")
+        p.add_argument("--output", help="zarr directory to create (default: next to the volume file, with the suffix .st.zarr)")
+        p.add_argument("--sigma0", type=float, default=2., help="width of the gaussian derivative, in voxels (default 2)")
+        p.add_argument("--sigma1", type=float, default=8., help="width of the tensor smoothing, in voxels (default 8)")
+        p.add_argument("--chunk", type=int, default=128, help="chunk size, in voxels (default 128)")
+        p.add_argument("--workers", type=int, default=None, help="number of worker processes (default: number of cpus)")
+        p.add_argument("--cache_gb", type=float, default=1., help="size of each worker's zarr chunk cache, in Gb (default 1)")
+        p.set_defaults(func=KhartesBatch.stVolume)
+        return parser
+
+# The guard is needed because worker processes (which are
+# started using "spawn") import this module
+if __name__ == '__main__':
+    args = KhartesBatch.parser().parse_args()
+    # khartes's own messages, including those of worker
+    # processes, are sent to standard error, so that standard
+    # output only carries the JSON messages
+    sys.stdout.flush()
+    out = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    batch = KhartesBatch(args.job, out)
+    batch.emit(status="started")
+    try:
+        err = args.func(batch, args)
+    except Exception as e:
+        err = "%s: %s"%(type(e).__name__, e)
+    if err != "":
+        batch.emit(status="error", error=err)
+        sys.exit(1)
+    batch.emit(status="ok")
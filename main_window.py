@@ -16,7 +16,7 @@ from PyQt5.QtWidgets import (
         QHBoxLayout, 
         QLabel, QLineEdit,
         QMainWindow, QMenuBar, QMessageBox,
-        QPlainTextEdit, QPushButton,
+        QPlainTextEdit, QProgressDialog, QPushButton,
         QSizePolicy,
         QSpacerItem, QSpinBox, QDoubleSpinBox,
         QStatusBar, QStyle, QStyledItemDelegate,
@@ -39,11 +39,13 @@ from tiff_loader import TiffLoader
 from zarr_loader import ZarrLoader
 from data_window import DataWindow, SurfaceWindow
 from project import Project, ProjectView
-from fragment import Fragment, FragmentsModel, FragmentView
+from fragment import Fragment, FragmentView
+from fragments_model import FragmentsModel
 from trgl_fragment import TrglFragment, TrglFragmentView
 from base_fragment import BaseFragment, BaseFragmentView
-from volume import (
-        Volume, VolumesModel, 
+from volume import Volume
+from volumes_model import (
+        VolumesModel, 
         DirectionSelectorDelegate,
         ColorSelectorDelegate)
 from volume_zarr import CachedZarrVolume
@@ -152,6 +154,9 @@ class InfillDialog(QDialog):
         super(InfillDialog, self).__init__(parent)
         project = main_window.project_view.project
         self.ppms = project.ppms
+        # volumes that the texture can be sampled from
+        # at full resolution
+        self.tex_volumes = [vol for vol in project.volumes if vol.is_zarr]
         needs_ppm = main_window.canUsePpm()
         self.needs_ppm = needs_ppm
         self.needs_infill = needs_infill
@@ -190,6 +195,17 @@ class InfillDialog(QDialog):
             self.ppm_cb.setEnabled(False)
             hlayout.addWidget(self.ppm_cb)
             hlayout.addStretch()
+        if self.needs_infill and len(self.tex_volumes) > 0:
+            hlayout = QHBoxLayout()
+            vlayout.addLayout(hlayout)
+            hlayout.addWidget(QLabel("Texture from:"))
+            self.tex_cb = QComboBox()
+            self.tex_cb.addItem("(current volume)")
+            for vol in self.tex_volumes:
+                self.tex_cb.addItem(vol.name+" (full resolution)")
+            self.tex_cb.setCurrentIndex(0)
+            hlayout.addWidget(self.tex_cb)
+            hlayout.addStretch()
         bbox = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
         bbox.accepted.connect(self.accepted)
         bbox.rejected.connect(self.rejected)
@@ -218,6 +234,14 @@ class InfillDialog(QDialog):
             return None
         return self.ppms[self.ppm_cb.currentIndex()]
 
+    def getTextureVolume(self):
+        if not self.needs_infill or len(self.tex_volumes) == 0:
+            return None
+        index = self.tex_cb.currentIndex()
+        if index <= 0:
+            return None
+        return self.tex_volumes[index-1]
+
     def accepted(self):
         self.is_accepted = True
         value = self.getValue()
@@ -765,6 +789,10 @@ class MainWindow(QMainWindow):
 
     appname = "χάρτης"
 
+    # how often the edit journal is folded into
+    # the fragment files
+    autosave_interval_ms = 60*1000
+
     draw_settings_defaults = {
         "node": {
             "width": 5,
@@ -1002,6 +1030,11 @@ class MainWindow(QMainWindow):
         self.zarr_timer.setSingleShot(True)
         self.zarr_timer.timeout.connect(self.zarrTimerCallback)
         self.zarr_signal.connect(self.zarrSlot)
+        # periodically folds the edit journal into the
+        # fragment files (see Project.compactJournal)
+        self.autosave_timer = QTimer()
+        self.autosave_timer.timeout.connect(self.autosaveTimerCallback)
+        self.autosave_timer.start(MainWindow.autosave_interval_ms)
         self.setZarrMaxCacheSize(self.draw_settings["zarr"]["max_cache_size_gb"], False)
         # self.setDrawSettingsToDefaults()
         # command line arguments
@@ -1592,6 +1625,7 @@ class MainWindow(QMainWindow):
             return
         # mf = mfv.fragment
         mfv.moveInK(step)
+        pv.project.journalRecord("replace", mfv.fragment, pts=mfv.fragment.gpoints)
         self.drawSlices()
 
     def moveActiveFragmentAlongNormals(self, step):
@@ -1607,6 +1641,7 @@ class MainWindow(QMainWindow):
             return
         # mf = mfv.fragment
         mfv.moveAlongNormals(step)
+        pv.project.journalRecord("replace", mfv.fragment, pts=mfv.fragment.gpoints)
         self.drawSlices()
 
     def copyActiveFragment(self):
@@ -1635,6 +1670,7 @@ class MainWindow(QMainWindow):
         # frag.gpoints = np.copy(mf.gpoints)
         frag = mf.createCopy(name)
         print("created fragment %s from %s"%(frag.name, mf.name))
+        pv.project.journalRecord("create", frag)
         self.fragments_table.model().beginResetModel()
         pv.project.addFragment(frag)
         self.setFragments()
@@ -1688,6 +1724,7 @@ class MainWindow(QMainWindow):
         frag.setColor(Utils.getNextColor(), no_notify=True)
         frag.valid = True
         print("created fragment %s"%frag.name)
+        pv.project.journalRecord("create", frag)
         self.fragments_table.model().beginResetModel()
         # print("start cafv")
         # if len(pv.activeFragmentViews(unaligned_ok=True)) == 1:
@@ -1726,6 +1763,9 @@ class MainWindow(QMainWindow):
         self.fragments_table.model().beginResetModel()
         result = fragment_view.movePoint(index, new_tijk)
         self.fragments_table.model().endResetModel()
+        if result:
+            frag = fragment_view.fragment
+            self.project_view.project.journalRecord("move", frag, index, frag.gpoints[index])
         return result
 
     def addPointToCurrentFragment(self, tijk):
@@ -1733,17 +1773,47 @@ class MainWindow(QMainWindow):
         if cur_frag_view is None:
             print("no current fragment view set")
             return
+        frag = cur_frag_view.fragment
+        npts = len(frag.gpoints)
         self.fragments_table.model().beginResetModel()
-        cur_frag_view.addPoint(tijk)
+        index = cur_frag_view.addPoint(tijk)
         self.fragments_table.model().endResetModel()
+        if index is not None:
+            op = "add" if index >= npts else "move"
+            self.project_view.project.journalRecord(op, frag, index, frag.gpoints[index])
+
+    # Adds a batch of points (a list of tijks) to the current
+    # fragment; the fragment is updated only once
+    def addPointsToCurrentFragment(self, tijks):
+        if len(tijks) == 0:
+            return
+        cur_frag_view = self.project_view.mainActiveVisibleFragmentView()
+        if cur_frag_view is None:
+            print("no current fragment view set")
+            return
+        frag = cur_frag_view.fragment
+        npts = len(frag.gpoints)
+        self.fragments_table.model().beginResetModel()
+        indexes = cur_frag_view.addPoints(tijks)
+        self.fragments_table.model().endResetModel()
+        project = self.project_view.project
+        moved = sorted(set(index for index in indexes if index is not None and index < npts))
+        for index in moved:
+            project.journalRecord("move", frag, index, frag.gpoints[index])
+        for index in range(npts, len(frag.gpoints)):
+            project.journalRecord("add", frag, index, frag.gpoints[index])
 
     def deleteNearbyNode(self):
         pv = self.project_view
         if pv.nearby_node_fv is None or pv.nearby_node_index < 0:
             print("deleteNearbyNode: no current nearby node")
             return
+        frag = pv.nearby_node_fv.fragment
+        npts = len(frag.gpoints)
         self.fragments_table.model().beginResetModel()
         pv.nearby_node_fv.deletePointByIndex(pv.nearby_node_index)
+        if len(frag.gpoints) < npts:
+            pv.project.journalRecord("delete", frag, pv.nearby_node_index)
         pv.nearby_node_fv = None
         pv.nearby_node_index = -1
         self.fragments_table.model().endResetModel()
@@ -1831,6 +1901,8 @@ class MainWindow(QMainWindow):
         if not self.warnIfNotSaved("exit khartes"):
             # print("Canceled by user after warning")
             return
+        if self.project_view is not None:
+            self.project_view.project.stopJournal(True)
         # if self.tiff_loader is not None:
         #     self.tiff_loader.close()
         e.accept()
@@ -2245,10 +2317,7 @@ class MainWindow(QMainWindow):
 
     def loadObjFiles(self, fnames):
         frags = []
-        for robj in fnames:
-            obj = Path(robj)
-            print ("obj:", obj.name)
-            trgl_frags = TrglFragment.load(obj)
+        for trgl_frags in TrglFragment.loadList(fnames):
             if trgl_frags is None or len(trgl_frags) == 0:
                 continue
             trgl_frag = trgl_frags[0]
@@ -2313,7 +2382,8 @@ class MainWindow(QMainWindow):
         if sdir is None:
             sdir = ""
 
-        filename_tuple = QFileDialog.getSaveFileName(self, "Save Fragment as Mesh", sdir, "Mesh *.obj")
+        ply_filter = "Binary PLY mesh *.ply"
+        filename_tuple = QFileDialog.getSaveFileName(self, "Save Fragment as Mesh", sdir, "Mesh *.obj;;"+ply_filter)
         print("user selected", filename_tuple)
         # [0] is filename, [1] is the selector used
         filename = filename_tuple[0]
@@ -2322,11 +2392,14 @@ class MainWindow(QMainWindow):
             return
 
         pname = Path(filename)
+        if filename_tuple[1] == ply_filter and pname.suffix.lower() != ".ply":
+            pname = pname.with_name(pname.name+".ply")
 
         name = pname.name
 
         project = self.project_view.project
         ppm = None
+        tex_volume = None
         infill = 0
         if needs_infill or self.canUsePpm():
             dialog = InfillDialog(self, needs_infill)
@@ -2336,6 +2409,7 @@ class MainWindow(QMainWindow):
                 return
             infill = dialog.getValue()
             ppm = dialog.getPpm()
+            tex_volume = dialog.getTextureVolume()
             ppm_name = "(None)"
             if ppm is not None:
                 ppm_name = ppm.name
@@ -2347,10 +2421,22 @@ class MainWindow(QMainWindow):
             ppm.loadData()
             ppm_loading = None
 
-        loading = self.showLoading("Saving obj file...")
-        err = BaseFragment.saveListAsObjMesh(fvs, pname, infill, ppm)
+        progress_dialog = QProgressDialog("Exporting %d fragments..."%len(fvs), "Cancel", 0, 1000, self)
+        progress_dialog.setWindowTitle("Save fragment as mesh")
+        progress_dialog.setWindowModality(Qt.WindowModal)
+        progress_dialog.setMinimumDuration(500)
+
+        # returns False if the user has cancelled the export
+        def progress(done, total):
+            progress_dialog.setValue(int(1000*done/max(total,1)))
+            self.app.processEvents()
+            return not progress_dialog.wasCanceled()
+
+        err = BaseFragment.saveListAsObjMesh(fvs, pname, infill, ppm, progress, tex_volume)
+        cancelled = progress_dialog.wasCanceled()
+        progress_dialog.close()
 
-        if err != "":
+        if err != "" and not cancelled:
             msg = QMessageBox()
             msg.setWindowTitle("Save fragment as mesh")
             msg.setIcon(QMessageBox.Critical)
@@ -2656,10 +2742,30 @@ class MainWindow(QMainWindow):
         self.drawSlices()
 
     def fragmentUndo(self):
+        self.fragmentUndoRedo(False)
+
+    def fragmentRedo(self):
+        self.fragmentUndoRedo(True)
+
+    # Undoes (or redoes) the most recent edit of each
+    # active fragment, recording the changes in the journal
+    def fragmentUndoRedo(self, redo):
         afvs = self.project_view.activeFragmentViews(unaligned_ok=True)
+        project = self.project_view.project
+        self.fragments_table.model().beginResetModel()
         for fragment_view in afvs:
-            if fragment_view.active:
-                fragment_view.popFragmentState()
+            if not fragment_view.active:
+                continue
+            if redo:
+                changes = fragment_view.redo()
+            else:
+                changes = fragment_view.undo()
+            for op, index, pt in changes:
+                if op == "replace":
+                    project.journalRecord(op, fragment_view.fragment, pts=pt)
+                else:
+                    project.journalRecord(op, fragment_view.fragment, index, pt)
+        self.fragments_table.model().endResetModel()
         self.drawSlices()
 
     def setFragmentVisibility(self, fragment, visible):
@@ -2710,6 +2816,9 @@ class MainWindow(QMainWindow):
     def unsetProjectView(self):
         if self.project_view == None:
             return
+        # by this point, the user has either saved the project,
+        # or agreed to discard the unsaved changes
+        self.project_view.project.stopJournal(True)
         self.setVolume(None, no_notify=True)
         self.live_zsurf_update = True
         self.live_zsurf_update_button.setChecked(self.live_zsurf_update)
@@ -2728,8 +2837,14 @@ class MainWindow(QMainWindow):
         self.app.processEvents()
 
 
+    def autosaveTimerCallback(self):
+        if self.project_view is None:
+            return
+        self.project_view.project.compactJournal()
+
     def setProjectView(self, project_view):
         project_view.project.modified_callback = self.projectModifiedCallback
+        project_view.project.startJournal()
         self.project_view = project_view
         self.volumes_model = VolumesModel(project_view, self)
         self.volumes_table.setModel(self.volumes_model)
@@ -2802,8 +2917,10 @@ class MainWindow(QMainWindow):
             if w != self and method is not None:
                 w.dwKeyPressEvent(e)
         elif e.modifiers() == Qt.ControlModifier and e.key() == Qt.Key_Z:
-            # Undo lasted node added, if possible
+            # Undo last edit of the active fragments, if possible
             self.fragmentUndo()
+        elif (e.modifiers() == Qt.ControlModifier and e.key() == Qt.Key_Y) or (e.modifiers() == (Qt.ControlModifier | Qt.ShiftModifier) and e.key() == Qt.Key_Z):
+            self.fragmentRedo()
         else:
             w = QApplication.widgetAt(QCursor.pos())
             method = getattr(w, "dwKeyPressEvent", None)
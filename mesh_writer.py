@@ -0,0 +1,73 @@
+import numpy as np
+
+# Bulk writers for mesh files.  Rather than formatting one
+# line at a time, each block of rows is formatted with a single
+# string operation, so writing speed is limited mostly by
+# the disk.
+class MeshWriter():
+
+    # class variable
+    # number of rows formatted at one time; limits
+    # the amount of memory used for formatting
+    rows_per_chunk = 1<<16
+
+    # class function
+    # Writes one line per row of arr, using line_fmt (a printf-style
+    # format, without the trailing newline) with all the values
+    # of the row.  of is a text-mode file.
+    def writeRows(of, line_fmt, arr):
+        arr = np.asarray(arr)
+        if arr.ndim == 1:
+            arr = arr.reshape(-1,1)
+        line_fmt += "\n"
+        n = MeshWriter.rows_per_chunk
+        for i in range(0, len(arr), n):
+            chunk = arr[i:i+n]
+            of.write((line_fmt*len(chunk)) % tuple(chunk.ravel().tolist()))
+
+    # class function
+    # Writes a binary (little-endian) PLY file.
+    # tvrts (texture coordinates, one per vertex) and
+    # normals are optional.
+    # Returns an error string ("" if no error).
+    def writePly(filename, vrts, trgls, tvrts=None, normals=None, comments=()):
+        nv = len(vrts)
+        fields = [('x','<f4'), ('y','<f4'), ('z','<f4')]
+        if normals is not None:
+            fields.extend([('nx','<f4'), ('ny','<f4'), ('nz','<f4')])
+        if tvrts is not None:
+            fields.extend([('s','<f4'), ('t','<f4')])
+        varr = np.zeros(nv, dtype=fields)
+        varr['x'] = vrts[:,0]
+        varr['y'] = vrts[:,1]
+        varr['z'] = vrts[:,2]
+        if normals is not None:
+            varr['nx'] = normals[:,0]
+            varr['ny'] = normals[:,1]
+            varr['nz'] = normals[:,2]
+        if tvrts is not None:
+            varr['s'] = tvrts[:,0]
+            varr['t'] = tvrts[:,1]
+        farr = np.zeros(len(trgls), dtype=[('n','u1'), ('v','<i4',(3,))])
+        farr['n'] = 3
+        farr['v'] = trgls
+
+        header = ["ply", "format binary_little_endian 1.0"]
+        for comment in comments:
+            header.append("comment %s"%comment)
+        header.append("element vertex %d"%nv)
+        for name, _ in fields:
+            header.append("property float %s"%name)
+        header.append("element face %d"%len(trgls))
+        header.append("property list uchar int vertex_indices")
+        header.append("end_header")
+        try:
+            with open(filename, "wb") as of:
+                of.write(("\n".join(header)+"\n").encode("utf-8"))
+                varr.tofile(of)
+                farr.tofile(of)
+        except Exception as e:
+            err = "Could not write %s: %s"%(str(filename), e)
+            print(err)
+            return err
+        return ""
@@ -0,0 +1,295 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+# Reads the geometry in an OBJ file.  Rather than parsing the
+# file line by line in Python, the file is read in large blocks,
+# and each block is parsed with vectorized numpy operations
+# (in parallel, for large files).
+# Only the records that khartes uses are parsed:
+# v (vertex; color, if present, is ignored), vt (texture vertex),
+# vn (vertex normal), f (triangles only; for faces of the form
+# v/vt/vn, v//vn, or v/vt, only the vertex index is kept),
+# and comments.
+class ObjReader():
+
+    # class variable
+    # approximate size, in bytes, of the blocks that the
+    # file is parsed in (each block is adjusted to begin
+    # and end on a line boundary)
+    block_size = 16*1024*1024
+    # starting the worker processes takes a second or two
+    # (each one imports the main module), so the pool is only
+    # used if the files contain at least this many blocks
+    # in total
+    pool_min_blocks = 4
+
+    def __init__(self):
+        self.vrts = np.zeros((0,3), dtype=np.float32)
+        self.tvrts = np.zeros((0,2), dtype=np.float32)
+        self.normals = np.zeros((0,3), dtype=np.float32)
+        self.trgls = np.zeros((0,3), dtype=np.int32)
+        # list of strings, with the leading '#' removed
+        self.comments = []
+        self.valid = False
+        self.error = "no error message set"
+
+    def createErrorObjReader(err):
+        rdr = ObjReader()
+        rdr.error = err
+        return rdr
+
+    # class function
+    # Returns an ObjReader; check the valid flag
+    # and the error string.
+    def read(obj_file, max_workers=None):
+        return ObjReader.readList([obj_file], max_workers)[0]
+
+    # class function
+    # Reads a list of obj files; returns a list of ObjReaders,
+    # in the same order as the input list.
+    # Each file is divided into ranges of about block_size bytes.
+    # If the files are large enough (see pool_min_blocks), the
+    # ranges are parsed in parallel by a pool of max_workers
+    # processes (default is the number of cpus); otherwise
+    # they are parsed in the calling process.
+    def readList(obj_files, max_workers=None):
+        rdrs = []
+        jobs = []
+        total_size = 0
+        for i, obj_file in enumerate(obj_files):
+            fstr = str(obj_file)
+            try:
+                size = os.path.getsize(obj_file)
+            except Exception as e:
+                err = "Could not open obj file %s: %s"%(fstr, e)
+                print(err)
+                rdrs.append(ObjReader.createErrorObjReader(err))
+                continue
+            rdrs.append(ObjReader())
+            total_size += size
+            bs = ObjReader.block_size
+            for start in range(0, max(size, 1), bs):
+                jobs.append((i, fstr, start, min(start+bs, size)))
+
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        max_workers = min(max_workers, len(jobs))
+        if total_size < ObjReader.pool_min_blocks*ObjReader.block_size:
+            max_workers = 1
+        if max_workers > 1:
+            # "spawn" rather than "fork", because the calling
+            # process may be running Qt
+            ctx = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=max_workers, mp_context=ctx) as executor:
+                results = list(executor.map(ObjReader.parseRange,
+                    [job[1] for job in jobs],
+                    [job[2] for job in jobs],
+                    [job[3] for job in jobs]))
+        else:
+            results = [ObjReader.parseRange(*job[1:]) for job in jobs]
+
+        parts = {}
+        for job, result in zip(jobs, results):
+            parts.setdefault(job[0], []).append(result)
+        for i, rdr in enumerate(rdrs):
+            if i not in parts:
+                continue
+            fstr = str(obj_files[i])
+            errs = [part[0] for part in parts[i] if part[0] != ""]
+            if len(errs) > 0:
+                err = "obj file %s: %s"%(fstr, errs[0])
+                print(err)
+                rdrs[i] = ObjReader.createErrorObjReader(err)
+                continue
+            rdr.vrts = np.concatenate([rdr.vrts]+[part[1] for part in parts[i]], axis=0)
+            rdr.tvrts = np.concatenate([rdr.tvrts]+[part[2] for part in parts[i]], axis=0)
+            rdr.normals = np.concatenate([rdr.normals]+[part[3] for part in parts[i]], axis=0)
+            rdr.trgls = np.concatenate([rdr.trgls]+[part[4] for part in parts[i]], axis=0)
+            for part in parts[i]:
+                rdr.comments.extend(part[5])
+            rdr.valid = True
+        return rdrs
+
+    # class function
+    # Returns the bytes of all the lines that begin
+    # in the byte range [start, end) of the file
+    def readRange(fd, start, end):
+        if start > 0:
+            fd.seek(start-1)
+            data = fd.read(end-start+1)
+            # the first line that begins in the range is the
+            # one following the first newline
+            first = data.find(b'\n')
+            if first < 0:
+                return b''
+            data = data[first+1:]
+            if len(data) == 0:
+                return b''
+        else:
+            data = fd.read(end)
+        if data[-1:] != b'\n':
+            # extend the data to the end of the last line
+            pieces = [data]
+            while True:
+                piece = fd.read(64*1024)
+                if len(piece) == 0:
+                    pieces.append(b'\n')
+                    break
+                index = piece.find(b'\n')
+                if index >= 0:
+                    pieces.append(piece[:index+1])
+                    break
+                pieces.append(piece)
+            data = b''.join(pieces)
+        return data
+
+    # class function
+    # Parses the lines that begin in the byte range [start, end)
+    # of the file.  Runs in a worker process, so it returns
+    # plain arrays:
+    # (err, vrts, tvrts, normals, trgls, comments)
+    def parseRange(fstr, start, end):
+        vrtl = []
+        tvrtl = []
+        nrml = []
+        trgll = []
+        rdr = ObjReader()
+        try:
+            with open(fstr, "rb") as fd:
+                data = ObjReader.readRange(fd, start, end)
+        except Exception as e:
+            return ("could not read: %s"%e, None, None, None, None, None)
+        err = rdr.parseBlock(data, vrtl, tvrtl, nrml, trgll)
+        if err != "":
+            return (err, None, None, None, None, None)
+        return ("",
+                np.concatenate([rdr.vrts]+vrtl, axis=0),
+                np.concatenate([rdr.tvrts]+tvrtl, axis=0),
+                np.concatenate([rdr.normals]+nrml, axis=0),
+                np.concatenate([rdr.trgls]+trgll, axis=0),
+                rdr.comments)
+
+    # class function
+    # Given the bytes of a set of lines (one record per line),
+    # and a boolean per line that is True for the lines to
+    # be extracted, returns the bytes of the selected lines,
+    # concatenated into a single uint8 array, together with
+    # the start index of each line in that array.
+    # The first plen bytes of each line (the record type)
+    # are replaced by blanks.
+    def selectLines(arr, starts, lengths, sel, plen):
+        slengths = lengths[sel]
+        sub = arr[np.repeat(sel, lengths)]
+        sstarts = np.cumsum(slengths) - slengths
+        for k in range(plen):
+            sub[sstarts+k] = 32
+        return sub, sstarts
+
+    # class function
+    # Returns the number of whitespace-delimited tokens in each
+    # of the lines in sub (lines start at sstarts).
+    # Space, tab, newline and carriage return are all <= 32
+    def tokenCounts(sub, sstarts):
+        ws = (sub <= 32)
+        tok_starts = np.empty(len(sub), dtype=np.bool_)
+        tok_starts[0] = not ws[0]
+        np.greater(ws[:-1], ws[1:], out=tok_starts[1:])
+        tok_pos = np.flatnonzero(tok_starts)
+        first_tok = np.searchsorted(tok_pos, sstarts)
+        return np.diff(np.append(first_tok, len(tok_pos)))
+
+    # class function
+    # Parses the numbers in the selected lines.  If a line
+    # consists of n groups (for instance, n=3 for the vertices
+    # of a triangle), and each group contains k numbers separated
+    # by slashes ("12/12/12"), only the first number of each
+    # group is kept.
+    # Returns an array containing the first number of the first
+    # ncols groups of each line that has an acceptable number of
+    # groups, or an error string.
+    def parseValues(sub, sstarts, ncols, ok_counts, dtype):
+        counts = ObjReader.tokenCounts(sub, sstarts)
+        good = np.isin(counts, ok_counts)
+        nvalues = counts
+        slashes = (sub == 47)
+        if slashes.any():
+            sub[slashes] = 32
+            nvalues = ObjReader.tokenCounts(sub, sstarts)
+        values = np.fromstring(sub.tobytes(), dtype=dtype, sep=' ')
+        if len(values) != nvalues.sum():
+            return "could not parse values", None
+        offsets = np.cumsum(nvalues) - nvalues
+        # number of values in each group
+        k = nvalues // np.maximum(counts, 1)
+        indices = offsets[good, np.newaxis] + k[good, np.newaxis]*np.arange(ncols)
+        return "", values[indices]
+
+    # Parses a block of text, consisting of complete lines, and
+    # appends the results to the given lists.
+    # Returns an error string ("" if no error).
+    def parseBlock(self, data, vrtl, tvrtl, nrml, trgll):
+        arr = np.frombuffer(data, dtype=np.uint8)
+        nls = np.flatnonzero(arr == 10)
+        if len(nls) == 0:
+            return ""
+        starts = np.concatenate(([0], nls[:-1]+1))
+        # Record types are recognized only at the start of a
+        # line, so leading blanks (which are rare, but are
+        # accepted by line-by-line readers) are removed first
+        c0 = arr[starts]
+        if ((c0 == 32) | (c0 == 9)).any():
+            data = b'\n'.join(line.lstrip(b' \t') for line in data.split(b'\n'))
+            arr = np.frombuffer(data, dtype=np.uint8)
+            nls = np.flatnonzero(arr == 10)
+        starts = np.concatenate(([0], nls[:-1]+1))
+        # lengths include the newline
+        lengths = nls - starts + 1
+        # pad so that the first three characters of
+        # every line can be examined, even at the end
+        parr = np.concatenate((arr, np.full(3, 10, dtype=np.uint8)))
+        c0 = parr[starts]
+        c1 = parr[starts+1]
+        c2 = parr[starts+2]
+        ws1 = (c1 == 32) | (c1 == 9)
+        ws2 = (c2 == 32) | (c2 == 9)
+        is_v = (c0 == ord('v'))
+
+        comments = np.flatnonzero(c0 == ord('#'))
+        for i in comments:
+            line = data[starts[i]+1:nls[i]]
+            self.comments.append(line.decode('utf-8', errors='replace').strip())
+
+        specs = [
+            # (line selector, prefix length, ncols, acceptable
+            #   numbers of values per line, dtype, list)
+            (is_v & ws1, 1, 3, (3,6), np.float64, vrtl),
+            (is_v & (c1 == ord('t')) & ws2, 2, 2, (2,), np.float64, tvrtl),
+            (is_v & (c1 == ord('n')) & ws2, 2, 3, (3,), np.float64, nrml),
+            ((c0 == ord('f')) & ws1, 1, 3, (3,), np.int64, trgll),
+            ]
+        for sel, plen, ncols, ok_counts, dtype, olist in specs:
+            if not sel.any():
+                continue
+            sub, sstarts = ObjReader.selectLines(arr, starts, lengths, sel, plen)
+            err, values = ObjReader.parseValues(sub, sstarts, ncols, ok_counts, dtype)
+            if err != "":
+                return err
+            if olist is trgll:
+                # obj indices start at 1
+                values = (values-1).astype(np.int32)
+            else:
+                values = values.astype(np.float32)
+            olist.append(values)
+        return ""
+
+    # Returns the value from the last comment of the form
+    # "# key: value", or "" if none is found
+    def commentValue(self, key):
+        value = ""
+        for comment in self.comments:
+            words = comment.split()
+            if len(words) > 1 and words[0] == key+":":
+                value = words[1]
+        return value
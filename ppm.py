@@ -1,6 +1,5 @@
 import pathlib
 import numpy as np
-from scipy.interpolate import RegularGridInterpolator
 
 class Ppm():
 
@@ -8,9 +7,9 @@ class Ppm():
         self.data = None
         self.ijks = None
         self.normals = None
-        self.ijk_interpolator = None
-        self.normal_interpolator = None
         self.data_header = None
+        # byte offset of the data (the end of the header)
+        self.data_offset = 0
         self.valid = False
         self.error = "no error message set"
 
@@ -21,33 +20,57 @@ class Ppm():
 
     no_data = (0.,0.,0.)
 
+    # class function
+    # Bilinear interpolation of arr (an array of shape (h,w,n),
+    # typically memory-mapped) at the points ijs (shape (m,2),
+    # not necessarily integers).  Only the 4 neighbors of each
+    # point are read.  Points outside of arr are given the value 0.
+    # Returns an array of shape (m,n).
+    def bilinear(arr, ijs):
+        h, w = arr.shape[:2]
+        out = np.zeros((len(ijs), arr.shape[2]), dtype=np.float64)
+        if h < 2 or w < 2:
+            return out
+        inside = ((ijs[:,0] >= 0) & (ijs[:,0] <= h-1) &
+                (ijs[:,1] >= 0) & (ijs[:,1] <= w-1))
+        ijs = ijs[inside]
+        i0s = np.minimum(np.floor(ijs[:,0]).astype(np.int64), h-2)
+        j0s = np.minimum(np.floor(ijs[:,1]).astype(np.int64), w-2)
+        fi = (ijs[:,0]-i0s)[:,np.newaxis]
+        fj = (ijs[:,1]-j0s)[:,np.newaxis]
+        out[inside] = (
+                (1.-fi)*((1.-fj)*arr[i0s,j0s] + fj*arr[i0s,j0s+1]) +
+                fi*((1.-fj)*arr[i0s+1,j0s] + fj*arr[i0s+1,j0s+1]))
+        return out
+
+    # ijs is an array of (row, column) positions in the ppm
+    def ijksAt(self, ijs):
+        return Ppm.bilinear(self.ijks, ijs)
+
+    def normalsAt(self, ijs):
+        return Ppm.bilinear(self.normals, ijs)
+
     # lijk (layer ijk) is in layer's global coordinates
     def layerIjksToScrollIjks(self, lijks):
         print("litsi")
         if self.data is None:
             print("litsi no data")
             return lijks
-        '''
-        li,lj,lk = lijk
-        if li < 0 or lj < 0:
-            return Ppm.no_data
-        if li >= self.width:
-            return Ppm.no_data
-        if lj >= self.height:
-            return Ppm.no_data
-        '''
-        # sijk = np.zeros((lijk.shape), dtype=lijk.dtype)
-        # sijks = self.ijk_interpolator(lijks[:,0:2])
         ijs = lijks[:,(2,0)]
         ks = lijks[:,1,np.newaxis]
-        sijks = self.ijk_interpolator(ijs)
-        norms = self.normal_interpolator(ijs)
+        # the ijks and normals are interpolated together
+        values = Ppm.bilinear(self.data, ijs)
+        sijks = values[:,:3]
+        norms = values[:,3:]
         print(lijks.shape, sijks.shape, norms.shape, ks.shape)
         sijks += norms*(ks-32)
         return sijks
 
-
-    def loadData(self):
+    # The data is memory-mapped rather than read, so only the
+    # parts that are actually used are loaded.  If dtype is
+    # np.float32, the data is instead read and converted, which
+    # uses half the memory of the original float64 data.
+    def loadData(self, dtype=np.float64):
         if self.data is not None:
             return
         print("reading data from %s for %s"%(str(self.path), self.name))
@@ -60,27 +83,12 @@ class Ppm():
             return Ppm.createErrorPpm(err)
 
         try:
-            fd = self.path.open("rb")
+            lbd = self.path.stat().st_size - self.data_offset
         except Exception as e:
             err="Failed to open ppm file %s: %s"%(fstr, e)
             print(err)
             return Ppm.createErrorPpm(err)
 
-        try:
-            bdata = fd.read()
-        except Exception as e:
-            err="Failed to read ppm file %s: %s"%(fstr, e)
-            print(err)
-            return Ppm.createErrorPpm(err)
-
-        index = bdata.find(b'<>\n')
-        if index < 0:
-            err="Ppm file %s does not have a header"%fstr
-            print(err)
-            return Ppm.createErrorPpm(err)
-
-        bdata = bdata[index+3:]
-        lbd = len(bdata)
         height = self.height
         width = self.width
         le = height*width*8*6
@@ -89,19 +97,19 @@ class Ppm():
             print(err)
             return Ppm.createErrorPpm(err)
 
-        raw = np.frombuffer(bdata, dtype=np.float64)
-        self.data = np.reshape(raw, (height,width,6))
+        try:
+            data = np.memmap(self.path, dtype='<f8', mode='r', offset=self.data_offset, shape=(height,width,6))
+            if dtype != np.float64:
+                data = data.astype(dtype)
+        except Exception as e:
+            err="Failed to read ppm file %s: %s"%(fstr, e)
+            print(err)
+            return Ppm.createErrorPpm(err)
+
+        self.data = data
         self.ijks = self.data[:,:,:3]
         self.normals = self.data[:,:,3:]
         print(self.ijks.shape, self.normals.shape)
-        # print(self.ijks[0,0,:],self.normals[0,0,:])
-        # print(self.ijks[3000,3000,:],self.normals[3000,3000,:])
-        ii = np.arange(height)
-        jj = np.arange(width)
-        self.ijk_interpolator = RegularGridInterpolator((ii, jj), self.ijks, fill_value=0., bounds_error=False)
-        self.normal_interpolator = RegularGridInterpolator((ii, jj), self.normals, fill_value=0., bounds_error=False)
-
-
 
     # reads and loads the header of the ppm file
     def loadPpm(filename):
@@ -188,6 +196,7 @@ class Ppm():
         ppm.width = width
         ppm.path = filename
         ppm.name = filename.stem
+        ppm.data_offset = index+3
         print("created ppm %s width %d height %d"%(ppm.name, ppm.width, ppm.height))
         return ppm
 
@@ -0,0 +1,200 @@
+import os
+import sys
+import pathlib
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+import tifffile
+from ppm import Ppm
+from volume import Volume
+from volume_zarr import CachedZarrVolume
+
+# Renders the layers of a surface volume from a PPM: layer n
+# (nmin <= n <= nmax) is the image formed by sampling the data
+# volume at the PPM's positions, each displaced n voxels along
+# the PPM's normal.  There is one uint16 TIFF file per layer,
+# with the same width and height as the PPM.
+# The PPM is processed in bands of rows.  Each band is rendered
+# in a worker process, which samples the volume (any type of
+# khartes volume: NRRD, or zarr/TIFF through the chunk cache),
+# and writes its rows directly into the (memory-mapped) layer
+# files, so no process ever holds all of the layers in memory.
+class PpmLayers():
+
+    # class variable
+    # approximate number of PPM pixels in a band
+    pixels_per_band = 1<<16
+
+    # class variable
+    # in a worker process, set by initWorker to
+    # (ppm, volume, layers, nrange)
+    worker = None
+
+    # class function
+    # Loads a khartes volume file (.nrrd or .volzarr), and,
+    # if load_data is True, the data of an NRRD volume, which
+    # is memory-mapped if possible (see Volume.mapData); zarr
+    # data is read as needed.  Returns the volume; check the
+    # valid flag and the error string.
+    def loadVolume(path, load_data=True):
+        path = pathlib.Path(path)
+        if path.suffix == ".volzarr":
+            return CachedZarrVolume.loadFile(path)
+        volume = Volume.loadNRRD(path)
+        if volume.valid and load_data:
+            volume.mapData()
+        return volume
+
+    # class function
+    def layerPaths(out_dir, nmin, nmax):
+        return [pathlib.Path(out_dir) / ("%02d.tif"%i) for i in range(nmax-nmin+1)]
+
+    # class function
+    # Runs in each worker process (and, if there is no pool,
+    # in the calling process).  cache_gb, if not None, is the
+    # size of the zarr chunk cache.
+    def initWorker(ppm_path, volume_path, layer_paths, nmin, nmax, cache_gb=None):
+        if cache_gb is not None:
+            CachedZarrVolume.max_mem_gb = cache_gb
+        ppm = Ppm.loadPpm(pathlib.Path(ppm_path))
+        ppm.loadData()
+        volume = PpmLayers.loadVolume(volume_path)
+        layers = [tifffile.memmap(str(lpath), mode='r+') for lpath in layer_paths]
+        nrange = np.arange(nmin, nmax+1)
+        PpmLayers.worker = (ppm, volume, layers, nrange)
+
+    # class function
+    # Renders rows r0 to r1 of every layer.
+    # Returns the number of rows rendered.
+    def renderBand(r0, r1):
+        ppm, volume, layers, nrange = PpmLayers.worker
+        ijks = np.asarray(ppm.ijks[r0:r1], dtype=np.float64)
+        normals = np.asarray(ppm.normals[r0:r1], dtype=np.float64)
+        # PPM pixels that are not on the surface have
+        # zero normals
+        valid = (normals != 0).any(axis=2)
+        vijks = ijks[valid]
+        vnormals = normals[valid]
+        # all the layers are sampled at once, so that each
+        # part of the volume is read only once per band
+        gps = vijks[np.newaxis,:,:] + nrange[:,np.newaxis,np.newaxis]*vnormals[np.newaxis,:,:]
+        values = volume.sampleGlobalPositions(gps.reshape(-1,3))
+        values = np.minimum(np.rint(values), 65535).astype(np.uint16).reshape(len(nrange), -1)
+        band = np.zeros(valid.shape, dtype=np.uint16)
+        for layer, lvalues in zip(layers, values):
+            band[valid] = lvalues
+            layer[r0:r1] = band
+            layer.flush()
+        return r1-r0
+
+    # class function
+    # Renders the layers of the surface defined by the PPM file
+    # ppm_path, sampling the volume file volume_path, into
+    # out_dir (which is created if necessary).
+    # max_workers is the number of worker processes (default is
+    # the number of cpus).
+    # progress, if not None, is called as progress(done, total),
+    # and should return False to cancel the operation.
+    # Returns an error string ("" if no error).
+    def render(ppm_path, volume_path, out_dir, nmin=-32, nmax=32, max_workers=None, cache_gb=1., progress=None):
+        ppm = Ppm.loadPpm(pathlib.Path(ppm_path))
+        if not ppm.valid:
+            return ppm.error
+        # check that the volume file is readable; the
+        # data itself is only loaded by the workers
+        volume = PpmLayers.loadVolume(volume_path, False)
+        if not volume.valid:
+            return volume.error
+        # each worker would have to read the whole of
+        # a compressed NRRD volume into memory
+        mappable = volume.is_zarr or volume.rawDataLayout() is not None
+        volume = None
+        if nmax < nmin:
+            err = "Layer range %d to %d is empty"%(nmin, nmax)
+            print(err)
+            return err
+
+        h, w = ppm.height, ppm.width
+        out_dir = pathlib.Path(out_dir)
+        layer_paths = PpmLayers.layerPaths(out_dir, nmin, nmax)
+        try:
+            out_dir.mkdir(parents=True, exist_ok=True)
+            for lpath in layer_paths:
+                # creates an uncompressed, all-zeros TIFF file;
+                # classic TIFF files are limited to 4 Gb
+                layer = tifffile.memmap(str(lpath), shape=(h,w), dtype=np.uint16, bigtiff=(2*h*w > 2**31))
+                del layer
+        except Exception as e:
+            err = "Could not create layer files in %s: %s"%(str(out_dir), e)
+            print(err)
+            return err
+
+        rows = max(1, PpmLayers.pixels_per_band // max(w, 1))
+        bands = [(r0, min(r0+rows, h)) for r0 in range(0, h, rows)]
+        args = (str(ppm_path), str(volume_path), [str(p) for p in layer_paths], nmin, nmax)
+        done = 0
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        max_workers = min(max_workers, len(bands))
+        if not mappable and max_workers > 1:
+            print("Volume data can not be memory-mapped; using one worker process")
+            max_workers = 1
+        if max_workers > 1:
+            # "spawn" rather than "fork", because the calling
+            # process may be running Qt
+            ctx = multiprocessing.get_context("spawn")
+            executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=ctx,
+                    initializer=PpmLayers.initWorker, initargs=args+(cache_gb,))
+            pending = {executor.submit(PpmLayers.renderBand, *band) for band in bands}
+            cancelled = False
+            try:
+                while len(pending) > 0 and not cancelled:
+                    # time out periodically, so that the
+                    # caller can respond to the user
+                    finished, pending = wait(pending, timeout=.1, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        done += future.result()
+                    if progress is not None and not progress(done, h):
+                        cancelled = True
+            except Exception as e:
+                err = "Layer rendering failed: %s"%e
+                print(err)
+                executor.shutdown(wait=False, cancel_futures=True)
+                return err
+            executor.shutdown(wait=not cancelled, cancel_futures=True)
+            if cancelled:
+                return "Layer rendering cancelled"
+        else:
+            PpmLayers.initWorker(*args)
+            for band in bands:
+                done += PpmLayers.renderBand(*band)
+                if progress is not None and not progress(done, h):
+                    PpmLayers.worker = None
+                    return "Layer rendering cancelled"
+            PpmLayers.worker = None
+        return ""
+
+# The guard is needed because worker processes (which are
+# started using "spawn") import this module
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description="Render the layers of a surface volume from a PPM file")
+    parser.add_argument("ppm", help="PPM file")
+    parser.add_argument("volume", help="khartes volume file (.nrrd or .volzarr)")
+    parser.add_argument("output_dir", help="directory for the layer TIFF files")
+    parser.add_argument("--nmin", type=int, default=-32, help="offset of the first layer along the normal (default -32)")
+    parser.add_argument("--nmax", type=int, default=32, help="offset of the last layer along the normal (default 32)")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: number of cpus)")
+    parser.add_argument("--cache_gb", type=float, default=1., help="size of each worker's zarr chunk cache, in Gb (default 1)")
+    args = parser.parse_args()
+
+    def progress(done, total):
+        print("rendered %d of %d rows"%(done, total))
+        return True
+
+    err = PpmLayers.render(args.ppm, args.volume, args.output_dir, args.nmin, args.nmax, args.workers, args.cache_gb, progress)
+    if err != "":
+        print("Error:", err)
+        sys.exit(1)
@@ -1,7 +1,9 @@
+import os
 import pathlib
 import shutil
 import time
 import json
+import numpy as np
 from utils import Utils
 from volume import Volume, VolumeView
 from volume_zarr import CachedZarrVolume
@@ -9,7 +11,9 @@ from ppm import Ppm
 from fragment import Fragment, FragmentView
 from trgl_fragment import TrglFragment, TrglFragmentView
 from base_fragment import BaseFragment, BaseFragmentView
-from PyQt5.QtGui import QColor 
+from fragment_file import FragmentFile
+from journal import EditJournal
+from color import Color
 
 
 
@@ -170,7 +174,7 @@ class ProjectView:
                 if 'ijktf' in vinfo:
                     vv.ijktf = vinfo['ijktf']
                 if 'color' in vinfo:
-                    vv.setColor(QColor(vinfo['color']), no_notify=True)
+                    vv.setColor(Color(vinfo['color']), no_notify=True)
                 # else:
                 # this else clause is not needed because VolumeView
                 # creator sets a random color
@@ -229,9 +233,11 @@ class ProjectView:
             # print("svv")
             fv.setVolumeView(self.cur_volume_view)
         # make sure echo fragments are updated
+        # (only views that are visible or active are
+        # computed now; the others are computed when needed)
         for fv in self.fragments.values():
             # print("slp")
-            fv.setLocalPoints(True)
+            fv.updateLocalPoints(True)
 
 
     def setCurrentVolume(self, volume, no_notify=False):
@@ -330,6 +336,7 @@ class Project:
         self.error = "no error message set"
         self.modified_callback = None
         self.last_saved = ""
+        self.journal = None
 
     def createErrorProject(err):
         prj = Project()
@@ -410,6 +417,14 @@ class Project:
         return prj
 
 
+    # Keeps the two previous versions of the fragments directory
+    # in fragments_prev and fragments_prev_2.  Rather than moving
+    # the files of the current version into fragments_prev, they
+    # are hard linked there (or copied, if the file system does
+    # not support hard links).  This is safe because fragment
+    # files are never modified in place; they are replaced
+    # (see FragmentFile.write), so the links in fragments_prev
+    # continue to point to the previous contents.
     def preservePreviousVersion(self):
         frag_path = self.fragments_path
         frag_path_old = self.fragments_path.with_name('fragments_prev')
@@ -428,7 +443,10 @@ class Project:
         files = list(frag_path.glob('*'))
         for file in files:
             name = file.name
-            file.rename(frag_path_old / name)
+            try:
+                os.link(file, frag_path_old / name)
+            except Exception:
+                shutil.copy2(file, frag_path_old / name)
 
     def preservePreviousVersionOld(self):
         frag_path = self.fragments_path
@@ -522,12 +540,48 @@ class Project:
 
     def save(self):
         print("called project save")
-        try:
-            self.preservePreviousVersion()
-        except Exception as e:
-            print(e)
-            print("failed to preserve previous version")
-        BaseFragment.saveList(self.fragments, self.fragments_path, "all")
+        restart_journal = False
+        if self.journal is not None:
+            if self.journal.path.parent != self.path:
+                # project is being saved under a new name
+                self.stopJournal(True)
+                restart_journal = True
+            else:
+                # wait for any compaction to finish
+                self.journal.sync()
+        frag_path = self.fragments_path
+        BaseFragment.assignFileStems(self.fragments)
+        # Only the fragments that have changed since the last
+        # save are written.  Files that don't belong to any
+        # current fragment (deleted fragments, and json and obj
+        # files from older versions of khartes) are removed
+        # from the fragments directory; they are still
+        # available in fragments_prev.
+        dirty = [frag for frag in self.fragments if frag.needsSave(frag_path)]
+        current = set([frag.binaryFileName() for frag in self.fragments])
+        stale = [file for file in frag_path.glob('*') if file.name not in current]
+        print("saving", len(dirty), "of", len(self.fragments), "fragments")
+        if len(dirty) > 0 or len(stale) > 0:
+            # fragments loaded from binary files are memory-mapped
+            # to those files, which are about to be replaced
+            for frag in dirty:
+                frag.detachArrays()
+            try:
+                self.preservePreviousVersion()
+            except Exception as e:
+                print(e)
+                print("failed to preserve previous version")
+            for file in stale:
+                try:
+                    file.unlink()
+                except Exception as e:
+                    print(e)
+                    print("failed to unlink", file)
+            # The binary format is the project's native format;
+            # BaseFragment.saveList (json and obj files) is still
+            # available for interchange, and json and obj files
+            # in the fragments directory are still loaded
+            BaseFragment.saveListBinary(dirty, frag_path)
 
         info = {}
         # TODO: set modified-date in info
@@ -536,6 +590,177 @@ class Project:
         info_txt = json.dumps(info, sort_keys=True, indent=4)
         (self.path / 'project.json').write_text(info_txt, encoding="utf8")
         self.last_saved = Utils.timestamp()
+        if self.journal is not None:
+            self.journal.reset()
+        elif restart_journal:
+            self.startJournal()
+
+    # The journal records node edits as they happen, so
+    # that they can be recovered after a crash (see EditJournal)
+    def startJournal(self):
+        if self.journal is None:
+            self.journal = EditJournal(self.path / EditJournal.file_name)
+
+    # discard should be True if the user has chosen
+    # not to keep the edits made since the last save
+    def stopJournal(self, discard=False):
+        if self.journal is not None:
+            self.journal.stop(discard)
+            self.journal = None
+
+    # op is "create", "add", "insert", "move", "delete", or
+    # "replace" ("insert" puts the point at the given index,
+    # moving the later points up; it is used to undo a delete;
+    # "replace" sets all of the fragment's points to pts, and
+    # is used when the whole fragment is moved);
+    # fragments are identified by their "created" timestamp.
+    # A "create" record contains the fragment's info and arrays
+    # (as in a binary fragment file), so that copies of
+    # existing fragments can be recreated.
+    def journalRecord(self, op, frag, index=-1, pt=None, pts=None):
+        if self.journal is None:
+            return
+        rec = {"op": op, "frag": frag.created}
+        if op == "create" and hasattr(frag, "binaryInfoAndArrays"):
+            info, arrays = frag.binaryInfoAndArrays()
+            info['type'] = type(frag).__name__
+            rec["info"] = info
+            # the arrays are converted to lists by the
+            # journal's thread
+            rec["arrays"] = {name: {"dtype": str(arr.dtype), "shape": arr.shape, "data": np.array(arr)} for name, arr in arrays.items()}
+        if index >= 0:
+            rec["index"] = int(index)
+        if pt is not None:
+            rec["pt"] = [float(x) for x in pt]
+        if pts is not None:
+            rec["pts"] = np.array(pts)
+        self.journal.record(rec)
+
+    # Writes, in the background, the fragments that have been
+    # modified since they were last saved (or autosaved) to
+    # the autosave directory, and then removes their records
+    # from the journal.  The fragments directory is not
+    # touched; the autosaved fragments are only used to
+    # recover the edits after a crash (see restoreAutosave).
+    # Only the copying of the fragment data is done in the
+    # calling thread.
+    def compactJournal(self):
+        if self.journal is None:
+            return
+        frags = {frag.created: frag for frag in self.fragments}
+        retry = False
+        for created in self.journal.failures():
+            if created in frags:
+                # make sure the next compaction writes it
+                frags[created].autosaved_version = None
+                retry = True
+        if self.journal.count == 0 and not retry:
+            return
+        frag_path = self.fragments_path
+        autosave_path = self.journal.autosave_path
+        BaseFragment.assignFileStems(self.fragments)
+        jobs = []
+        for frag in self.fragments:
+            if not frag.needsSave(frag_path) or not hasattr(frag, "binaryInfoAndArrays"):
+                continue
+            if frag.autosaved_version == frag.version:
+                continue
+            # on Windows, a memory-mapped file can't be replaced
+            frag.detachArrays()
+            info, arrays = frag.binaryInfoAndArrays()
+            info['type'] = type(frag).__name__
+            arrays = {name: np.array(arr) for name, arr in arrays.items()}
+            jobs.append((frag.created, autosave_path / frag.binaryFileName(), info, arrays))
+            frag.autosaved_version = frag.version
+        names = set([frag.binaryFileName() for frag in self.fragments])
+        print("autosave: compacting journal;", len(jobs), "fragments")
+        self.journal.compact(jobs, names)
+
+    # Loads the fragments in the autosave directory (if any),
+    # which replace the fragments, loaded from the fragments
+    # directory, that have the same "created" id.  Returns
+    # the list of fragments that were restored.
+    def restoreAutosave(self):
+        autosave_path = self.path / EditJournal.autosave_dir_name
+        if not autosave_path.is_dir():
+            return []
+        ffiles = sorted(autosave_path.glob("*"+FragmentFile.suffix))
+        restored = []
+        for frags in BaseFragment.loadBinaryList(ffiles):
+            if frags is None:
+                continue
+            for frag in frags:
+                if not frag.valid:
+                    continue
+                old = self.findFragmentById(frag.created)
+                if old is not None:
+                    self.fragments.remove(old)
+                # not yet saved to the fragments directory
+                frag.saved_version = None
+                frag.autosaved_version = frag.version
+                self.addFragment(frag)
+                restored.append(frag)
+        print("autosave: restored", len(restored), "fragments")
+        return restored
+
+    # Applies the autosaved fragments, and then the edits in
+    # the journal (if any), to the fragments that were loaded
+    # from the fragments directory.  Returns the number of
+    # records applied.
+    def replayJournal(self):
+        restored = self.restoreAutosave()
+        modified = set(restored)
+        recs = EditJournal.readRecords(self.path / EditJournal.file_name)
+        frags = {frag.created: frag for frag in self.fragments}
+        count = 0
+        for rec in recs:
+            op = rec.get("op", "")
+            created = rec.get("frag", "")
+            if op == "create":
+                if created in frags:
+                    continue
+                info = dict(rec.get("info", {}))
+                if "arrays" in rec:
+                    arrays = {name: np.array(ar["data"], dtype=ar["dtype"]).reshape(ar["shape"]) for name, ar in rec["arrays"].items()}
+                    frag = BaseFragment.fromBinaryInfo(info, arrays, "journal")
+                else:
+                    info['gpoints'] = []
+                    frag = Fragment.fragFromDict(info)
+                if frag is None or not frag.valid:
+                    continue
+                self.addFragment(frag)
+                frags[created] = frag
+                modified.add(frag)
+                count += 1
+                continue
+            frag = frags.get(created, None)
+            if frag is None:
+                print("journal: fragment %s not found; skipping %s"%(created, op))
+                continue
+            index = rec.get("index", -1)
+            npts = len(frag.gpoints)
+            if op == "add" and "pt" in rec:
+                pt = np.array(rec["pt"], dtype=np.float32).reshape(1,3)
+                frag.gpoints = np.append(frag.gpoints, pt, axis=0)
+            elif op == "insert" and "pt" in rec and 0 <= index <= npts:
+                pt = np.array(rec["pt"], dtype=np.float32).reshape(1,3)
+                frag.gpoints = np.insert(frag.gpoints, index, pt, axis=0)
+            elif op == "move" and "pt" in rec and 0 <= index < npts:
+                frag.gpoints[index, :] = rec["pt"]
+            elif op == "delete" and 0 <= index < npts:
+                frag.gpoints = np.delete(frag.gpoints, index, 0)
+            elif op == "replace" and "pts" in rec and len(rec["pts"]) == npts:
+                frag.gpoints = np.array(rec["pts"], dtype=frag.gpoints.dtype).reshape(-1,3)
+            else:
+                print("journal: ignoring record", rec)
+                continue
+            modified.add(frag)
+            count += 1
+        for frag in modified:
+            frag.notifyModified()
+        if len(modified) > 0:
+            print("journal: replayed", count, "edits to", len(modified), "fragments")
+        return count
 
     notify_counter = 0
 
@@ -625,6 +850,13 @@ class Project:
             if ppm is not None and ppm.valid:
                 prj.addPpm(ppm)
 
+        ffiles = sorted(fdir.glob("*"+FragmentFile.suffix))
+        for frags in BaseFragment.loadBinaryList(ffiles):
+            if frags is not None:
+                for frag in frags:
+                    if frag.valid:
+                        prj.addFragment(frag)
+
         for ffile in fdir.glob("*.json"):
             frags = Fragment.load(ffile)
             if frags is not None:
@@ -632,13 +864,17 @@ class Project:
                     if frag.valid:
                         prj.addFragment(frag)
 
-        for ffile in fdir.glob("*.obj"):
-            frags = TrglFragment.load(ffile)
+        for frags in TrglFragment.loadList(list(fdir.glob("*.obj"))):
             if frags is not None:
                 for frag in frags:
                     if frag.valid:
                         prj.addFragment(frag)
 
+        # recover edits that were made after the last save
+        # (the previous session presumably crashed) from the
+        # autosave directory and the journal
+        prj.replayJournal()
+
         return prj
 
     def isSaveUpToDate(self):
@@ -1,12 +1,14 @@
 import sys
 import pathlib
 import math
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import numpy as np
 import scipy
+import scipy.linalg
 # from scipy.ndimage import gaussian_filter, gaussian_filter1d
-from scipy.interpolate import RegularGridInterpolator, CubicSpline
+from scipy.interpolate import CubicSpline
 from scipy.integrate import solve_ivp
 from scipy.optimize import least_squares
 from scipy.sparse.linalg import LinearOperator
@@ -36,8 +38,75 @@ Gijs C. Fehmers and Christian F. W. H Hocker - Geophysics, 2003
 https://sci-hub.se/10.1190/1.1598121
 '''
 
+# Bilinear sampler over a 2D field (an array of shape (h,w) or
+# (h,w,c)), indexed [y,x].  Points outside the grid get the
+# value 0.  It replaces scipy's RegularGridInterpolator, which
+# has a large per-call overhead; this matters in particular when
+# the field is sampled one point at a time, as it is by solve_ivp.
+class FieldSampler():
+
+    def __init__(self, data):
+        self.data = np.asarray(data, dtype=np.float64)
+        self.h, self.w = self.data.shape[:2]
+        self.trailing = self.data.shape[2:]
+
+    # Batched path; same calling convention as
+    # RegularGridInterpolator: yxs has shape (..., 2),
+    # with points in y,x order, and the result has shape
+    # yxs.shape[:-1] + (trailing shape of the field).
+    # A single point (shape (2,)) gives a result of
+    # shape (1,) + (trailing shape).
+    def __call__(self, yxs):
+        yxs = np.asarray(yxs, dtype=np.float64)
+        if yxs.ndim == 1:
+            yxs = yxs[np.newaxis,:]
+        oshape = yxs.shape[:-1]
+        yxs = yxs.reshape(-1, 2)
+        ys = yxs[:,0]
+        xs = yxs[:,1]
+        h, w = self.h, self.w
+        inside = (ys >= 0) & (ys <= h-1) & (xs >= 0) & (xs <= w-1)
+        ys = ys[inside]
+        xs = xs[inside]
+        i0 = np.minimum(ys.astype(np.int64), max(h-2, 0))
+        j0 = np.minimum(xs.astype(np.int64), max(w-2, 0))
+        i1 = np.minimum(i0+1, h-1)
+        j1 = np.minimum(j0+1, w-1)
+        fy = (ys-i0).reshape((-1,)+(1,)*len(self.trailing))
+        fx = (xs-j0).reshape(fy.shape)
+        a = self.data
+        values = ((a[i0,j0]*(1-fy) + a[i1,j0]*fy)*(1-fx) +
+                  (a[i0,j1]*(1-fy) + a[i1,j1]*fy)*fx)
+        out = np.zeros((len(yxs),)+self.trailing, dtype=np.float64)
+        out[inside] = values
+        return out.reshape(oshape+self.trailing)
+
+    # Fast path for a single point; returns a new array
+    # of the field's trailing shape (a float if the
+    # field is scalar)
+    def at(self, y, x):
+        h, w = self.h, self.w
+        if not (0 <= y <= h-1 and 0 <= x <= w-1):
+            return np.zeros(self.trailing, dtype=np.float64)
+        i0 = min(int(y), max(h-2, 0))
+        j0 = min(int(x), max(w-2, 0))
+        i1 = min(i0+1, h-1)
+        j1 = min(j0+1, w-1)
+        fy = y-i0
+        fx = x-j0
+        a = self.data
+        return ((a[i0,j0]*(1-fy) + a[i1,j0]*fy)*(1-fx) +
+                (a[i0,j1]*(1-fy) + a[i1,j1]*fy)*fx)
+
+
 class ST(object):
 
+    # class variables
+    # width of the gaussian derivative (computeGradient)
+    sigma0 = 2.
+    # width of the gaussian blur of the tensor (computeEigens)
+    sigma1 = 8.
+
     # assumes image is a floating-point numpy array
     def __init__(self, image):
         self.image = image
@@ -48,16 +117,20 @@ class ST(object):
         self.isotropy = None
         self.linearity = None
         self.coherence = None
+        # sampler of the stacked vector_v and grad fields;
+        # see velocitySampler
+        self.velocity_sampler = None
 
     def saveImage(self, fname):
         timage = (self.image*65535).astype(np.uint16)
         cv2.imwrite(str(fname), timage)
 
-    def computeEigens(self):
+    # Returns gx, gy: the gaussian-derivative gradient of the image
+    def computeGradient(self):
         tif = self.image
-        sigma0 = 1.  # value used by Hale
-        sigma0 = 2.
-        ksize = int(math.floor(.5+6*sigma0+1))
+        # sigma0 = 1.  # value used by Hale
+        sigma0 = ST.sigma0
+        ksize = ST.derivativeKernelSize(sigma0)
         hksize = ksize//2
         kernel = cv2.getGaussianKernel(ksize, sigma0)
         dkernel = kernel.copy()
@@ -71,13 +144,33 @@ class ST(object):
         # this is equivalent, and gives zero when it should
         gx = cv2.sepFilter2D(tif.transpose(), -1, kernel, dkernel).transpose()
         gy = cv2.sepFilter2D(tif, -1, kernel, dkernel)
+        return gx, gy
+
+    # class function
+    def derivativeKernelSize(sigma0):
+        return int(math.floor(.5+6*sigma0+1))
+
+    # class function
+    # Returns the distance, in pixels, over which the fields
+    # computed by computeEigens depend on the image: the
+    # half-width of the derivative kernel plus the half-width
+    # of the kernel that cv2.GaussianBlur uses, for floating-point
+    # images, when no kernel size is given (8*sigma+1, rounded
+    # and made odd)
+    def kernelReach():
+        hksize0 = ST.derivativeKernelSize(ST.sigma0)//2
+        ksize1 = int(round(8*ST.sigma1+1)) | 1
+        return hksize0 + ksize1//2
+
+    def computeEigens(self):
+        gx, gy = self.computeGradient()
         grad = np.concatenate((gx, gy)).reshape(2,gx.shape[0],gx.shape[1]).transpose(1,2,0)
 
         # gaussian blur
         # OpenCV function is several times faster than
         # numpy equivalent
-        sigma1 = 8. # value used by Hale
-        # sigma1 = 16.
+        # sigma1 = 8. # value used by Hale
+        sigma1 = ST.sigma1
         # gx2 = gaussian_filter(gx*gx, sigma1)
         gx2 = cv2.GaussianBlur(gx*gx, (0, 0), sigma1)
         # gy2 = gaussian_filter(gy*gy, sigma1)
@@ -164,6 +257,7 @@ class ST(object):
         self.linearity = linearity
         self.coherence = coherence
 
+        self.velocity_sampler = None
         self.lambda_u_interpolator = ST.createInterpolator(self.lambda_u)
         self.lambda_v_interpolator = ST.createInterpolator(self.lambda_v)
         self.vector_u_interpolator = ST.createInterpolator(self.vector_u)
@@ -173,8 +267,17 @@ class ST(object):
         self.linearity_interpolator = ST.createInterpolator(self.linearity)
         self.coherence_interpolator = ST.createInterpolator(self.coherence)
 
+    # Returns a sampler of vector_v and grad, stacked so that
+    # both are obtained in one (single-point) call; created
+    # the first time it is needed
+    def velocitySampler(self):
+        if self.velocity_sampler is None:
+            self.velocity_sampler = FieldSampler(np.concatenate((self.vector_v, self.grad), axis=2))
+        return self.velocity_sampler
+
     def create_vel_func(self, xy, sign, nudge=0):
         x0 = np.array((xy))
+        sampler = self.velocitySampler()
         # vv0 = self.vector_v_interpolator((x0[::-1]))[0]
         # print(x0, vv0)
         def vf(t, y):
@@ -182,9 +285,9 @@ class ST(object):
             # print(t,y)
             # vv stores vector at x,y in vv[y,x], but the
             # vector itself is returned in x,y order
-            yr = y[::-1]
-            vv = self.vector_v_interpolator((yr))[0]
-            grad = self.grad_interpolator((yr))[0]
+            vvgrad = sampler.at(y[1], y[0])
+            vv = vvgrad[:2]
+            grad = vvgrad[2:]
             # print(t,y,vv,grad)
             # print("vv", vv.shape, vv.dtype)
             # print(vv)
@@ -202,11 +305,64 @@ class ST(object):
             return vv
         return vf
 
+    # Traces streamlines of the eigenvector field vector_v
+    # (nudged by nudge*grad), starting from each of the points
+    # in xys (an array of shape (n,2), in x,y order), using
+    # fixed-step fourth-order Runge-Kutta.  All the streamlines
+    # are traced at the same time, so each Runge-Kutta stage
+    # samples the field once for all the seeds.
+    # signs (a scalar, or one value per seed) gives the initial
+    # direction (in x) of each streamline; after that, the
+    # direction of the eigenvector is chosen to point away from
+    # the seed, as in create_vel_func.
+    # Returns an array of shape (n, nsteps+1, 2), where
+    # nsteps = tmax/step, containing the positions (x,y)
+    # along each streamline, starting with the seed.
+    def traceStreamlines(self, xys, signs, nudge=0., tmax=500, step=2.):
+        x0 = np.array(xys, dtype=np.float64).reshape(-1,2)
+        signs = np.broadcast_to(np.asarray(signs, dtype=np.float64), (len(x0),))
+        sampler = self.velocitySampler()
+
+        def vel(y, first):
+            # the sampler takes points in y,x order
+            if len(y) == 1:
+                # single-point fast path
+                vvgrad = sampler.at(y[0,1], y[0,0])[np.newaxis,:]
+            else:
+                vvgrad = sampler(y[:,::-1])
+            vv = vvgrad[:,:2]
+            if first:
+                flip = vv[:,0]*signs < 0
+            else:
+                flip = (vv*(y-x0)).sum(axis=1) < 0
+            vv[flip] *= -1
+            return vv + nudge*vvgrad[:,2:]
+
+        nsteps = int(round(tmax/step))
+        out = np.zeros((nsteps+1,)+x0.shape, dtype=np.float64)
+        out[0] = x0
+        y = x0
+        for i in range(nsteps):
+            k1 = vel(y, i==0)
+            k2 = vel(y+.5*step*k1, False)
+            k3 = vel(y+.5*step*k2, False)
+            k4 = vel(y+step*k3, False)
+            y = y + (step/6.)*(k1+2*k2+2*k3+k4)
+            out[i+1] = y
+        return out.transpose(1,0,2)
+
     # the idea of using Runge-Kutta (which solve_ivp uses)
     # was suggested by @TizzyTom
     # Uses Runge-Kutta to extrapolate (to the left or
     # right, depending on sign) from the given point.
+    # Returns an array of shape (npts, 2), containing
+    # positions (x,y) along the streamline.
     def call_ivp(self, xy, sign, nudge=0):
+        return self.traceStreamlines([xy], sign, nudge)[0]
+
+    # Previous version of call_ivp, using solve_ivp
+    # (adaptive step size, one point per callback)
+    def call_ivp_old(self, xy, sign, nudge=0):
         vel_func = self.create_vel_func(xy, sign, nudge)
         tmax = 400
         tmax = 500
@@ -227,8 +383,13 @@ class ST(object):
             return None
         return sol.y.transpose()
 
-    # This is used by the Wu-Hale version of interp2d
-    def solve2d(self, xs, ys, constraints):
+    # This is used by the Wu-Hale version of interp2d.
+    # within, if not None, flags the segments (pairs of
+    # consecutive points) that belong to a curve; the other
+    # segments join separate curves that are solved together
+    # (each curve has constraints at both ends), and
+    # contribute nothing to the objective function.
+    def solve2d(self, xs, ys, constraints, within=None):
         # return ys.copy()
 
         # vv stores the vector at x,y in vv[y,x], but the
@@ -241,6 +402,8 @@ class ST(object):
         mxs = .5*(xs[:-1]+xs[1:])
         # length (in x direction) of each segment
         lxs = xs[1:]-xs[:-1]
+        if within is not None:
+            lxs[~within] = 1.
         mys = .5*(ys[:-1]+ys[1:])
         myxs = np.stack((mys, mxs), axis=1)
         # print("xs")
@@ -276,77 +439,74 @@ class ST(object):
         
         # Following the notation in Wu and Hale (2015):
         f = ys
-        # print("f", f.shape)
-        # print(f)
-        # W = np.diag(cohs)
-        G = np.diag(-1./lxs)
-        # print(G.shape)
-        G = np.append(G, np.zeros((G.shape[0]),dtype=np.float64)[:,np.newaxis], axis=1)
-        # print(G.shape)
-        G[:,1:] += np.diag(1./lxs)
-        # print("G", G.shape)
-        # print(G)
-        # G = np.concatenate((G,G,G), axis=0)
-        G = np.concatenate((G,G), axis=0)
-        # print("G", G.shape)
-        # print(G)
-
-        # print("cohs", cohs.shape)
+        # The objective function is
+        #   sum over segments i of
+        #     (cohs[i]*(g[i]-vslope[i]))**2 + (rweight*g[i])**2
+        # where g[i] = (f[i+1]-f[i])/lxs[i] is the slope of
+        # segment i.  (This is |W(Gf-v)|**2 in Wu and Hale's
+        # notation, with G being the finite-difference
+        # operator stacked twice, and W the diagonal matrix
+        # of the weights cohs and rws).
+        # The normal equations A f = b, where A = G'W'WG and
+        # b = G'W'Wv, form a tridiagonal system, which is
+        # assembled directly in banded form rather than
+        # as dense matrices.
         rweight = .1
-        rws = np.full(cohs.shape, rweight, dtype=np.float64)
-        # print("rws", rws.shape)
-        rvs = np.full(vslope.shape, 0., dtype=np.float64)
-        # print("rvs", rvs.shape)
-        # gweight = 0.1
-        # gws = np.full(cohs.shape, gweight, dtype=np.float64)
-        # # print("gws", gws.shape)
-        # gvs = grads[:,1]
-        # # print("gvs", gvs.shape)
-
-        # W = np.diag(np.concatenate((cohs,rws,gws)))
-        W = np.diag(np.concatenate((cohs,rws)))
-        # print("W", W.shape)
-        # v = np.concatenate((vslope, rvs, gvs))
-        v = np.concatenate((vslope, rvs))
-        # print("v", v.shape)
-
-        wgtw = (W@G).T @ W
-        A = wgtw@G
-        # print("A", A.shape)
-        # print(A)
-        # print(A.sum(axis=1))
-        b = wgtw@v
-        # print("b", b.shape)
-        # print(b)
+        # weight of each segment's slope term in A
+        aw = (cohs*cohs + rweight*rweight)/(lxs*lxs)
+        # contribution of each segment to b
+        bw = cohs*cohs*vslope/lxs
+        if within is not None:
+            aw[~within] = 0.
+            bw[~within] = 0.
+        n = f.shape[0]
+        diag = np.zeros(n, dtype=np.float64)
+        diag[:-1] += aw
+        diag[1:] += aw
+        # off-diagonal: A[i,i+1] = A[i+1,i] = off[i]
+        off = -aw
+        b = np.zeros(n, dtype=np.float64)
+        b[:-1] -= bw
+        b[1:] += bw
+
         cons = np.array(constraints, dtype=np.float64)
         cidxs = cons[:,0].astype(np.int64)
         cys = cons[:,1]
-
-        Z = np.identity(A.shape[0])
-        # Z = Z[:,1:]
-        Z = np.delete(Z, cidxs, axis=1)
-        # print("Z", Z.shape)
-        # print(np.linalg.inv(Z.T@A@Z))
-        f0 = np.zeros(f.shape[0], dtype=np.float64)
+        f0 = np.zeros(n, dtype=np.float64)
         f0[cidxs] = cys
-        # print("f0", f0.shape)
-        # print(f0)
+
+        # Constraint elimination: solve for the unconstrained
+        # values only (Z'AZ p = Z'(b-Af0), where Z selects the
+        # unconstrained values).  Removing rows and columns
+        # from a tridiagonal matrix leaves it tridiagonal.
+        af0 = diag*f0
+        af0[:-1] += off*f0[1:]
+        af0[1:] += off*f0[:-1]
+        free = np.ones(n, dtype=np.bool_)
+        free[cidxs] = False
+        fidxs = np.nonzero(free)[0]
+        nf = len(fidxs)
+        if nf == 0:
+            return f0 + ys[0] - f0[0]
+        # off-diagonal of the reduced matrix; zero where two
+        # consecutive free values are separated by a constraint
+        foff = np.zeros(nf-1, dtype=np.float64)
+        adjacent = (fidxs[1:] == fidxs[:-1]+1)
+        foff[adjacent] = off[fidxs[:-1][adjacent]]
+        ab = np.zeros((3, nf), dtype=np.float64)
+        ab[0,1:] = foff
+        ab[1] = diag[fidxs]
+        ab[2,:-1] = foff
 
         try:
-            p = np.linalg.inv(Z.T@A@Z)@Z.T@(b-A@f0)
-        except:
+            p = scipy.linalg.solve_banded((1,1), ab, (b-af0)[fidxs])
+        except Exception:
             print("Singular matrix!")
             return ys.copy()
 
-        newf = f0 + Z@p
-
-        # print(np.linalg.inv(A))
-        # print(scipy.linalg.inv(A))
+        newf = f0.copy()
+        newf[fidxs] = p
 
-        # newf = np.linalg.inv(A)@b
-        # newf = np.linalg.inv(Z.T@A@Z)@b
-        # print("newf")
-        # print(newf)
         newys = newf + ys[0] - newf[0]
         return newys
         # return ys.copy()
@@ -400,6 +560,66 @@ class ST(object):
         # print(xys)
         return xys
 
+    # Wu-Hale interpolation of several curves at once: curve n
+    # joins xy1s[n] to xy2s[n].  All the curves are solved as a
+    # single (block-tridiagonal) system, so each iteration costs
+    # one call to solve2d; each curve stops changing once it has
+    # converged, so the result for each curve is the same as
+    # that of interp2dWH.
+    # Returns a list with, for each curve, an array of
+    # shape (npts, 2) of positions (x,y), or None if the
+    # two end points have the same x.
+    def interp2dWHSpans(self, xy1s, xy2s):
+        print("interp2dWHSpans", len(xy1s), "curves")
+        epsilon = .01
+        xss = []
+        yss = []
+        nxs = []
+        for xy1, xy2 in zip(xy1s, xy2s):
+            oxy1, oxy2 = xy1, xy2
+            if xy1[0] > xy2[0]:
+                oxy1,oxy2 = oxy2,oxy1
+            nx = int(oxy2[0]-oxy1[0])+1
+            if nx < 2:
+                nx = 0
+            nxs.append(nx)
+            xss.append(np.linspace(oxy1[0],oxy2[0],nx, dtype=np.float64))
+            yss.append(np.linspace(oxy1[1],oxy2[1],nx, dtype=np.float64))
+        nxs = np.array(nxs, dtype=np.int64)
+        curves = (nxs > 0).nonzero()[0]
+        result = [None]*len(nxs)
+        if len(curves) == 0:
+            return result
+        xs = np.concatenate([xss[c] for c in curves])
+        ys = np.concatenate([yss[c] for c in curves])
+        nxs = nxs[curves]
+        starts = np.concatenate(([0], np.cumsum(nxs)[:-1]))
+        ends = starts+nxs-1
+        within = np.ones(len(xs)-1, dtype=np.bool_)
+        within[ends[:-1]] = False
+        constraints = [(i, ys[i]) for i in np.concatenate((starts, ends))]
+        # curve number of each point
+        cidx = np.repeat(np.arange(len(curves)), nxs)
+        active = np.ones(len(curves), dtype=np.bool_)
+        min_dys = np.full(len(curves), -1., dtype=np.float64)
+        min_ys = ys.copy()
+        for _ in range(20):
+            prev_ys = ys.copy()
+            ys = self.solve2d(xs, ys, constraints, within)
+            # curves that have converged keep their values
+            ys[~active[cidx]] = prev_ys[~active[cidx]]
+            avg_dys = np.add.reduceat(np.abs(ys-prev_ys), starts)/nxs
+            better = active & ((min_dys < 0.) | (avg_dys < min_dys))
+            min_dys[better] = avg_dys[better]
+            min_ys[better[cidx]] = ys[better[cidx]]
+            active &= (avg_dys >= epsilon)
+            if not active.any():
+                break
+        xys = np.stack((xs, min_ys), axis=1)
+        for c, s, n in zip(curves, starts, nxs):
+            result[c] = xys[s:s+n]
+        return result
+
     # Interpolate between two points, using the same objective function
     # as the Wu-Hale interpolator, but a different solver:
     # least_squares from scipy.optimize
@@ -794,9 +1014,12 @@ class ST(object):
 
 
     # class function
+    # Returns a bilinear sampler of ar (indexed [y,x]), with the
+    # same calling convention as the RegularGridInterpolator that
+    # was previously used; creating one does not copy ar (if
+    # ar is float64)
     def createInterpolator(ar):
-        interp = RegularGridInterpolator((np.arange(ar.shape[0]), np.arange(ar.shape[1])), ar, method='linear', bounds_error=False, fill_value=0.)
-        return interp
+        return FieldSampler(ar)
 
     def saveEigens(self, fname):
         if self.lambda_u is None:
@@ -809,11 +1032,18 @@ class ST(object):
         grad = self.grad
         # print(lu.shape, lu[np.newaxis,:,:].shape)
         # print(vu.shape)
-        st_all = np.concatenate((lu[:,:,np.newaxis], lv[:,:,np.newaxis], vu, vv, grad), axis=2)
+        st_all = self.eigenStack()
         # turn off the default gzip compression
         header = {"encoding": "raw",}
         nrrd.write(str(fname), st_all, header, index_order='C')
 
+    # Returns the eigen fields as a single array of shape
+    # (h,w,8), in the layout expected by setEigens
+    def eigenStack(self):
+        lu = self.lambda_u
+        lv = self.lambda_v
+        return np.concatenate((lu[:,:,np.newaxis], lv[:,:,np.newaxis], self.vector_u, self.vector_v, self.grad), axis=2)
+
     def loadOrCreateEigens(self, fname):
         self.lambda_u = None
         print("loading eigens")
@@ -831,6 +1061,14 @@ class ST(object):
             print("Error while loading",fname,e)
             return
 
+        self.setEigens(data)
+
+    # st_all has the layout written by saveEigens: an array
+    # of shape (h,w,8) holding lambda_u, lambda_v, vector_u,
+    # vector_v, and grad.  Sets the eigen fields (and their
+    # interpolators) from st_all, without copying it.
+    def setEigens(self, st_all):
+        data = st_all
         self.lambda_u = data[:,:,0]
         self.lambda_v = data[:,:,1]
         self.vector_u = data[:,:,2:4]
@@ -845,6 +1083,7 @@ class ST(object):
         # print("lambda_u", self.lambda_u.shape, self.lambda_u.dtype)
         # print("vector_u", self.vector_u.shape, self.vector_u.dtype)
 
+        self.velocity_sampler = None
         self.lambda_u_interpolator = ST.createInterpolator(self.lambda_u)
         self.lambda_v_interpolator = ST.createInterpolator(self.lambda_v)
         # TODO: vector_u can abruptly change sign in areas of
@@ -861,3 +1100,102 @@ class ST(object):
         self.linearity_interpolator = ST.createInterpolator(self.linearity)
         self.coherence_interpolator = ST.createInterpolator(self.coherence)
 
+
+
+# Cache of structure-tensor fields, so that repeated
+# auto-interpolation and auto-extrapolation in the same slice
+# do not recompute them.
+# The slice is divided into square tiles of a fixed size;
+# the fields of each tile are computed from the tile's data
+# plus a surrounding margin, so that (away from the edges of
+# the slice) the fields do not depend on where the tile
+# boundaries fall.
+# Tiles are keyed by (slice_key, ti, tj), where slice_key
+# identifies the slice (for instance volume, direction, axis,
+# and slice index) and ti, tj are the tile indexes.
+class STTileCache():
+
+    # class variables
+    tile_size = 256
+    # the distance over which the fields depend on the
+    # image (38 pixels, with the default sigmas)
+    margin = ST.kernelReach()
+    # each tile takes about 4.5 Mb
+    max_tiles = 40
+    # number of threads used to compute missing tiles
+    compute_threads = 4
+
+    def __init__(self):
+        # dict values are (image, st_all); dicts preserve
+        # insertion order, and a tile is moved to the end
+        # whenever it is used, so the first tile is
+        # the least recently used one
+        self.tiles = {}
+
+    def clear(self):
+        self.tiles = {}
+
+    # class function
+    # Computes the fields of tile (ti, tj).
+    # get_data(i0, i1, j0, j1) returns the slice data (float64,
+    # in the range 0 to 1), indexed [j,i], in the given range.
+    # extent is (ni, nj), the size of the full slice.
+    # Returns (image, st_all) for the tile, without the margin.
+    def computeTile(get_data, ti, tj, extent):
+        ts = STTileCache.tile_size
+        m = STTileCache.margin
+        ni, nj = extent
+        i0, j0 = ti*ts, tj*ts
+        i1, j1 = min(i0+ts, ni), min(j0+ts, nj)
+        pi0, pj0 = max(i0-m, 0), max(j0-m, 0)
+        pi1, pj1 = min(i1+m, ni), min(j1+m, nj)
+        st = ST(get_data(pi0, pi1, pj0, pj1))
+        st.computeEigens()
+        sj = slice(j0-pj0, j1-pj0)
+        si = slice(i0-pi0, i1-pi0)
+        return st.image[sj,si].copy(), st.eigenStack()[sj,si].copy()
+
+    # Returns an ST covering the rectangle ij0, ij1 (in slice
+    # coordinates; ij1 is exclusive) of the slice identified
+    # by slice_key, with its eigen fields already set.
+    # Missing tiles are computed, in worker threads, by calling
+    # get_data (see computeTile); extent is (ni, nj), the size
+    # of the full slice.
+    def getST(self, slice_key, get_data, ij0, ij1, extent):
+        ts = STTileCache.tile_size
+        i0, j0 = int(ij0[0]), int(ij0[1])
+        i1, j1 = int(ij1[0]), int(ij1[1])
+        tis = range(i0//ts, (i1-1)//ts+1)
+        tjs = range(j0//ts, (j1-1)//ts+1)
+        keys = [(slice_key, ti, tj) for tj in tjs for ti in tis]
+        missing = [key for key in keys if key not in self.tiles]
+        if len(missing) > 0:
+            # print("computing", len(missing), "of", len(keys), "st tiles")
+            nthreads = min(STTileCache.compute_threads, len(missing))
+            with ThreadPoolExecutor(max_workers=nthreads) as executor:
+                results = list(executor.map(
+                    lambda key: STTileCache.computeTile(get_data, key[1], key[2], extent), missing))
+            for key, result in zip(missing, results):
+                self.tiles[key] = result
+
+        image = np.zeros((j1-j0, i1-i0), dtype=np.float64)
+        st_all = np.zeros((j1-j0, i1-i0, 8), dtype=np.float64)
+        for key in keys:
+            ti, tj = key[1], key[2]
+            timage, tst_all = self.tiles.pop(key)
+            # move the tile to the most-recently-used end
+            self.tiles[key] = (timage, tst_all)
+            ti0, tj0 = ti*ts, tj*ts
+            # intersection of the tile and the rectangle,
+            # in slice coordinates
+            ci0, ci1 = max(ti0, i0), min(ti0+timage.shape[1], i1)
+            cj0, cj1 = max(tj0, j0), min(tj0+timage.shape[0], j1)
+            image[cj0-j0:cj1-j0, ci0-i0:ci1-i0] = timage[cj0-tj0:cj1-tj0, ci0-ti0:ci1-ti0]
+            st_all[cj0-j0:cj1-j0, ci0-i0:ci1-i0] = tst_all[cj0-tj0:cj1-tj0, ci0-ti0:ci1-ti0]
+        # keep at least the tiles that were just used
+        while len(self.tiles) > max(STTileCache.max_tiles, len(keys)):
+            del self.tiles[next(iter(self.tiles))]
+
+        st = ST(image)
+        st.setEigens(st_all)
+        return st
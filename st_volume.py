@@ -0,0 +1,401 @@
+import os
+import sys
+import pathlib
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+import zarr
+from scipy import ndimage
+
+from utils import Utils
+from st import ST
+from volume import Volume
+from volume_zarr import CachedZarrVolume, ZarrLevel
+
+# A precomputed 3D structure-tensor field of a khartes data
+# volume (NRRD, or zarr/TIFF), stored as a chunked zarr array
+# next to the volume file: the field of volumes/scroll.volzarr
+# is volumes/scroll.st.zarr.
+# The array, named "st", is indexed [k,j,i,c] in the same
+# (data) grid as the volume, and holds float16 values:
+# c = 0, 1, 2: the unit normal to the layering (the eigenvector
+#   of the largest eigenvalue of the structure tensor), in
+#   i,j,k order; its k component is always >= 0
+# c = 3: the coherence ((l1-l2)/(l1+l2))**2, where l1 >= l2 are
+#   the two largest eigenvalues; 0 where there is no gradient.
+# The field is computed out-of-core, one chunk at a time, in
+# worker processes; each chunk is computed from the volume data
+# in the chunk plus a margin (halo) that is wide enough that
+# the result does not depend on the chunk boundaries.
+# The field is read through the same thread-safe chunk cache
+# as a CachedZarrVolume.
+class StructureTensorVolume():
+
+    # class variable
+    # in a worker process, set by initWorker to
+    # (volume, st_array, sigma0, sigma1)
+    worker = None
+
+    # class variable
+    # gaussian kernels are truncated at this many sigmas
+    truncate = 3.
+
+    # class variable
+    # fields that have been loaded, indexed by path; the
+    # value is None if there is no field for that path
+    loaded = {}
+
+    def __init__(self):
+        self.valid = False
+        self.error = "no error message set"
+        self.path = None
+        self.level = None
+        self.data = None
+        self.sigma0 = 0.
+        self.sigma1 = 0.
+
+    # class function
+    def createErrorVolume(err):
+        stv = StructureTensorVolume()
+        stv.error = err
+        return stv
+
+    # class function
+    # Path of the structure-tensor field of the given
+    # khartes volume file (.nrrd or .volzarr)
+    def pathForVolumeFile(volume_path):
+        volume_path = pathlib.Path(volume_path)
+        return volume_path.with_name(volume_path.stem + ".st.zarr")
+
+    # class function
+    # Width of the margin needed around each chunk
+    def halo(sigma0, sigma1):
+        t = StructureTensorVolume.truncate
+        # scipy.ndimage's kernel radius is int(truncate*sigma+.5)
+        return int(t*sigma0+.5) + int(t*sigma1+.5)
+
+    # class function
+    # Loads a structure-tensor field.  Returns the field;
+    # check the valid flag and the error string.
+    def loadFile(path, max_mem_gb=1.):
+        path = pathlib.Path(path)
+        try:
+            group = zarr.open_group(str(path), mode="r")
+            st = group["st"]
+        except Exception as e:
+            err = "Could not read structure-tensor field %s: %s"%(path, e)
+            print(err)
+            return StructureTensorVolume.createErrorVolume(err)
+        if st.ndim != 4 or st.shape[3] != 4:
+            err = "Structure-tensor field %s has shape %s; expected (nk,nj,ni,4)"%(path, str(st.shape))
+            print(err)
+            return StructureTensorVolume.createErrorVolume(err)
+        stv = StructureTensorVolume()
+        stv.path = path
+        stv.sigma0 = group.attrs.get("sigma0", 0.)
+        stv.sigma1 = group.attrs.get("sigma1", 0.)
+        stv.level = ZarrLevel(group, "st", 1., 0, max_mem_gb)
+        stv.data = stv.level.data
+        stv.valid = True
+        return stv
+
+    # class function
+    # Returns the structure-tensor field that was computed for
+    # volume (loading it the first time it is needed), or None
+    # if there is none.
+    # Volumes from vc_render are not supported.
+    def forVolume(volume):
+        if volume.from_vc_render:
+            return None
+        path = StructureTensorVolume.pathForVolumeFile(volume.path)
+        key = str(path)
+        stv = StructureTensorVolume.loaded.get(key, None)
+        if stv is None and path.exists():
+            stv = StructureTensorVolume.loadFile(path)
+            if not stv.valid:
+                stv = None
+            StructureTensorVolume.loaded[key] = stv
+        return stv
+
+    # Returns the field values at the given data ijks (i, j,
+    # and k are int arrays of the same shape), as an array of
+    # float64, of shape i.shape + (4,).  Points outside the
+    # volume get zeros.  The data is read synchronously.
+    def sampleDataIjks(self, i, j, k):
+        shape = self.data.shape
+        out = np.zeros(i.shape+(4,), dtype=np.float64)
+        inside = ((i >= 0) & (i < shape[2]) &
+                  (j >= 0) & (j < shape[1]) &
+                  (k >= 0) & (k < shape[0]))
+        if not inside.any():
+            return out
+        i, j, k = i[inside], j[inside], k[inside]
+        i0, j0, k0 = i.min(), j.min(), k.min()
+        self.level.setImmediateDataMode(True)
+        try:
+            box = self.data[k0:k.max()+1, j0:j.max()+1, i0:i.max()+1]
+        finally:
+            self.level.setImmediateDataMode(False)
+        out[inside] = box[k-k0, j-j0, i-i0]
+        return out
+
+    # Returns the field values (as in sampleDataIjks) at the
+    # given global positions (an array of [x, y, z] rows) of
+    # volume, rounded to the nearest voxel.
+    # Normals have no consistent sign; if ref_normals (an
+    # array of normals in x, y, z order, one per position)
+    # is given, each normal is flipped if necessary to point
+    # the same way as the corresponding reference normal.
+    def sampleGlobalPositions(self, volume, gpoints, ref_normals=None):
+        g0 = np.array(volume.gijk_starts)
+        dg = np.array(volume.gijk_steps)
+        ijks = np.rint((np.asarray(gpoints, dtype=np.float64)-g0)/dg).astype(np.int64)
+        out = self.sampleDataIjks(ijks[:,0], ijks[:,1], ijks[:,2])
+        if ref_normals is not None:
+            flip = (out[:,:3]*ref_normals).sum(axis=1) < 0
+            out[flip,:3] *= -1
+        return out
+
+    # Returns an ST, with eigen fields set, covering the
+    # rectangle ij0, ij1 (transposed data coordinates; ij1
+    # is exclusive) of slice k (along axis) of volume_view.
+    # The ST's eigenvector u is the projection of the 3D normal
+    # onto the plane of the slice, and its coherence is the 3D
+    # coherence, reduced where the normal is nearly perpendicular
+    # to the plane.  image is the slice data in the rectangle,
+    # indexed [j,i]; it is used only for the gradient.
+    def createST(self, volume_view, axis, k, ij0, ij1, image):
+        volume = volume_view.volume
+        i0, j0 = int(ij0[0]), int(ij0[1])
+        i1, j1 = int(ij1[0]), int(ij1[1])
+        iaxis, jaxis = volume.ijIndexesInPlaneOfSlice(axis)
+        tijk = [None]*3
+        tijk[iaxis], tijk[jaxis] = np.meshgrid(np.arange(i0, i1), np.arange(j0, j1))
+        tijk[axis] = np.full(tijk[iaxis].shape, k)
+        # perm[d] is the transposed axis that corresponds
+        # to data axis d
+        perm = volume.transposedIjkToIjk((0,1,2), volume_view.direction)
+        values = self.sampleDataIjks(tijk[perm[0]], tijk[perm[1]], tijk[perm[2]])
+        vu = np.stack((values[:,:,perm.index(iaxis)], values[:,:,perm.index(jaxis)]), axis=2)
+        # length of the in-plane part of the normal
+        vulen = np.sqrt((vu*vu).sum(axis=2))
+        coherence = values[:,:,3]*vulen*vulen
+        vulen[vulen==0] = 1
+        vu /= vulen[:,:,np.newaxis]
+        # same sign conventions as ST.computeEigens: the y
+        # component of u is >= 0, the x component of v is >= 0
+        vu[vu[:,:,1]<0] *= -1
+        vv = np.stack((vu[:,:,1], -vu[:,:,0]), axis=2)
+        vv[vv[:,:,0]<0] *= -1
+        # eigenvalues consistent with the coherence
+        r = np.sqrt(np.clip(coherence, 0., 1.))
+        lu = np.ones(coherence.shape, dtype=np.float64)
+        lv = (1-r)/(1+r)
+
+        st = ST(image)
+        gx, gy = st.computeGradient()
+        st_all = np.concatenate((lu[:,:,np.newaxis], lv[:,:,np.newaxis], vu, vv, gx[:,:,np.newaxis], gy[:,:,np.newaxis]), axis=2)
+        st.setEigens(st_all)
+        return st
+
+    # class function
+    # Computes the normals and coherences of a (3D) block of data.
+    # Returns an array of shape block.shape+(4,), in the
+    # layout of the "st" array
+    def computeBlock(block, sigma0, sigma1):
+        t = StructureTensorVolume.truncate
+        block = block.astype(np.float32)
+        # gradient in i, j, k order (block is indexed [k,j,i])
+        grad = [ndimage.gaussian_filter(block, sigma0, order=order, truncate=t)
+                for order in ((0,0,1), (0,1,0), (1,0,0))]
+        # the six distinct components of the structure tensor
+        pairs = ((0,0), (1,1), (2,2), (0,1), (0,2), (1,2))
+        comps = [ndimage.gaussian_filter(grad[a]*grad[b], sigma1, truncate=t) for a,b in pairs]
+        grad = None
+        tensor = np.zeros(block.shape+(3,3), dtype=np.float32)
+        for (a,b), comp in zip(pairs, comps):
+            tensor[...,a,b] = comp
+            tensor[...,b,a] = comp
+        comps = None
+        # eigenvalues are in ascending order
+        evals, evecs = np.linalg.eigh(tensor)
+        tensor = None
+        l1 = evals[...,2]
+        l2 = evals[...,1]
+        normal = evecs[...,:,2]
+        normal[normal[...,2]<0] *= -1
+        lsum = l1+l2
+        zero = lsum <= 0
+        lsum[zero] = 1
+        coherence = ((l1-l2)/lsum)**2
+        coherence[zero] = 0
+        normal[zero] = 0
+        return np.concatenate((normal, coherence[...,np.newaxis]), axis=-1)
+
+    # class function
+    # Runs in each worker process (and, if there is no pool,
+    # in the calling process).  cache_gb, if not None, is the
+    # size of the zarr chunk cache.
+    def initWorker(volume_path, st_path, sigma0, sigma1, cache_gb=None):
+        if cache_gb is not None:
+            CachedZarrVolume.max_mem_gb = cache_gb
+        volume = StructureTensorVolume.loadVolume(volume_path)
+        # workers always wait for the data
+        volume.setImmediateDataMode(True)
+        st_array = zarr.open_group(str(st_path), mode="r+")["st"]
+        StructureTensorVolume.worker = (volume, st_array, sigma0, sigma1)
+
+    # class function
+    # Computes the chunk whose first corner (in k,j,i order)
+    # is kji0.  Returns the number of voxels computed.
+    def computeChunk(kji0):
+        volume, st_array, sigma0, sigma1 = StructureTensorVolume.worker
+        shape = st_array.shape[:3]
+        halo = StructureTensorVolume.halo(sigma0, sigma1)
+        c0 = [int(c) for c in kji0]
+        c1 = [min(c+n, s) for c,n,s in zip(c0, st_array.chunks, shape)]
+        h0 = [max(c-halo, 0) for c in c0]
+        h1 = [min(c+halo, s) for c,s in zip(c1, shape)]
+        block = volume.data[h0[0]:h1[0], h0[1]:h1[1], h0[2]:h1[2]]
+        result = StructureTensorVolume.computeBlock(np.asarray(block), sigma0, sigma1)
+        inner = tuple(slice(c-h, d-h) for c,d,h in zip(c0, c1, h0))
+        st_array[c0[0]:c1[0], c0[1]:c1[1], c0[2]:c1[2]] = result[inner].astype(np.float16)
+        return (c1[0]-c0[0])*(c1[1]-c0[1])*(c1[2]-c0[2])
+
+    # class function
+    # Loads a khartes volume file (.nrrd or .volzarr); the data
+    # of an NRRD volume is memory-mapped if possible (see
+    # Volume.mapData), and zarr data is read as needed.
+    def loadVolume(path):
+        path = pathlib.Path(path)
+        if path.suffix == ".volzarr":
+            return CachedZarrVolume.loadFile(path)
+        volume = Volume.loadNRRD(path)
+        if volume.valid:
+            volume.mapData()
+        return volume
+
+    # class function
+    # Computes the structure-tensor field of the khartes volume
+    # file volume_path (.nrrd or .volzarr), and writes it to
+    # st_path (by default, next to the volume file; see
+    # pathForVolumeFile); an existing field is overwritten.
+    # sigma0 is the width of the gaussian derivative, sigma1
+    # the width of the gaussian that smooths the tensor.
+    # chunk is the edge length of the (cubic) chunks of the
+    # result, which are also the units of work.
+    # max_workers is the number of worker processes (default is
+    # the number of cpus).
+    # progress, if not None, is called as progress(done, total),
+    # and should return False to cancel the operation.
+    # Returns an error string ("" if no error).
+    def compute(volume_path, st_path=None, sigma0=2., sigma1=8., chunk=128, max_workers=None, cache_gb=1., progress=None):
+        volume_path = pathlib.Path(volume_path)
+        if volume_path.suffix == ".volzarr":
+            volume = CachedZarrVolume.loadFile(volume_path)
+        else:
+            volume = Volume.loadNRRD(volume_path)
+        if not volume.valid:
+            return volume.error
+        if volume.from_vc_render:
+            err = "Volumes from vc_render are not supported"
+            print(err)
+            return err
+        # data shape, in k,j,i order
+        shape = tuple(volume.sizes[::-1])
+        name = volume.name
+        # each worker would have to read the whole of
+        # a compressed NRRD volume into memory
+        mappable = volume.is_zarr or volume.rawDataLayout() is not None
+        volume = None
+        if st_path is None:
+            st_path = StructureTensorVolume.pathForVolumeFile(volume_path)
+        st_path = pathlib.Path(st_path)
+        try:
+            group = zarr.open_group(str(st_path), mode="w")
+            group.zeros("st", shape=shape+(4,), chunks=(chunk,chunk,chunk,4),
+                    dtype=np.float16, write_empty_chunks=False)
+            group.attrs.update({
+                "khartes_version": "1.0",
+                "khartes_created": Utils.timestamp(),
+                "volume": name,
+                "sigma0": sigma0,
+                "sigma1": sigma1,
+                })
+        except Exception as e:
+            err = "Could not create structure-tensor field %s: %s"%(str(st_path), e)
+            print(err)
+            return err
+        StructureTensorVolume.loaded.pop(str(st_path), None)
+
+        corners = [(k,j,i) for k in range(0, shape[0], chunk)
+                   for j in range(0, shape[1], chunk)
+                   for i in range(0, shape[2], chunk)]
+        total = shape[0]*shape[1]*shape[2]
+        args = (str(volume_path), str(st_path), sigma0, sigma1)
+        done = 0
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        max_workers = min(max_workers, len(corners))
+        if not mappable and max_workers > 1:
+            print("Volume data can not be memory-mapped; using one worker process")
+            max_workers = 1
+        if max_workers > 1:
+            # "spawn" rather than "fork", because the calling
+            # process may be running Qt
+            ctx = multiprocessing.get_context("spawn")
+            executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=ctx,
+                    initializer=StructureTensorVolume.initWorker, initargs=args+(cache_gb,))
+            pending = {executor.submit(StructureTensorVolume.computeChunk, corner) for corner in corners}
+            cancelled = False
+            try:
+                while len(pending) > 0 and not cancelled:
+                    # time out periodically, so that the
+                    # caller can respond to the user
+                    finished, pending = wait(pending, timeout=.1, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        done += future.result()
+                    if progress is not None and not progress(done, total):
+                        cancelled = True
+            except Exception as e:
+                err = "Structure-tensor computation failed: %s"%e
+                print(err)
+                executor.shutdown(wait=False, cancel_futures=True)
+                return err
+            executor.shutdown(wait=not cancelled, cancel_futures=True)
+            if cancelled:
+                return "Structure-tensor computation cancelled"
+        else:
+            StructureTensorVolume.initWorker(*args)
+            for corner in corners:
+                done += StructureTensorVolume.computeChunk(corner)
+                if progress is not None and not progress(done, total):
+                    StructureTensorVolume.worker = None
+                    return "Structure-tensor computation cancelled"
+            StructureTensorVolume.worker = None
+        return ""
+
+# The guard is needed because worker processes (which are
+# started using "spawn") import this module
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description="Compute the 3D structure-tensor field of a khartes volume")
+    parser.add_argument("volume", help="khartes volume file (.nrrd or .volzarr)")
+    parser.add_argument("--output", help="zarr directory to create (default: next to the volume file, with the suffix .st.zarr)")
+    parser.add_argument("--sigma0", type=float, default=2., help="width of the gaussian derivative, in voxels (default 2)")
+    parser.add_argument("--sigma1", type=float, default=8., help="width of the tensor smoothing, in voxels (default 8)")
+    parser.add_argument("--chunk", type=int, default=128, help="chunk size, in voxels (default 128)")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: number of cpus)")
+    parser.add_argument("--cache_gb", type=float, default=1., help="size of each worker's zarr chunk cache, in Gb (default 1)")
+    args = parser.parse_args()
+
+    def progress(done, total):
+        print("computed %d of %d voxels"%(done, total))
+        return True
+
+    err = StructureTensorVolume.compute(args.volume, args.output, args.sigma0, args.sigma1, args.chunk, args.workers, args.cache_gb, progress)
+    if err != "":
+        print("Error:", err)
+        sys.exit(1)
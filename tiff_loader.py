@@ -20,6 +20,7 @@ from PyQt5.QtWidgets import (
         )
 from PyQt5.QtCore import QSize, Qt, qVersion, QSettings
 from PyQt5.QtGui import QPalette, QColor, QCursor, QIntValidator
+from color import Color
 
 class ColorEdit(QPushButton):
 
@@ -662,7 +663,7 @@ class TiffLoader(QMainWindow):
             self.main_window.setVolume(new_volume)
             vv = self.main_window.project_view.cur_volume_view
             # vv.setColor(QColor(self.color()))
-            self.main_window.setVolumeViewColor(vv, QColor(self.color()))
+            self.main_window.setVolumeViewColor(vv, Color(self.color().name()))
             # should have been hidden during readerCallback
             self.hide()
         # unset name of volume
@@ -2,12 +2,13 @@ import math
 import json
 import numpy as np
 from pathlib import Path
-from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from utils import Utils
+from obj_reader import ObjReader
+from mesh_writer import MeshWriter
 from base_fragment import BaseFragment, BaseFragmentView
 from fragment import Fragment, FragmentView
-
-from PyQt5.QtGui import QColor
+from color import Color
 
 class TrglFragment(BaseFragment):
     def __init__(self, name):
@@ -16,6 +17,8 @@ class TrglFragment(BaseFragment):
         self.tpoints = np.zeros((0,2), dtype=np.float32)
         self.trgls = np.zeros((0,3), dtype=np.int32)
         self.direction = 0
+        # vertex-to-trgl adjacency; see vertexTrglAdjacency
+        self.vertex_trgls = None
         '''
         self.name = name
         self.trgls = np.zeros((0,3), dtype=np.int32)
@@ -29,54 +32,42 @@ class TrglFragment(BaseFragment):
     def load(obj_file):
         print("loading obj file", obj_file)
         pname = Path(obj_file)
-        try:
-            fd = pname.open("r")
-        except:
+        rdr = ObjReader.read(pname)
+        return TrglFragment.fromObjReader(pname, rdr)
+
+    # class function
+    # Loads a list of obj files, parsing them in parallel.
+    # Returns a list, in the same order as obj_files, where
+    # each element is what load() would have returned for
+    # that file.
+    def loadList(obj_files):
+        pnames = [Path(obj_file) for obj_file in obj_files]
+        print("loading", len(pnames), "obj files")
+        rdrs = ObjReader.readList(pnames)
+        # findNeighbors, which is called by fromObjReader, spends
+        # most of its time in numpy sorts, which release the GIL
+        with ThreadPoolExecutor(max_workers=BaseFragment.load_threads) as executor:
+            return list(executor.map(TrglFragment.fromObjReader, pnames, rdrs))
+
+    # class function
+    def fromObjReader(pname, rdr):
+        if not rdr.valid:
             return None
 
         name = pname.stem
         
-        vrtl = []
-        tvrtl = []
-        trgl = []
-        
-        created = ""
-        frag_name = ""
-        for line in fd:
-            line = line.strip()
-            words = line.split()
-            if words == []: # prevent crash on empty line
-                continue
-            if words[0][0] == '#':
-                if len(words) > 2: 
-                    if words[1] == "Created:":
-                        created = words[2]
-                    if words[1] == "Name:":
-                        frag_name = words[2]
-            elif words[0] == 'v':
-                # len is 7 if the vrt has color attached
-                # (color is ignored)
-                if len(words) == 4 or len(words) == 7:
-                    vrtl.append([float(w) for w in words[1:4]])
-            elif words[0] == 'vt':
-                if len(words) == 3:
-                    tvrtl.append([float(w) for w in words[1:]])
-            elif words[0] == 'f':
-                if len(words) == 4:
-                    # implicit assumption that v == vt
-                    trgl.append([int(w.split('/')[0])-1 for w in words[1:]])
-        print("tf obj reader", len(vrtl), len(tvrtl), len(trgl))
+        created = rdr.commentValue("Created")
+        frag_name = rdr.commentValue("Name")
+        print("tf obj reader", len(rdr.vrts), len(rdr.tvrts), len(rdr.trgls))
         
         if frag_name == "":
         #     frag_name = name.replace("_",":").replace("p",".")
             frag_name = name
         trgl_frag = TrglFragment(frag_name)
-        trgl_frag.gpoints = np.array(vrtl, dtype=np.float32)
-        trgl_frag.tpoints = np.array(tvrtl, dtype=np.float32)
-        if len(trgl) > 0:
-            trgl_frag.trgls = np.array(trgl, dtype=np.int32)
-        else:
-            trgl_frag.trgls = np.zeros((0,3), dtype=np.int32)
+        trgl_frag.gpoints = rdr.vrts
+        # implicit assumption that v == vt
+        trgl_frag.tpoints = rdr.tvrts
+        trgl_frag.trgls = rdr.trgls
         if created == "":
             ts = Utils.vcToTimestamp(name)
             if ts is not None:
@@ -107,7 +98,7 @@ class TrglFragment(BaseFragment):
                     except:
                         continue
                     # print("rgb", r,g,b)
-                    color = QColor.fromRgbF(r,g,b)
+                    color = Color.fromRgbF(r,g,b)
                     break
 
         if color is None:
@@ -145,15 +136,77 @@ class TrglFragment(BaseFragment):
             fpath = path / cfixed
             frag.save(fpath)
 
+    # returns the info and arrays to be stored in
+    # a binary fragment file
+    def binaryInfoAndArrays(self):
+        info = {}
+        info['name'] = self.name
+        info['created'] = self.created
+        info['modified'] = self.modified
+        info['color'] = self.color.name()
+        info['params'] = self.params
+        arrays = {
+                'gpoints': self.gpoints.astype(np.float32, copy=False),
+                'tpoints': self.tpoints.astype(np.float32, copy=False),
+                'trgls': self.trgls.astype(np.int32, copy=False),
+                'neighbors': self.neighbors.astype(np.int32, copy=False),
+                }
+        return info, arrays
+
+    # class function
+    # creates a fragment from the contents of
+    # a binary fragment file
+    def fromBinary(info, arrays):
+        if 'name' not in info:
+            print("binary file missing parameter name")
+            return None
+        for attr in ['gpoints', 'trgls']:
+            if attr not in arrays:
+                print("binary file missing array %s"%attr)
+                return None
+        trgl_frag = TrglFragment(info['name'])
+        trgl_frag.gpoints = arrays['gpoints']
+        trgl_frag.trgls = arrays['trgls']
+        trgl_frag.tpoints = arrays.get('tpoints', np.zeros((0,2), dtype=np.float32))
+        if 'created' in info:
+            trgl_frag.created = info['created']
+        trgl_frag.modified = info.get('modified', trgl_frag.created)
+        trgl_frag.params = info.get('params', {})
+        if 'color' in info:
+            color = Color(info['color'])
+        else:
+            color = Utils.getNextColor()
+        trgl_frag.setColor(color, no_notify=True)
+        if 'neighbors' in arrays and len(arrays['neighbors']) == len(trgl_frag.trgls):
+            trgl_frag.neighbors = arrays['neighbors']
+        else:
+            trgl_frag.neighbors = BaseFragment.findNeighbors(trgl_frag.trgls)
+        trgl_frag.valid = True
+        return trgl_frag
+
+    # Returns (starts, tindexes), the vertex-to-trgl adjacency
+    # (see BaseFragment.vertexTrgls).  It is built the first
+    # time it is needed; a TrglFragment's trgls do not change
+    # after the fragment is created.
+    def vertexTrglAdjacency(self):
+        if self.vertex_trgls is None:
+            self.vertex_trgls = BaseFragment.vertexTrgls(self.trgls, len(self.gpoints))
+        return self.vertex_trgls
+
     # class function
-    def saveListAsObjMesh(fvs, path, infill, ppm, class_count):
+    # tex_volume is ignored, since no texture is exported
+    def saveListAsObjMesh(fvs, path, infill, ppm, class_count, progress=None, tex_volume=None):
         print("TF slaom", len(fvs), class_count)
         name = path.name
         stem = path.stem
-        for fv in fvs:
+        for i, fv in enumerate(fvs):
+            if progress is not None and not progress(i, len(fvs)):
+                err = "Export cancelled"
+                print(err)
+                return err
             frag = fv.fragment
             if class_count > 1 or len(fvs) > 1:
-                newname = stem+"_"+frag.name
+                newname = stem+"_"+frag.name+path.suffix
                 opath = path.with_name(newname)
             else:
                 opath = path
@@ -162,7 +215,24 @@ class TrglFragment(BaseFragment):
 
         return ""
 
+    # writes a binary PLY file if fpath has a .ply suffix;
+    # otherwise writes OBJ and MTL files
     def save(self, fpath, ppm=None, fv=None):
+        ns = BaseFragment.pointNormals(self.gpoints, self.trgls)
+        vrts = self.gpoints
+        if ppm is not None:
+            vrts = ppm.layerIjksToScrollIjks(vrts)
+        has_texture = (len(self.tpoints) == len(self.gpoints))
+        if fpath.suffix.lower() == ".ply":
+            print("TF save", fpath)
+            tvrts = None
+            if has_texture:
+                tvrts = self.tpoints
+            comments = ["Created: %s"%self.created, "Name: %s"%self.name]
+            MeshWriter.writePly(fpath, vrts, self.trgls, tvrts, ns, comments)
+            self.saveExportInfo(fpath, fv)
+            return
+
         obj_path = fpath.with_suffix(".obj")
         name = fpath.name
         print("TF save", obj_path)
@@ -172,33 +242,26 @@ class TrglFragment(BaseFragment):
         print("# Created: %s"%self.created, file=of)
         print("# Name: %s"%self.name, file=of)
         print("# Vertices: %d"%len(self.gpoints), file=of)
-        ns = BaseFragment.pointNormals(self.gpoints, self.trgls)
-        vrts = self.gpoints
-        if ppm is not None:
-            vrts = ppm.layerIjksToScrollIjks(vrts)
-        for i, pt in enumerate(vrts):
-            print("v %f %f %f"%(pt[0], pt[1], pt[2]), file=of)
-            if ns is not None:
-                n = ns[i]
-                print("vn %f %f %f"%(n[0], n[1], n[2]), file=of)
+        if ns is not None:
+            # each vertex is followed by its normal
+            MeshWriter.writeRows(of, "v %f %f %f\nvn %f %f %f",
+                    np.concatenate((vrts, ns), axis=1))
+        else:
+            MeshWriter.writeRows(of, "v %f %f %f", vrts)
         print("# Color and texture information", file=of)
         # print("mtllib %s.mtl"%self.name, file=of)
         print("mtllib %s.mtl"%name, file=of)
         print("usemtl default", file=of)
-        has_texture = (len(self.tpoints) == len(self.gpoints))
         if has_texture:
-            for i, pt in enumerate(self.tpoints):
-                print("vt %f %f"%(pt[0], pt[1]), file=of)
+            MeshWriter.writeRows(of, "vt %f %f", self.tpoints)
         print("# Faces: %d"%len(self.trgls), file=of)
-        for trgl in self.trgls:
-            ostr = "f"
-            for i in range(3):
-                v = trgl[i]+1
-                if has_texture:
-                    ostr += " %d/%d/%d"%(v,v,v)
-                else:
-                    ostr += " %d/%d"%(v,v)
-            print(ostr, file=of)
+        if has_texture:
+            MeshWriter.writeRows(of, "f %d/%d/%d %d/%d/%d %d/%d/%d",
+                    np.repeat(self.trgls+1, 3, axis=1))
+        else:
+            MeshWriter.writeRows(of, "f %d/%d %d/%d %d/%d",
+                    np.repeat(self.trgls+1, 2, axis=1))
+        of.close()
         mtl_path = fpath.with_suffix(".mtl")
         try:
             of = mtl_path.open("w")
@@ -216,7 +279,12 @@ class TrglFragment(BaseFragment):
         # TODO: print this only if TIFF file exists
         # if has_texture:
         #     print("map_Kd %s.tif"%name, file=of)
+        of.close()
+
+        self.saveExportInfo(fpath, fv)
 
+    # writes the json file that accompanies an exported mesh
+    def saveExportInfo(self, fpath, fv):
         if fv is not None:
             jfilename = fpath.with_suffix(".json")
             jdict = {}
@@ -231,7 +299,7 @@ class TrglFragment(BaseFragment):
             try:
                 ofj = jfilename.open("w")
                 print(info_txt, file=ofj)
-            except Excepton as e:
+            except Exception as e:
                 print("Could not open %s: %s"%(str(jfilename), e))
                 return
 
@@ -364,6 +432,8 @@ class TrglFragmentView(BaseFragmentView):
 
     # TODO: if cur_volume_view changed, unset working region
     def setLocalPoints(self, recursion_ok=True, always_update_zsurfs=True):
+        self.geometry_pending = False
+        self.clearSliceCache()
         if self.cur_volume_view is None:
             self.vpoints = np.zeros((0,4), dtype=np.float32)
             self.fpoints = self.vpoints
@@ -398,12 +468,6 @@ class TrglFragmentView(BaseFragmentView):
         self.setWorkingRegion(-1, 0.)
         super(TrglFragmentView, self).setVolumeView(vol_view)
 
-    def pushFragmentState(self):
-        pass
-
-    def popFragmentState(self):
-        pass
-
     def setWorkingRegion(self, index, max_angle):
         if index < 0:
             # self.working_trgls = np.zeros((0, 3), dtype=np.int32)
@@ -481,8 +545,10 @@ class TrglFragmentView(BaseFragmentView):
 
     # outputs a list of lines; each line has two vertices
     # NOTE that input axis and position are in local tijk coordinates,
-    # and that output vertices are in tijk coordinates
-    def getLinesOnSlice(self, axis, axis_pos):
+    # and that output vertices are in tijk coordinates.
+    # Called via BaseFragmentView.getLinesOnSlice, which caches
+    # the result.
+    def computeLinesOnSlice(self, axis, axis_pos):
         '''
         tijk = [0,0,0]
         tijk[axis] = axis_pos
@@ -509,6 +575,7 @@ class TrglFragmentView(BaseFragmentView):
         new_gijk = self.cur_volume_view.transposedIjkToGlobalPosition(new_vijk)
         # print(self.fragment.gpoints)
         # print(match, new_gijk)
+        self.fragment.history.record(self.fragment.gpoints, moved=([index], new_gijk))
         self.fragment.gpoints[index, :] = new_gijk
         # print(self.fragment.gpoints)
         self.fragment.notifyModified()
@@ -518,7 +585,12 @@ class TrglFragmentView(BaseFragmentView):
         self.setLocalPoints(True, False)
         return True
 
-    # returns list of trgl indexes
+    # Returns an array of the indexes of the trgls in the
+    # region around point ptind: the trgls that are connected
+    # to ptind through trgls whose normals are within max_angle
+    # of the (local) z direction.
+    # The region is grown by a breadth-first search, with
+    # the whole frontier processed at once.
     def regionByNormals(self, ptind, max_angle):
         pts = self.fpoints
         trgls = self.fragment.trgls
@@ -526,43 +598,26 @@ class TrglFragmentView(BaseFragmentView):
         minz = math.cos(math.radians(max_angle))
         # print("minz", minz)
         normals = BaseFragment.faceNormals(pts, trgls)
-        trgl_stack = deque()
-        tap = BaseFragment.trglsAroundPoint(ptind, trgls)
+        starts, tindexes = self.fragment.vertexTrglAdjacency()
+        tap = tindexes[starts[ptind]:starts[ptind+1]]
         zsgn = np.sum(normals[tap,2])
         # print("zsgn", zsgn)
         if zsgn < 0:
             zsgn = -1
         else:
             zsgn = 1
-        # print("tap", tap)
-        trgl_stack.extend(tap)
-        done = set()
-        out_trgls = []
-        while len(trgl_stack) > 0:
-            trgl = trgl_stack.pop()
-            # print("1", trgl)
-            if trgl in done:
-                continue
-            done.add(trgl)
-            # print("2", trgl)
-            n = normals[trgl]
-            # print("n", n)
-            # if abs(n[2]) < minz:
-            if zsgn*n[2] < minz:
-                continue
-            # print("3", trgl)
-            out_trgls.append(trgl)
-            for neigh in neighbors[trgl]:
-                # print("4", neigh)
-                if neigh < 0:
-                    continue
-                # print("5", neigh)
-                if neigh in done:
-                    continue
-                # print("6", neigh)
-                trgl_stack.append(neigh)
-            # print("ts", len(trgl_stack))
-        return out_trgls
+        # trgls whose normals are acceptable
+        good = zsgn*normals[:,2] >= minz
+        in_region = np.zeros(len(trgls), dtype=np.bool_)
+        frontier = tap[good[tap]]
+        in_region[frontier] = True
+        while len(frontier) > 0:
+            neighs = neighbors[frontier].ravel()
+            neighs = neighs[neighs >= 0]
+            neighs = neighs[good[neighs] & ~in_region[neighs]]
+            frontier = np.unique(neighs)
+            in_region[frontier] = True
+        return np.nonzero(in_region)[0]
 
 
 
@@ -3,11 +3,7 @@ import random
 import datetime
 import re
 import numpy as np
-from PyQt5.QtGui import QColorConstants as QCC
-from PyQt5.QtGui import QColor
-# import PyQt5.QtGuiQColor.SVG as QtSVG
-
-c1 = QCC.Svg.skyblue
+from color import Color
 
 
 class Utils:
@@ -56,9 +52,8 @@ class Utils:
         s = random.randrange(128,255)
         l = 128
         v = 255
-        color = QColor()
         # color.setHsl(h,s,l)
-        color.setHsv(h,s,v)
+        color = Color.fromHsv(h,s,v)
         # rgba = color.getRgbF()
         # print(color.name())
         # cvcolor = [int(65535*c) for c in rgba]
@@ -93,9 +88,67 @@ class Utils:
                 d[k] = v
         return d
 
-    # https://stackoverflow.com/questions/64414944/hot-to-get-the-set-difference-of-two-2d-numpy-arrays-or-equivalent-of-np-setdif
     # returns indices of rows in a that do not appear in b
     def setDiff2DIndex(a, b):
+        return Utils.setDiffs2DIndex(a, b)[0]
+
+    # a and b are 2D arrays with the same number of columns.
+    # Returns (indices of rows in a that do not appear in b,
+    # indices of rows in b that do not appear in a).
+    # Both differences are found using a single sort.
+    def setDiffs2DIndex(a, b):
+        na = len(a)
+        ids, nids = Utils.rowIds(np.concatenate((a, b)))
+        ida = ids[:na]
+        idb = ids[na:]
+        in_a = np.zeros(nids, dtype=np.bool_)
+        in_a[ida] = True
+        in_b = np.zeros(nids, dtype=np.bool_)
+        in_b[idb] = True
+        return (~in_b[ida]).nonzero()[0], (~in_a[idb]).nonzero()[0]
+
+    # Returns (ids, nids): ids gives, for each row of the 2D
+    # array a, an integer in the range 0 to nids-1, with equal
+    # rows having equal ids and different rows different ids.
+    # The rows are hashed to 64-bit keys, so that only the
+    # keys, rather than the rows, need to be sorted; rows
+    # that share a key are checked for equality, and in the
+    # (very unlikely) event of a hash collision, the rows
+    # themselves are sorted instead.
+    # Rows are compared bit by bit (except that -0. equals 0.).
+    def rowIds(a):
+        a = np.ascontiguousarray(a)
+        if a.dtype.kind == 'f':
+            # so that -0. and 0. are equal
+            a = a + 0.
+        n = len(a)
+        if n == 0:
+            return np.zeros(0, dtype=np.int64), 0
+        u = a.view(np.dtype('u%d'%a.dtype.itemsize)).reshape(n, -1).astype(np.uint64)
+        # FNV-1a style hash of the columns, with extra mixing
+        h = np.full(n, 0xcbf29ce484222325, dtype=np.uint64)
+        with np.errstate(over='ignore'):
+            for col in u.T:
+                h ^= col
+                h *= np.uint64(0x100000001b3)
+                h ^= h >> np.uint64(29)
+        order = np.argsort(h)
+        hs = h[order]
+        starts = np.ones(n, dtype=np.bool_)
+        starts[1:] = hs[1:] != hs[:-1]
+        ids = np.empty(n, dtype=np.int64)
+        ids[order] = np.cumsum(starts)-1
+        first = order[starts]
+        if (u != u[first[ids]]).any():
+            print("rowIds: hash collision; sorting rows")
+            rows = a.view(np.dtype((np.void, a.dtype.itemsize*u.shape[1]))).ravel()
+            keys, ids = np.unique(rows, return_inverse=True)
+            return ids.reshape(-1), len(keys)
+        return ids, len(first)
+
+    # https://stackoverflow.com/questions/64414944/hot-to-get-the-set-difference-of-two-2d-numpy-arrays-or-equivalent-of-np-setdif
+    # returns indices of rows in a that do not appear in b
+    def setDiff2DIndexOld(a, b):
         nrows, ncols = a.shape
         # print("rows, cols",nrows, ncols)
         adt = a.dtype
@@ -116,6 +169,23 @@ class Utils:
         # print(nzc)
         return nzc
 
+    # Trilinear interpolation in the 3D array arr.
+    # i0s (shape (n,3), integer) are the indices of the lower
+    # corner of each point's interpolation cell, and fracs
+    # (shape (n,3)) are the fractional positions within the cells.
+    # The upper corners (i0s+1) must be inside arr.
+    # Returns a float32 array of length n.
+    def trilinear(arr, i0s, fracs):
+        b0, b1, b2 = i0s.T
+        f0, f1, f2 = fracs.astype(np.float32).T
+        g0, g1, g2 = 1.-f0, 1.-f1, 1.-f2
+        return (
+            g0*(g1*(g2*arr[b0,b1,b2]+f2*arr[b0,b1,b2+1]) +
+                f1*(g2*arr[b0,b1+1,b2]+f2*arr[b0,b1+1,b2+1])) +
+            f0*(g1*(g2*arr[b0+1,b1,b2]+f2*arr[b0+1,b1,b2+1]) +
+                f1*(g2*arr[b0+1,b1+1,b2]+f2*arr[b0+1,b1+1,b2+1]))
+            ).astype(np.float32)
+
     # adapted from https://stackoverflow.com/questions/25068538/intersection-and-difference-of-two-rectangles/25068722#25068722
     # The C++ version of OpenCV provides operations, including intersection,
     # on rectangles, but the Python version doesn't.
@@ -157,150 +227,3 @@ class Utils:
         ru = ((min(ax1,bx1), min(ay1,by1)),
               (max(ax2,bx2), max(ay2,by2)))
         return ru
-
-    def getNextColorOld():
-        Utils.colorCounter = (Utils.colorCounter+1)%len(Utils.colors)
-        color = Utils.colors[Utils.colorCounter]
-        color = Utils.colors[random.randrange(len(Utils.colors))]
-        rgba = color.getRgbF()
-        return [int(65535*c) for c in rgba]
-
-
-    colorCounter = 7
-    colors= [
-    QCC.Svg.aliceblue,
-    QCC.Svg.aqua,
-    QCC.Svg.aquamarine,
-    QCC.Svg.azure,
-    QCC.Svg.beige,
-    QCC.Svg.bisque,
-    QCC.Svg.black,
-    QCC.Svg.blanchedalmond,
-    QCC.Svg.blue,
-    QCC.Svg.blueviolet,
-    QCC.Svg.brown,
-    QCC.Svg.burlywood,
-    QCC.Svg.cadetblue,
-    QCC.Svg.chartreuse,
-    QCC.Svg.chocolate,
-    QCC.Svg.coral,
-    QCC.Svg.cornflowerblue,
-    QCC.Svg.cornsilk,
-    QCC.Svg.crimson,
-    QCC.Svg.cyan,
-    QCC.Svg.darkblue,
-    QCC.Svg.darkcyan,
-    QCC.Svg.darkgoldenrod,
-    QCC.Svg.darkgray,
-    QCC.Svg.darkgreen,
-    QCC.Svg.darkkhaki,
-    QCC.Svg.darkmagenta,
-    QCC.Svg.darkolivegreen,
-    QCC.Svg.darkorange,
-    QCC.Svg.darkorchid,
-    QCC.Svg.darkred,
-    QCC.Svg.darksalmon,
-    QCC.Svg.darkseagreen,
-    QCC.Svg.darkslateblue,
-    QCC.Svg.darkslategray,
-    QCC.Svg.darkturquoise,
-    QCC.Svg.darkviolet,
-    QCC.Svg.deeppink,
-    QCC.Svg.deepskyblue,
-    QCC.Svg.dimgray,
-    QCC.Svg.dodgerblue,
-    QCC.Svg.firebrick,
-    QCC.Svg.forestgreen,
-    QCC.Svg.fuchsia,
-    QCC.Svg.gainsboro,
-    QCC.Svg.gold,
-    QCC.Svg.goldenrod,
-    QCC.Svg.gray,
-    QCC.Svg.green,
-    QCC.Svg.greenyellow,
-    QCC.Svg.honeydew,
-    QCC.Svg.hotpink,
-    QCC.Svg.indianred,
-    QCC.Svg.indigo,
-    QCC.Svg.ivory,
-    QCC.Svg.khaki,
-    QCC.Svg.lavender,
-    QCC.Svg.lavenderblush,
-    QCC.Svg.lawngreen,
-    QCC.Svg.lemonchiffon,
-    QCC.Svg.lightblue,
-    QCC.Svg.lightcoral,
-    QCC.Svg.lightcyan,
-    QCC.Svg.lightgoldenrodyellow,
-    QCC.Svg.lightgray,
-    QCC.Svg.lightgreen,
-    QCC.Svg.lightpink,
-    QCC.Svg.lightsalmon,
-    QCC.Svg.lightseagreen,
-    QCC.Svg.lightskyblue,
-    QCC.Svg.lightslategray,
-    QCC.Svg.lightsteelblue,
-    QCC.Svg.lightyellow,
-    QCC.Svg.lime,
-    QCC.Svg.limegreen,
-    QCC.Svg.linen,
-    QCC.Svg.magenta,
-    QCC.Svg.maroon,
-    QCC.Svg.mediumaquamarine,
-    QCC.Svg.mediumblue,
-    QCC.Svg.mediumorchid,
-    QCC.Svg.mediumpurple,
-    QCC.Svg.mediumseagreen,
-    QCC.Svg.mediumslateblue,
-    QCC.Svg.mediumspringgreen,
-    QCC.Svg.mediumturquoise,
-    QCC.Svg.mediumvioletred,
-    QCC.Svg.midnightblue,
-    QCC.Svg.mintcream,
-    QCC.Svg.mistyrose,
-    QCC.Svg.moccasin,
-    QCC.Svg.navy,
-    QCC.Svg.oldlace,
-    QCC.Svg.olive,
-    QCC.Svg.olivedrab,
-    QCC.Svg.orange,
-    QCC.Svg.orangered,
-    QCC.Svg.orchid,
-    QCC.Svg.palegoldenrod,
-    QCC.Svg.palegreen,
-    QCC.Svg.paleturquoise,
-    QCC.Svg.palevioletred,
-    QCC.Svg.papayawhip,
-    QCC.Svg.peachpuff,
-    QCC.Svg.peru,
-    QCC.Svg.pink,
-    QCC.Svg.plum,
-    QCC.Svg.powderblue,
-    QCC.Svg.purple,
-    QCC.Svg.red,
-    QCC.Svg.rosybrown,
-    QCC.Svg.royalblue,
-    QCC.Svg.saddlebrown,
-    QCC.Svg.salmon,
-    QCC.Svg.sandybrown,
-    QCC.Svg.seagreen,
-    QCC.Svg.seashell,
-    QCC.Svg.sienna,
-    QCC.Svg.silver,
-    QCC.Svg.skyblue,
-    QCC.Svg.slateblue,
-    QCC.Svg.slategray,
-    QCC.Svg.snow,
-    QCC.Svg.springgreen,
-    QCC.Svg.steelblue,
-    QCC.Svg.tan,
-    QCC.Svg.teal,
-    QCC.Svg.thistle,
-    QCC.Svg.tomato,
-    QCC.Svg.turquoise,
-    QCC.Svg.violet,
-    QCC.Svg.wheat,
-    QCC.Svg.yellow,
-    QCC.Svg.yellowgreen,
-    ]
-    
@@ -1,8 +1,6 @@
 import pathlib
 import numpy as np
 from utils import Utils
-from PyQt5 import QtCore, QtGui, QtWidgets
-from PyQt5.QtCore import Qt
 import cv2
 import nrrd
 import nrrd.writer
@@ -34,309 +32,6 @@ nrrd.writer._write_data = nrrd_write_data_override
 
 # end of code to override pynrrd functionality
 
-class ColorSelectorDelegate(QtWidgets.QStyledItemDelegate):
-    def __init__(self, table, parent=None):
-        super(ColorSelectorDelegate, self).__init__(parent)
-        self.table = table
-        # self.color = QColor()
-
-    def createEditor(self, parent, option, index):
-        # print("ce", index.row())
-        cb = QtWidgets.QPushButton(parent)
-        cb.setContentsMargins(5,5,5,5)
-        cb.clicked.connect(lambda d: self.onClicked(d, cb, index))
-        return cb
-
-    def onClicked(self, cb_index, push_button, model_index):
-        old_color = push_button.palette().color(QtGui.QPalette.Window)
-        new_color = QtWidgets.QColorDialog.getColor(old_color, self.table)
-        # print("old_color",old_color.name(),"new_color",new_color.name())
-        if new_color.isValid() and new_color != old_color:
-            self.setColor(push_button, new_color.name())
-            self.table.model().setData(model_index, new_color, Qt.EditRole)
-
-    # this could be a class function
-    def setColor(self, push_button, color):
-        # color is a string, not a qcolor
-        # print("pb setting color", color)
-        push_button.setStyleSheet("background-color: %s"%color)
-
-    def setEditorData(self, editor, index):
-        # print("sed", index.row(), index.data(Qt.EditRole))
-        # print("sed", index.row(), index.data(Qt.DisplayRole))
-        color = index.data(Qt.DisplayRole)
-        # color is a string
-        if color:
-            # editor.setCurrentIndex(cb_index)
-            self.setColor(editor, color)
-
-    def setModelData(self, editor, model, index):
-        old_color = editor.palette().color(QtGui.QPalette.Window)
-        # print("csd smd", old_color.name())
-
-    def displayText(self, value, locale):
-        return ""
-
-
-class DirectionSelectorDelegate(QtWidgets.QStyledItemDelegate):
-    def __init__(self, table, parent=None):
-        super(DirectionSelectorDelegate, self).__init__(parent)
-        self.table = table
-
-    def createEditor(self, parent, option, index):
-        # print("ce", index.row())
-        cb = QtWidgets.QComboBox(parent)
-        # row = index.row()
-        cb.addItem("X")
-        cb.addItem("Y")
-        cb.activated.connect(lambda d: self.onActivated(d, cb, index))
-        return cb
-
-    def onActivated(self, cb_index, combo_box, model_index):
-        self.table.model().setData(model_index, combo_box.currentText(), Qt.EditRole)
-
-    def setEditorData(self, editor, index):
-        # print("sed", index.row(), index.data(Qt.EditRole))
-        # print("sed", index.row(), index.data(Qt.DisplayRole))
-        cb_index = index.data(Qt.DisplayRole)
-        if cb_index >= 0:
-            editor.setCurrentIndex(cb_index)
-        # return editor
-        # for i in range(15):
-        #     print(i, index.data(i))
-        # otxt = index.data(Qt.EditRole)
-        # cb_index = editor.findText(otxt)
-        # if index >= 0:
-        #     editor.setCurrentIndex(index)
-        # return editor
-
-    def setModelData(self, editor, model, index):
-        pass
-        # print("smd", editor.currentText())
-        # do nothing, since onActivated handled it
-        # model.setData(index, editor.currentText(), Qt.EditRole)
-
-class VolumesModel(QtCore.QAbstractTableModel):
-    def __init__(self, project_view, main_window):
-        super(VolumesModel, self).__init__()
-        # note that self.project_view should not be
-        # changed after initialization; instead, a new
-        # instance of VolumesModel should be created
-        # and attached to the QTableView
-        self.project_view = project_view
-        self.main_window = main_window
-
-    columns = [
-            "Use",
-            "Name",
-            "Color",
-            "Ld",
-            "Dir",
-            "X min",
-            "X max",
-            "dX",
-            "Y min",
-            "Y max",
-            "dY",
-            "Z min",
-            "Z max",
-            "dZ",
-            "Gb",
-            ]
-
-    ctips = [
-            "Select which volume is visible;\nclick box to select",
-            "Name of the volume",
-            "Color of the volume outline drawn on slices;\nclick to edit",
-            "Is volume currently loaded in memory\n(volumes that are not currently displayed\nare unloaded by default)",
-            """Direction (orientation) of the volume;
-X means that the X axis in the original tiff 
-files is aligned with the vertical axes of the slice
-displays; Y means that the Y axis in the original
-tiff files is aligned with the slice vertical axes""",
-            "Minimum X coordinate of the volume,\nrelative to tiff coordinates",
-            "Maximum X coordinate of the volume,\nrelative to tiff coordinates",
-            "X step (number of pixels stepped\nin the X direction in the tiff image\nfor each pixel in the slices)",
-            "Minimum Y coordinate of the volume,\nrelative to tiff coordinates",
-            "Maximum Y coordinate of the volume,\nrelative to tiff coordinates",
-            "Y step (number of pixels stepped\nin the X direction in the tiff image\nfor each pixel in the slices)",
-            "Minimum Z coordinate (image number) of the volume",
-            "Maximum Z coordinate (image number) of the volume",
-            "Z step (number of tiff images stepped for each slice image)",
-            "Data size in Gb (10^9 bytes)",
-            ]
-    
-    def flags(self, index):
-        col = index.column()
-        # if col in (0,1,2):
-        #     return Qt.ItemIsEditable|Qt.ItemIsEnabled
-        oflags = super(VolumesModel, self).flags(index)
-        if col == 0:
-            # print(col, int(oflags))
-            nflags = Qt.ItemNeverHasChildren
-            nflags |= Qt.ItemIsUserCheckable
-            nflags |= Qt.ItemIsEnabled
-            # nflags |= Qt.ItemIsEditable
-            return nflags
-        elif col== 2 or col == 4:
-            nflags = Qt.ItemNeverHasChildren
-            # nflags |= Qt.ItemIsUserCheckable
-            nflags |= Qt.ItemIsEnabled
-            # nflags |= Qt.ItemIsEditable
-            return nflags
-        else:
-            return Qt.ItemNeverHasChildren|Qt.ItemIsEnabled
-
-    def headerData(self, section, orientation, role):
-        if orientation != Qt.Horizontal:
-            return None
-        
-        if role == Qt.DisplayRole:
-            if section == 0:
-                # print("HD", self.rowCount())
-                table = self.main_window.volumes_table
-                # make sure the combo box in column 4 is always open
-                # (so no double-clicking required)
-                for i in range(self.rowCount()):
-                    index = self.createIndex(i, 2)
-                    table.openPersistentEditor(index)
-                    index = self.createIndex(i, 4)
-                    table.openPersistentEditor(index)
-
-            return VolumesModel.columns[section]
-        elif role == Qt.ToolTipRole:
-            return VolumesModel.ctips[section]
-
-    def columnCount(self, parent=None):
-        return len(VolumesModel.columns)
-
-    def rowCount(self, parent=None):
-        if self.project_view is None:
-            return 0
-        volumes = self.project_view.volumes
-        return len(volumes.keys())
-
-    # columns: name, color, direction, xmin, xmax, xstep, y..., img...
-
-    def data(self, index, role):
-        if self.project_view is None:
-            return None
-        if role == Qt.DisplayRole:
-            return self.dataDisplayRole(index, role)
-        elif role == Qt.TextAlignmentRole:
-            return self.dataAlignmentRole(index, role)
-        elif role == Qt.BackgroundRole:
-            return self.dataBackgroundRole(index, role)
-        elif role == Qt.CheckStateRole:
-            return self.dataCheckStateRole(index, role)
-        return None
-
-    def dataCheckStateRole(self, index, role):
-        column = index.column()
-        row = index.row()
-        volumes = self.project_view.volumes
-        volume = list(volumes.keys())[row]
-        selected = (self.project_view.cur_volume == volume)
-        if column == 0:
-            if selected:
-                return Qt.Checked
-            else:
-                return Qt.Unchecked
-
-    def dataAlignmentRole(self, index, role):
-        # column = index.column()
-        # if column >= 4:
-        #     return Qt.AlignVCenter + Qt.AlignRight
-        return Qt.AlignVCenter + Qt.AlignRight
-
-    def dataBackgroundRole(self, index, role):
-        row = index.row()
-        volumes = self.project_view.volumes
-        volume = list(volumes.keys())[row]
-        if self.project_view.cur_volume == volume:
-            return QtGui.QColor(self.main_window.highlightedBackgroundColor())
-
-    def dataDisplayRole(self, index, role):
-        row = index.row()
-        column = index.column()
-        volumes = self.project_view.volumes
-        volume = list(volumes.keys())[row]
-        volume_view = volumes[volume]
-        mins = volume.gijk_starts
-        steps = volume.gijk_steps 
-        sizes = volume.sizes
-        selected = (self.project_view.cur_volume == volume)
-        if column == 1:
-            return volume.name
-        elif column == 2:
-            # print("ddr", row, volume_view.color.name())
-            return volume_view.color.name()
-        elif column == 3:
-            if volume.data is None:
-                return 'No'
-            else:
-                return 'Yes'
-        elif column == 4:
-            # return "%s"%(('X','Y')[volume_view.direction])
-            # print("data display role", row, volume_view.direction)
-            return (0,1)[volume_view.direction]
-
-        elif column >= 5 and column < 14:
-            i3 = column-5
-            i = i3//3
-            j = i3 %3
-            x0 = mins[i]
-            dx = steps[i]
-            nx = sizes[i]
-            if j == 0:
-                return x0
-            elif j == 1:
-                return x0+dx*(nx-1)
-            else:
-                return dx
-        elif column == 14:
-            gb = volume.dataSize()/1000000000
-            # print(volume.name,gb)
-            return "%0.1f"%gb
-        else:
-            return None
-
-    def setData(self, index, value, role):
-        row = index.row()
-        column = index.column()
-        # print("setdata", row, column, value, role)
-        # if role != Qt.EditRole:
-        #     return False
-        if role == Qt.CheckStateRole and column == 0:
-            # print(row, value)
-            if value != Qt.Checked:
-                self.main_window.setVolume(None)
-                return False
-            volumes = self.project_view.volumes
-            volume = list(volumes.keys())[row]
-            volume_view = volumes[volume]
-            self.main_window.setVolume(volume)
-            # return True
-        if role == Qt.EditRole and column == 2:
-            color = value
-            volumes = self.project_view.volumes
-            volume = list(volumes.keys())[row]
-            volume_view = volumes[volume]
-            # print("setdata", row, color.name())
-            # volume_view.setColor(color)
-            self.main_window.setVolumeViewColor(volume_view, color)
-        if role == Qt.EditRole and column == 4:
-            # print("setdata", row, value)
-            direction = 0
-            if value == 'Y':
-                direction = 1
-            volumes = self.project_view.volumes
-            volume = list(volumes.keys())[row]
-            self.main_window.setDirection(volume, direction)
-
-        return False
-
-
 class VolumeView():
 
     def __init__(self, project_view, volume):
@@ -369,9 +64,10 @@ class VolumeView():
         # print("volume view modified", tstamp)
         self.project_view.notifyModified(tstamp)
 
-    def setColor(self, qcolor, no_notify=False):
-        self.color = qcolor
-        rgba = qcolor.getRgbF()
+    # color is a Color (not a QColor)
+    def setColor(self, color, no_notify=False):
+        self.color = color
+        rgba = color.getRgbF()
         self.cvcolor = [int(65535*c) for c in rgba] 
         if not no_notify:
             self.notifyModified()
@@ -765,10 +461,60 @@ class Volume():
         print("finished reading")
         self.data = data
         self.createTransposedData()
-        self.active_project_views.add(project_view)
+        # project_view is None if the data is being loaded
+        # outside of the GUI (for instance, in a worker process)
+        if project_view is not None:
+            self.active_project_views.add(project_view)
         # self.setDirection(0)
         print(self.data.shape, self.trdatas[0].shape, self.trdatas[1].shape)
 
+    # Returns (offset, dtype, shape) of the data in the NRRD file:
+    # the byte offset of the data in the file, and its numpy
+    # dtype and shape (in C order), or None if the data is not
+    # stored in a form that can be memory-mapped (raw, and in
+    # the same file as the header)
+    def rawDataLayout(self):
+        header = self.data_header
+        if header.get("encoding", "") != "raw":
+            return None
+        if "data file" in header or "datafile" in header:
+            return None
+        if int(header.get("line skip", 0)) != 0 or int(header.get("byte skip", 0)) != 0:
+            return None
+        try:
+            dtype = nrrd.reader._determine_datatype(header)
+            with open(self.path, "rb") as fd:
+                # the header ends with a blank line
+                while True:
+                    line = fd.readline()
+                    if line == b'':
+                        return None
+                    if line.strip() == b'':
+                        break
+                offset = fd.tell()
+        except Exception as e:
+            print("could not find data layout of %s: %s"%(self.path, e))
+            return None
+        shape = tuple(self.sizes[::-1])
+        return offset, dtype, shape
+
+    # Like loadData, but when possible the data is memory-mapped
+    # rather than read, so that only the parts of the volume
+    # that are actually used are read from disk.  Used by
+    # worker processes, so that each of them does not hold a
+    # copy of the whole volume.
+    def mapData(self):
+        if self.data is not None:
+            return
+        layout = self.rawDataLayout()
+        if layout is None:
+            self.loadData(None)
+            return
+        offset, dtype, shape = layout
+        print("mapping data from",self.path,"for",self.name)
+        self.data = np.memmap(self.path, dtype=dtype, mode='r', offset=offset, shape=shape)
+        self.createTransposedData()
+
     def unloadData(self, project_view):
         volume_view = project_view.volumes[self]
         self.active_project_views.discard(project_view)
@@ -928,6 +674,25 @@ class Volume():
         gijks = dg*ijks + g0
         return gijks
 
+    # Returns the data values, trilinearly interpolated at the given
+    # global positions (an array of [x, y, z] rows), as float32.
+    # Positions outside of the volume are given the value 0.
+    # The data must already be loaded.
+    def sampleGlobalPositions(self, gpoints):
+        out = np.zeros(len(gpoints), dtype=np.float32)
+        g0 = np.array(self.gijk_starts)
+        dg = np.array(self.gijk_steps)
+        # data index order is k,j,i
+        dpts = ((np.asarray(gpoints, dtype=np.float64)-g0)/dg)[:,(2,1,0)]
+        dshape = np.array(self.data.shape)
+        inside = np.all((dpts >= 0) & (dpts <= dshape-1), axis=1)
+        if np.any(dshape < 2) or not inside.any():
+            return out
+        dpts = dpts[inside]
+        i0s = np.minimum(np.floor(dpts).astype(np.int64), dshape-2)
+        out[inside] = Utils.trilinear(self.data, i0s, dpts-i0s)
+        return out
+
     # returns range as [[imin,imax], [jmin,jmax], [kmin,kmax]]
     def getGlobalRanges(self):
         arr = []
@@ -845,6 +845,62 @@ class CachedZarrVolume():
         else:
             return ijkts[:,(0,2,1)]
 
+    # class member
+    # maximum number of voxels read at one time by
+    # sampleGlobalPositions
+    max_sample_box_voxels = 1<<24
+
+    def sampleGlobalPositions(self, gpoints):
+        """Returns the full-resolution (level 0) data values, trilinearly
+        interpolated at the given global positions (an array of
+        [x, y, z] rows, not necessarily integers), as float32.
+        Positions outside of the volume are given the value 0.
+        The data is read synchronously, one box at a time; the
+        points are subdivided until each box contains no more than
+        max_sample_box_voxels voxels.
+        """
+        out = np.zeros(len(gpoints), dtype=np.float32)
+        data = self.levels[0].data
+        # index order of the data is [z, y, x], or [y, z, x]
+        # for volumes created by vc_render
+        dpts = np.asarray(gpoints, dtype=np.float64)[:,(2,1,0)]
+        if self.from_vc_render:
+            dpts = dpts[:,(1,0,2)]
+        dshape = np.array(data.shape)
+        inside = np.all((dpts >= 0) & (dpts <= dshape-1), axis=1)
+        if np.any(dshape < 2) or not inside.any():
+            return out
+        idxs = np.nonzero(inside)[0]
+        dpts = dpts[idxs]
+        # the lower corner of each point's interpolation cell
+        i0s = np.minimum(np.floor(dpts).astype(np.int64), dshape-2)
+        fracs = (dpts-i0s).astype(np.float32)
+
+        self.levels[0].setImmediateDataMode(True)
+        try:
+            stack = [np.arange(len(idxs))]
+            while len(stack) > 0:
+                sel = stack.pop()
+                lo = i0s[sel].min(axis=0)
+                hi = i0s[sel].max(axis=0)+2
+                size = hi-lo
+                if np.prod(size) > self.max_sample_box_voxels and len(sel) > 1:
+                    axis = np.argmax(size)
+                    below = i0s[sel,axis] < lo[axis]+size[axis]//2
+                    stack.append(sel[below])
+                    stack.append(sel[~below])
+                    continue
+                box = data[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]]
+                if self.original_dtype == np.uint8 and box.dtype == np.uint8:
+                    # same scaling as in TransposedDataView
+                    box = box.astype(np.float32)*256+128
+                box = box.astype(np.float32)
+                values = Utils.trilinear(box, i0s[sel]-lo, fracs[sel])
+                out[idxs[sel]] = values
+        finally:
+            self.levels[0].setImmediateDataMode(False)
+        return out
+
     def getGlobalRanges(self):
         arr = []
         for i in range(3):
@@ -0,0 +1,307 @@
+from PyQt5 import QtCore, QtGui, QtWidgets
+from PyQt5.QtCore import Qt
+from color import Color
+
+
+class ColorSelectorDelegate(QtWidgets.QStyledItemDelegate):
+    def __init__(self, table, parent=None):
+        super(ColorSelectorDelegate, self).__init__(parent)
+        self.table = table
+        # self.color = QColor()
+
+    def createEditor(self, parent, option, index):
+        # print("ce", index.row())
+        cb = QtWidgets.QPushButton(parent)
+        cb.setContentsMargins(5,5,5,5)
+        cb.clicked.connect(lambda d: self.onClicked(d, cb, index))
+        return cb
+
+    def onClicked(self, cb_index, push_button, model_index):
+        old_color = push_button.palette().color(QtGui.QPalette.Window)
+        new_color = QtWidgets.QColorDialog.getColor(old_color, self.table)
+        # print("old_color",old_color.name(),"new_color",new_color.name())
+        if new_color.isValid() and new_color != old_color:
+            self.setColor(push_button, new_color.name())
+            self.table.model().setData(model_index, new_color, Qt.EditRole)
+
+    # this could be a class function
+    def setColor(self, push_button, color):
+        # color is a string, not a qcolor
+        # print("pb setting color", color)
+        push_button.setStyleSheet("background-color: %s"%color)
+
+    def setEditorData(self, editor, index):
+        # print("sed", index.row(), index.data(Qt.EditRole))
+        # print("sed", index.row(), index.data(Qt.DisplayRole))
+        color = index.data(Qt.DisplayRole)
+        # color is a string
+        if color:
+            # editor.setCurrentIndex(cb_index)
+            self.setColor(editor, color)
+
+    def setModelData(self, editor, model, index):
+        old_color = editor.palette().color(QtGui.QPalette.Window)
+        # print("csd smd", old_color.name())
+
+    def displayText(self, value, locale):
+        return ""
+
+
+class DirectionSelectorDelegate(QtWidgets.QStyledItemDelegate):
+    def __init__(self, table, parent=None):
+        super(DirectionSelectorDelegate, self).__init__(parent)
+        self.table = table
+
+    def createEditor(self, parent, option, index):
+        # print("ce", index.row())
+        cb = QtWidgets.QComboBox(parent)
+        # row = index.row()
+        cb.addItem("X")
+        cb.addItem("Y")
+        cb.activated.connect(lambda d: self.onActivated(d, cb, index))
+        return cb
+
+    def onActivated(self, cb_index, combo_box, model_index):
+        self.table.model().setData(model_index, combo_box.currentText(), Qt.EditRole)
+
+    def setEditorData(self, editor, index):
+        # print("sed", index.row(), index.data(Qt.EditRole))
+        # print("sed", index.row(), index.data(Qt.DisplayRole))
+        cb_index = index.data(Qt.DisplayRole)
+        if cb_index >= 0:
+            editor.setCurrentIndex(cb_index)
+        # return editor
+        # for i in range(15):
+        #     print(i, index.data(i))
+        # otxt = index.data(Qt.EditRole)
+        # cb_index = editor.findText(otxt)
+        # if index >= 0:
+        #     editor.setCurrentIndex(index)
+        # return editor
+
+    def setModelData(self, editor, model, index):
+        pass
+        # print("smd", editor.currentText())
+        # do nothing, since onActivated handled it
+        # model.setData(index, editor.currentText(), Qt.EditRole)
+
+class VolumesModel(QtCore.QAbstractTableModel):
+    def __init__(self, project_view, main_window):
+        super(VolumesModel, self).__init__()
+        # note that self.project_view should not be
+        # changed after initialization; instead, a new
+        # instance of VolumesModel should be created
+        # and attached to the QTableView
+        self.project_view = project_view
+        self.main_window = main_window
+
+    columns = [
+            "Use",
+            "Name",
+            "Color",
+            "Ld",
+            "Dir",
+            "X min",
+            "X max",
+            "dX",
+            "Y min",
+            "Y max",
+            "dY",
+            "Z min",
+            "Z max",
+            "dZ",
+            "Gb",
+            ]
+
+    ctips = [
+            "Select which volume is visible;\nclick box to select",
+            "Name of the volume",
+            "Color of the volume outline drawn on slices;\nclick to edit",
+            "Is volume currently loaded in memory\n(volumes that are not currently displayed\nare unloaded by default)",
+            """Direction (orientation) of the volume;
+X means that the X axis in the original tiff 
+files is aligned with the vertical axes of the slice
+displays; Y means that the Y axis in the original
+tiff files is aligned with the slice vertical axes""",
+            "Minimum X coordinate of the volume,\nrelative to tiff coordinates",
+            "Maximum X coordinate of the volume,\nrelative to tiff coordinates",
+            "X step (number of pixels stepped\nin the X direction in the tiff image\nfor each pixel in the slices)",
+            "Minimum Y coordinate of the volume,\nrelative to tiff coordinates",
+            "Maximum Y coordinate of the volume,\nrelative to tiff coordinates",
+            "Y step (number of pixels stepped\nin the X direction in the tiff image\nfor each pixel in the slices)",
+            "Minimum Z coordinate (image number) of the volume",
+            "Maximum Z coordinate (image number) of the volume",
+            "Z step (number of tiff images stepped for each slice image)",
+            "Data size in Gb (10^9 bytes)",
+            ]
+    
+    def flags(self, index):
+        col = index.column()
+        # if col in (0,1,2):
+        #     return Qt.ItemIsEditable|Qt.ItemIsEnabled
+        oflags = super(VolumesModel, self).flags(index)
+        if col == 0:
+            # print(col, int(oflags))
+            nflags = Qt.ItemNeverHasChildren
+            nflags |= Qt.ItemIsUserCheckable
+            nflags |= Qt.ItemIsEnabled
+            # nflags |= Qt.ItemIsEditable
+            return nflags
+        elif col== 2 or col == 4:
+            nflags = Qt.ItemNeverHasChildren
+            # nflags |= Qt.ItemIsUserCheckable
+            nflags |= Qt.ItemIsEnabled
+            # nflags |= Qt.ItemIsEditable
+            return nflags
+        else:
+            return Qt.ItemNeverHasChildren|Qt.ItemIsEnabled
+
+    def headerData(self, section, orientation, role):
+        if orientation != Qt.Horizontal:
+            return None
+        
+        if role == Qt.DisplayRole:
+            if section == 0:
+                # print("HD", self.rowCount())
+                table = self.main_window.volumes_table
+                # make sure the combo box in column 4 is always open
+                # (so no double-clicking required)
+                for i in range(self.rowCount()):
+                    index = self.createIndex(i, 2)
+                    table.openPersistentEditor(index)
+                    index = self.createIndex(i, 4)
+                    table.openPersistentEditor(index)
+
+            return VolumesModel.columns[section]
+        elif role == Qt.ToolTipRole:
+            return VolumesModel.ctips[section]
+
+    def columnCount(self, parent=None):
+        return len(VolumesModel.columns)
+
+    def rowCount(self, parent=None):
+        if self.project_view is None:
+            return 0
+        volumes = self.project_view.volumes
+        return len(volumes.keys())
+
+    # columns: name, color, direction, xmin, xmax, xstep, y..., img...
+
+    def data(self, index, role):
+        if self.project_view is None:
+            return None
+        if role == Qt.DisplayRole:
+            return self.dataDisplayRole(index, role)
+        elif role == Qt.TextAlignmentRole:
+            return self.dataAlignmentRole(index, role)
+        elif role == Qt.BackgroundRole:
+            return self.dataBackgroundRole(index, role)
+        elif role == Qt.CheckStateRole:
+            return self.dataCheckStateRole(index, role)
+        return None
+
+    def dataCheckStateRole(self, index, role):
+        column = index.column()
+        row = index.row()
+        volumes = self.project_view.volumes
+        volume = list(volumes.keys())[row]
+        selected = (self.project_view.cur_volume == volume)
+        if column == 0:
+            if selected:
+                return Qt.Checked
+            else:
+                return Qt.Unchecked
+
+    def dataAlignmentRole(self, index, role):
+        # column = index.column()
+        # if column >= 4:
+        #     return Qt.AlignVCenter + Qt.AlignRight
+        return Qt.AlignVCenter + Qt.AlignRight
+
+    def dataBackgroundRole(self, index, role):
+        row = index.row()
+        volumes = self.project_view.volumes
+        volume = list(volumes.keys())[row]
+        if self.project_view.cur_volume == volume:
+            return QtGui.QColor(self.main_window.highlightedBackgroundColor())
+
+    def dataDisplayRole(self, index, role):
+        row = index.row()
+        column = index.column()
+        volumes = self.project_view.volumes
+        volume = list(volumes.keys())[row]
+        volume_view = volumes[volume]
+        mins = volume.gijk_starts
+        steps = volume.gijk_steps 
+        sizes = volume.sizes
+        selected = (self.project_view.cur_volume == volume)
+        if column == 1:
+            return volume.name
+        elif column == 2:
+            # print("ddr", row, volume_view.color.name())
+            return volume_view.color.name()
+        elif column == 3:
+            if volume.data is None:
+                return 'No'
+            else:
+                return 'Yes'
+        elif column == 4:
+            # return "%s"%(('X','Y')[volume_view.direction])
+            # print("data display role", row, volume_view.direction)
+            return (0,1)[volume_view.direction]
+
+        elif column >= 5 and column < 14:
+            i3 = column-5
+            i = i3//3
+            j = i3 %3
+            x0 = mins[i]
+            dx = steps[i]
+            nx = sizes[i]
+            if j == 0:
+                return x0
+            elif j == 1:
+                return x0+dx*(nx-1)
+            else:
+                return dx
+        elif column == 14:
+            gb = volume.dataSize()/1000000000
+            # print(volume.name,gb)
+            return "%0.1f"%gb
+        else:
+            return None
+
+    def setData(self, index, value, role):
+        row = index.row()
+        column = index.column()
+        # print("setdata", row, column, value, role)
+        # if role != Qt.EditRole:
+        #     return False
+        if role == Qt.CheckStateRole and column == 0:
+            # print(row, value)
+            if value != Qt.Checked:
+                self.main_window.setVolume(None)
+                return False
+            volumes = self.project_view.volumes
+            volume = list(volumes.keys())[row]
+            volume_view = volumes[volume]
+            self.main_window.setVolume(volume)
+            # return True
+        if role == Qt.EditRole and column == 2:
+            # value is a QColor; the volume view stores a plain Color
+            color = Color(value.name())
+            volumes = self.project_view.volumes
+            volume = list(volumes.keys())[row]
+            volume_view = volumes[volume]
+            # print("setdata", row, color.name())
+            # volume_view.setColor(color)
+            self.main_window.setVolumeViewColor(volume_view, color)
+        if role == Qt.EditRole and column == 4:
+            # print("setdata", row, value)
+            direction = 0
+            if value == 'Y':
+                direction = 1
+            volumes = self.project_view.volumes
+            volume = list(volumes.keys())[row]
+            self.main_window.setDirection(volume, direction)
+
+        return False
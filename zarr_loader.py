@@ -22,6 +22,7 @@ from PyQt5.QtWidgets import (
         )
 from PyQt5.QtCore import QSize, Qt, qVersion, QSettings
 from PyQt5.QtGui import QPalette, QColor, QCursor, QIntValidator
+from color import Color
 
 class ColorEdit(QPushButton):
 
@@ -300,7 +301,7 @@ class ZarrLoader(QMainWindow):
             self.main_window.setVolume(new_volume)
             vv = self.main_window.project_view.cur_volume_view
             # vv.setColor(QColor(self.color()))
-            self.main_window.setVolumeViewColor(vv, QColor(self.color()))
+            self.main_window.setVolumeViewColor(vv, Color(self.color().name()))
             self.hide()
         # unset name of volume
         self.nameedit.setText("")